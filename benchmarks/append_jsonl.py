@@ -0,0 +1,65 @@
+"""
+Benchmark of appending records to a growing file: `append_json` rewrites the whole file on every call,
+`append_jsonl` and `JsonlWriter` only write the new records, so their cost per append stays constant.
+
+Usage: python benchmarks/append_jsonl.py --n_appends 2000
+"""
+# SETUP
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+root_dir = os.path.abspath(os.path.join(__file__, '../' * 2))
+sys.path.append(root_dir)
+
+# IMPORTS
+import tempfile
+import time
+import typing as tp
+import click
+
+from src.read_write import append_json, append_jsonl, JsonlWriter, read_json
+
+RECORD = read_json(os.path.join(root_dir, "data", "results", "de_a2_test.json"))[0]
+
+
+def measure(append: tp.Callable[[tp.Dict], None], n_appends: int, report_every: int) -> tp.List[float]:
+    """
+    Appends `n_appends` records one by one.
+    :return: mean time of one append (in ms) for each window of `report_every` appends
+    """
+    timings = []
+    start = time.perf_counter()
+    for append_id in range(1, n_appends + 1):
+        append(RECORD)
+        if append_id % report_every == 0:
+            timings.append((time.perf_counter() - start) / report_every * 1000)
+            start = time.perf_counter()
+    return timings
+
+
+@click.command()
+@click.option("--n_appends", default=2000, help="Number of appended records (default: 2000)")
+@click.option("--report_every", default=500, help="Size of the window to average over (default: 500)")
+def main(n_appends: int, report_every: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_path = os.path.join(tmp_dir, "results.json")
+        jsonl_path = os.path.join(tmp_dir, "results.jsonl")
+        writer_path = os.path.join(tmp_dir, "results_writer.jsonl")
+
+        with JsonlWriter(writer_path) as writer:
+            results = {
+                "append_json": measure(lambda record: append_json(json_path, [record]), n_appends, report_every),
+                "append_jsonl": measure(lambda record: append_jsonl(jsonl_path, [record]), n_appends, report_every),
+                "JsonlWriter": measure(writer.write, n_appends, report_every),
+            }
+
+    header = "".join(f"{f'<={(i + 1) * report_every}':>10}" for i in range(n_appends // report_every))
+    print(f"ms per append, by number of records already in the file")
+    print(f"{'':>14}{header}")
+    for name, timings in results.items():
+        print(f"{name:>14}" + "".join(f"{timing:>10.3f}" for timing in timings))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Benchmark of `AsyncGenerationHandler` with `AsyncOpenAIApi` against a local stand-in OpenAI server.
+All requests share one event loop; throughput grows with `max_concurrency` until the server saturates.
+
+Usage: python benchmarks/async_generation.py --n_prompts 500 --latency 0.05
+"""
+# SETUP
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+root_dir = os.path.abspath(os.path.join(__file__, '../' * 2))
+sys.path.append(root_dir)
+sys.path.append(os.path.dirname(__file__))
+
+# IMPORTS
+import asyncio
+import json
+import time
+import typing as tp
+import click
+
+from fake_openai_server import FakeOpenAIServer
+from src.api.api import AsyncOpenAIApi
+from src.api.handler.handler import AsyncGenerationHandler
+from src.api.handler.response_validators import JsonResponseValidator
+
+
+async def run(base_url: str, prompts: tp.List[str], concurrency: tp.Tuple[int, ...]) -> None:
+    api = AsyncOpenAIApi(api_key="fake", model="fake", base_url=base_url)
+    handler = AsyncGenerationHandler(generator=api, response_validators=[JsonResponseValidator()])
+
+    print(f"{'max_concurrency':>16} {'seconds':>10} {'prompts/s':>10}")
+    for max_concurrency in concurrency:
+        start = time.perf_counter()
+        results = await handler.generate_many(prompts, max_concurrency=max_concurrency)
+        elapsed = time.perf_counter() - start
+
+        assert [json.loads(result)["prompt"] for result in results] == prompts, "Results are out of order"
+        print(f"{max_concurrency:>16} {elapsed:>10.3f} {len(prompts) / elapsed:>10.1f}")
+
+
+@click.command()
+@click.option("--n_prompts", default=500, help="Number of prompts to generate (default: 500)")
+@click.option("--latency", default=0.05, help="Latency of the fake server in seconds (default: 0.05)")
+@click.option("--concurrency", "-j", multiple=True, type=int, default=[1, 10, 50, 200], help="Values of max_concurrency to try")
+def main(n_prompts: int, latency: float, concurrency: tp.Tuple[int, ...]) -> None:
+    prompts = [f"prompt {i}" for i in range(n_prompts)]
+    with FakeOpenAIServer(latency=latency) as server:
+        asyncio.run(run(server.base_url, prompts, concurrency))
+
+if __name__ == "__main__":
+    main()
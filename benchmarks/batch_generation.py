@@ -0,0 +1,51 @@
+"""
+Runs `GenerationHandler.generate_batch` with `OpenAIApi` against a local fake Batch API
+and checks that results are mapped back to the input rows.
+
+Usage: python benchmarks/batch_generation.py --n_prompts 1000 --batch_latency 1
+"""
+# SETUP
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+root_dir = os.path.abspath(os.path.join(__file__, '../' * 2))
+sys.path.append(root_dir)
+sys.path.append(os.path.dirname(__file__))
+
+# IMPORTS
+import json
+import tempfile
+import time
+import click
+
+from fake_openai_server import FakeOpenAIServer
+from src.api.api import OpenAIApi
+from src.api.prompter import TemplatePrompter
+from src.api.handler.handler import GenerationHandler
+from src.api.handler.response_validators import JsonResponseValidator
+
+
+@click.command()
+@click.option("--n_prompts", default=1000, help="Number of prompts in the batch (default: 1000)")
+@click.option("--batch_latency", default=1.0, help="Time the fake server takes to complete the batch in seconds (default: 1)")
+@click.option("--poll_interval", default=0.2, help="Time between batch status polls in seconds (default: 0.2)")
+def main(n_prompts: int, batch_latency: float, poll_interval: float) -> None:
+    prompter = TemplatePrompter("User: {word} ({translation})")
+    rows = [{"word": f"word_{i}", "translation": f"translation_{i}"} for i in range(n_prompts)]
+    prompts = [prompter.get_prompt(**row) for row in rows]
+
+    with FakeOpenAIServer(batch_latency=batch_latency) as server, tempfile.TemporaryDirectory() as tmp_dir:
+        api = OpenAIApi(api_key="fake", model="fake", base_url=server.base_url)
+        handler = GenerationHandler(generator=api, response_validators=[JsonResponseValidator()])
+
+        start = time.perf_counter()
+        results = handler.generate_batch(prompts, batch_file=os.path.join(tmp_dir, "batch.jsonl"), poll_interval=poll_interval)
+        elapsed = time.perf_counter() - start
+
+    assert [json.loads(result)["prompt"] for result in results] == prompts, "Results are not mapped to the input rows"
+    print(f"{n_prompts} prompts in {elapsed:.2f} s (fake batch latency {batch_latency} s)")
+
+if __name__ == "__main__":
+    main()
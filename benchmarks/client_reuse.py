@@ -0,0 +1,45 @@
+"""
+Creates many `OpenAIApi` instances (as many handlers do) and sends one request through each of them,
+with shared clients from `src.api.clients` and with a new client per instance.
+Reports wall time and number of connections accepted by the local fake server.
+
+Usage: python benchmarks/client_reuse.py --n_instances 200 -j 8
+"""
+# SETUP
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+root_dir = os.path.abspath(os.path.join(__file__, '../' * 2))
+sys.path.append(root_dir)
+sys.path.append(os.path.dirname(__file__))
+
+# IMPORTS
+import time
+import click
+
+from fake_openai_server import FakeOpenAIServer
+from src.api.api import OpenAIApi
+from src.api.clients import close_shared_clients
+from src.helpers import ordered_thread_map
+
+
+@click.command()
+@click.option("--n_instances", default=200, help="Number of OpenAIApi instances, one request each (default: 200)")
+@click.option("--max_concurrency", "-j", default=8, help="Number of requests in flight (default: 8)")
+def main(n_instances: int, max_concurrency: int) -> None:
+    for shared_client in (False, True):
+        with FakeOpenAIServer() as server:
+            def request(instance_id: int) -> str:
+                api = OpenAIApi(api_key="fake", model="fake", base_url=server.base_url, shared_client=shared_client)
+                return api(f"prompt_{instance_id}")
+
+            start = time.perf_counter()
+            list(ordered_thread_map(request, range(n_instances), max_concurrency=max_concurrency))
+            elapsed = time.perf_counter() - start
+            close_shared_clients()
+            print(f"shared_client={shared_client!s:>5}: {elapsed:.2f} s, {server.n_connections} connections")
+
+if __name__ == "__main__":
+    main()
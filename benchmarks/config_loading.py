@@ -0,0 +1,81 @@
+"""
+Benchmark of loading a parameter sweep of configs (every `conf/model/*` x `conf/prompt/*`, each one loaded several times):
+the former `read_config` (hydra is initialized and the config goes through a YAML round trip on every call) vs
+`read_config` without the cache (resolved containers), `read_configs` (hydra is initialized once, equal overrides are composed once)
+and the cached `read_config` starting with an empty and with a filled cache.
+
+Usage: python benchmarks/config_loading.py --n_repeats 5
+"""
+# SETUP
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+root_dir = os.path.abspath(os.path.join(__file__, '../' * 2))
+sys.path.append(root_dir)
+
+# IMPORTS
+import itertools
+import time
+import typing as tp
+import click
+from hydra import initialize_config_dir, compose
+from omegaconf import OmegaConf
+
+from src.config_helpers import read_config, read_configs, clear_config_cache
+
+CONFIG_DIR = os.path.join(root_dir, "conf")
+
+
+def legacy_read_config(overrides: tp.List[str]) -> OmegaConf:
+    """`read_config` before the cache."""
+    with initialize_config_dir(config_dir=CONFIG_DIR, version_base=None):
+        cfg = compose(config_name="config", overrides=overrides)
+        cfg = OmegaConf.create(OmegaConf.to_yaml(cfg, resolve=True))
+    return cfg
+
+
+def sweep_overrides() -> tp.List[tp.List[str]]:
+    options = [sorted(os.path.splitext(name)[0] for name in os.listdir(os.path.join(CONFIG_DIR, group)))
+               for group in ("model", "prompt")]
+    return [[f"model={model}", f"prompt={prompt}"] for model, prompt in itertools.product(*options)]
+
+
+@click.command()
+@click.option("--n_repeats", default=5, help="Number of times each config of the sweep is loaded (default: 5)")
+def main(n_repeats: int) -> None:
+    sweep = sweep_overrides() * n_repeats
+    legacy_read_config(sweep[0])  # warm up imports and hydra plugins discovery
+    expected = [OmegaConf.to_container(legacy_read_config(overrides)) for overrides in sweep]
+
+    def run_uncached() -> tp.List[OmegaConf]:
+        return [read_config(CONFIG_DIR, overrides, use_cache=False) for overrides in sweep]
+
+    def run_batch() -> tp.List[OmegaConf]:
+        clear_config_cache()
+        return read_configs(sweep, config_dir=CONFIG_DIR, use_cache=False)
+
+    def run_cached() -> tp.List[OmegaConf]:
+        clear_config_cache()
+        return [read_config(CONFIG_DIR, overrides) for overrides in sweep]
+
+    def run_warm() -> tp.List[OmegaConf]:
+        return [read_config(CONFIG_DIR, overrides) for overrides in sweep]
+
+    start = time.perf_counter()
+    [legacy_read_config(overrides) for overrides in sweep]
+    legacy_time = time.perf_counter() - start
+    print(f"{len(sweep)} configs ({len(sweep) // n_repeats} distinct)")
+    print(f"{'method':>28} {'ms per config':>14} {'speedup':>8}")
+    print(f"{'legacy read_config':>28} {legacy_time / len(sweep) * 1e3:>14.2f} {'1.0x':>8}")
+    for name, run in [("read_config(use_cache=False)", run_uncached), ("read_configs", run_batch),
+                      ("read_config (cached)", run_cached), ("read_config (warm cache)", run_warm)]:
+        start = time.perf_counter()
+        configs = run()
+        elapsed = time.perf_counter() - start
+        assert [OmegaConf.to_container(cfg) for cfg in configs] == expected, f"Configs of {name!r} differ"
+        print(f"{name:>28} {elapsed / len(sweep) * 1e3:>14.2f} {legacy_time / elapsed:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Benchmark of generation for a dataset with duplicate rows (rows of `data/words/de_a2_test.csv` repeated, rendered with
+`conf/prompt/german.yaml`) with a generator sleeping `--latency_ms` per request:
+plain `generate_many` vs `single_flight=True` (identical prompts in flight share a request) vs `deduplicate=True`
+(each unique prompt is generated once before the run). Prints the number of requests sent and saved.
+
+Usage: python benchmarks/duplicate_prompts.py --n_rows 2000 --latency_ms 20 -j 16
+"""
+# SETUP
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+root_dir = os.path.abspath(os.path.join(__file__, '../' * 2))
+sys.path.append(root_dir)
+
+# IMPORTS
+import csv
+import itertools
+import threading
+import time
+import click
+import yaml
+
+from src.api.prompter import TemplatePrompter
+from src.api.handler.handler import GenerationHandler
+from src.api.handler.response_validators import JsonResponseValidator
+
+
+class SleepingGenerator:
+    """Stand-in for an API: sleeps `latency` seconds and counts requests."""
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.n_requests = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, prompt: str) -> str:
+        with self._lock:
+            self.n_requests += 1
+        time.sleep(self.latency)
+        return '{"prompt_length": %d}' % len(prompt)
+
+
+@click.command()
+@click.option("--n_rows", default=2000, help="Number of rows, the words file is repeated up to this number (default: 2000)")
+@click.option("--latency_ms", default=20.0, help="Latency of one request in ms (default: 20)")
+@click.option("--max_concurrency", "-j", default=16, help="Number of requests in flight (default: 16)")
+def main(n_rows: int, latency_ms: float, max_concurrency: int) -> None:
+    with open(os.path.join(root_dir, "conf", "prompt", "german.yaml"), 'r', encoding='utf-8') as f:
+        prompter = TemplatePrompter(yaml.safe_load(f)["template"])
+    with open(os.path.join(root_dir, "data", "words", "de_a2_test.csv"), 'r', encoding='utf-8') as f:
+        words = list(csv.DictReader(f))
+    prompts = prompter.render_many(list(itertools.islice(itertools.cycle(words), n_rows)))
+    print(f"{len(prompts)} rows, {len(set(prompts))} unique prompts, {latency_ms} ms per request, {max_concurrency} in flight")
+
+    print(f"{'mode':>14} {'seconds':>8} {'requests':>9} {'saved':>6}")
+    expected = None
+    for name, single_flight, deduplicate in [("plain", False, False), ("single_flight", True, False),
+                                             ("deduplicate", False, True)]:
+        generator = SleepingGenerator(latency_ms / 1000)
+        handler = GenerationHandler(generator, response_validators=[JsonResponseValidator()], structured=True,
+                                    single_flight=single_flight)
+        start = time.perf_counter()
+        results = handler.generate_many(prompts, max_concurrency=max_concurrency, deduplicate=deduplicate)
+        elapsed = time.perf_counter() - start
+        expected = expected or results
+        assert results == expected, f"Results of {name!r} differ"
+        print(f"{name:>14} {elapsed:>8.2f} {generator.n_requests:>9} {handler.n_saved_calls:>6}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Local stand-in for OpenAI compatible HTTP API. Used by benchmarks to run real clients without network access.
+Supports chat completions (including streaming) and the Batch API (file upload, batch creation/polling, file content download).
+
+Usage:
+    with FakeOpenAIServer(latency=0.05) as server:
+        api = AsyncOpenAIApi(api_key="fake", model="fake", base_url=server.base_url)
+"""
+import itertools
+import json
+import threading
+import time
+import typing as tp
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _FakeOpenAIRequestHandler(BaseHTTPRequestHandler):
+    """Answers chat completion requests with the prompt wrapped into json."""
+    protocol_version = "HTTP/1.1"  # keep-alive connections
+    server: "_FakeHTTPServer"
+
+    def setup(self) -> None:
+        super().setup()
+        with self.server.lock:
+            self.server.n_connections += 1
+
+    def log_message(self, format: str, *args: tp.Any) -> None:
+        pass
+
+    def _send_json(self, data: tp.Dict[str, tp.Any], status: int = 200) -> None:
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_bytes(self, body: bytes) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _completion(self, request: tp.Dict[str, tp.Any]) -> tp.Dict[str, tp.Any]:
+        prompt = request["messages"][-1]["content"]
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "fake"),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": self.server.respond(prompt)}
+            }],
+            "usage": {"prompt_tokens": len(prompt.split()), "completion_tokens": 1, "total_tokens": len(prompt.split()) + 1}
+        }
+
+    def _stream_completion(self, request: tp.Dict[str, tp.Any]) -> None:
+        """Sends response as server-sent events, `chunk_size` characters per event."""
+        content = self.server.respond(request["messages"][-1]["content"])
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        chunk_size = self.server.chunk_size
+        try:
+            for start in range(0, len(content), chunk_size):
+                time.sleep(self.server.chunk_latency)
+                chunk = {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": request.get("model", "fake"),
+                    "choices": [{"index": 0, "finish_reason": None,
+                                 "delta": {"role": "assistant", "content": content[start:start + chunk_size]}}]
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client aborted the stream
+        self.close_connection = True
+
+    def _upload_file(self, body: bytes) -> None:
+        message = BytesParser(policy=default_policy).parsebytes(
+            f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+        )
+        content = b""
+        for part in message.iter_parts():
+            if part.get_param("name", header="content-disposition") == "file":
+                content = part.get_payload(decode=True)
+        file_id = self.server.add_file(content)
+        self._send_json({"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                         "filename": "batch.jsonl", "purpose": "batch", "status": "processed"})
+
+    def _create_batch(self, request: tp.Dict[str, tp.Any]) -> None:
+        output_lines = []
+        for line in self.server.files[request["input_file_id"]].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            batch_request = json.loads(line)
+            output_lines.append(json.dumps({
+                "id": f"batch_req_{batch_request['custom_id']}",
+                "custom_id": batch_request["custom_id"],
+                "response": {"status_code": 200, "request_id": "fake", "body": self._completion(batch_request["body"])},
+                "error": None
+            }))
+        output_file_id = self.server.add_file("\n".join(output_lines).encode("utf-8"))
+        batch_id = f"batch_{next(self.server.ids)}"
+        self.server.batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": request["endpoint"],
+            "input_file_id": request["input_file_id"],
+            "completion_window": request["completion_window"],
+            "created_at": int(time.time()),
+            "request_counts": {"total": len(output_lines), "completed": len(output_lines), "failed": 0},
+            "ready_at": time.monotonic() + self.server.batch_latency,
+            "output_file_id": output_file_id,
+        }
+        self._send_json(self._batch_state(batch_id))
+
+    def _batch_state(self, batch_id: str) -> tp.Dict[str, tp.Any]:
+        batch = dict(self.server.batches[batch_id])
+        is_ready = time.monotonic() >= batch.pop("ready_at")
+        batch["status"] = "completed" if is_ready else "in_progress"
+        if not is_ready:
+            batch["output_file_id"] = None
+        return batch
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.path.endswith("/files"):
+            self._upload_file(body)
+            return
+
+        request = json.loads(body or b"{}")
+        if self.path.endswith("/batches"):
+            self._create_batch(request)
+        elif self.path.endswith("/chat/completions"):
+            time.sleep(self.server.latency)
+            if request.get("stream"):
+                self._stream_completion(request)
+            else:
+                self._send_json(self._completion(request))
+        else:
+            self._send_json({"error": {"message": f"Unknown path {self.path!r}"}}, status=404)
+
+    def do_GET(self) -> None:
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if len(parts) >= 3 and parts[-3] == "files" and parts[-1] == "content" and parts[-2] in self.server.files:
+            self._send_bytes(self.server.files[parts[-2]])
+        elif len(parts) >= 2 and parts[-2] == "batches" and parts[-1] in self.server.batches:
+            self._send_json(self._batch_state(parts[-1]))
+        else:
+            self._send_json({"error": {"message": f"Unknown path {self.path!r}"}}, status=404)
+
+
+class _FakeHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    latency: float
+    batch_latency: float
+    chunk_latency: float
+    chunk_size: int
+    respond: tp.Callable[[str], str]
+    files: tp.Dict[str, bytes]
+    batches: tp.Dict[str, tp.Dict[str, tp.Any]]
+    ids: tp.Iterator[int]
+    n_connections: int
+    lock: threading.Lock
+
+    def add_file(self, content: bytes) -> str:
+        file_id = f"file-{next(self.ids)}"
+        self.files[file_id] = content
+        return file_id
+
+
+class FakeOpenAIServer:
+    """Runs fake OpenAI server in a background thread."""
+    def __init__(self, latency: float = 0.0, respond: tp.Optional[tp.Callable[[str], str]] = None,
+                 host: str = "127.0.0.1", port: int = 0, batch_latency: float = 0.0,
+                 chunk_latency: float = 0.0, chunk_size: int = 8) -> None:
+        """
+        :param latency: delay of every response in seconds
+        :param batch_latency: time after which created batch becomes completed in seconds
+        :param chunk_latency: delay of every chunk of streamed response in seconds
+        :param chunk_size: number of characters in one chunk of streamed response
+        :param respond: function mapping prompt to response text (default: json with the prompt)
+        :param host: host to bind
+        :param port: port to bind (0 means any free port)
+        """
+        self.httpd = _FakeHTTPServer((host, port), _FakeOpenAIRequestHandler)
+        self.httpd.latency = latency
+        self.httpd.batch_latency = batch_latency
+        self.httpd.chunk_latency = chunk_latency
+        self.httpd.chunk_size = chunk_size
+        self.httpd.files = {}
+        self.httpd.batches = {}
+        self.httpd.ids = itertools.count()
+        self.httpd.n_connections = 0
+        self.httpd.lock = threading.Lock()
+        self.httpd.respond = respond or (lambda prompt: json.dumps({"prompt": prompt}))
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    @property
+    def n_connections(self) -> int:
+        """Number of accepted connections."""
+        return self.httpd.n_connections
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: tp.Any) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
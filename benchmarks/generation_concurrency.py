@@ -0,0 +1,59 @@
+"""
+Benchmark of `GenerationHandler.generate_many` against a fake generator with network-like latency.
+Shows how throughput scales with `max_concurrency`.
+
+Usage: python benchmarks/generation_concurrency.py --n_prompts 200 --latency 0.05
+"""
+# SETUP
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+root_dir = os.path.abspath(os.path.join(__file__, '../' * 2))
+sys.path.append(root_dir)
+
+# IMPORTS
+import time
+import typing as tp
+import json
+import click
+
+from src.api.handler.handler import GenerationHandler
+from src.api.handler.response_validators import JsonResponseValidator
+
+
+class FakeSlowGenerator:
+    """Generator which sleeps for `latency` seconds and echoes the prompt as json."""
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+
+    def __call__(self, prompt: str) -> str:
+        time.sleep(self.latency)
+        return json.dumps({"prompt": prompt})
+
+
+@click.command()
+@click.option("--n_prompts", default=200, help="Number of prompts to generate (default: 200)")
+@click.option("--latency", default=0.05, help="Latency of a single fake request in seconds (default: 0.05)")
+@click.option("--concurrency", "-j", multiple=True, type=int, default=[1, 2, 4, 8, 16, 32], help="Values of max_concurrency to try")
+def main(n_prompts: int, latency: float, concurrency: tp.Tuple[int, ...]) -> None:
+    handler = GenerationHandler(
+        generator=FakeSlowGenerator(latency),
+        response_validators=[JsonResponseValidator()]
+    )
+    prompts = [f"prompt {i}" for i in range(n_prompts)]
+
+    print(f"{'max_concurrency':>16} {'seconds':>10} {'prompts/s':>10} {'speedup':>8}")
+    baseline = None
+    for max_concurrency in concurrency:
+        start = time.perf_counter()
+        results = handler.generate_many(prompts, max_concurrency=max_concurrency)
+        elapsed = time.perf_counter() - start
+
+        assert [json.loads(result)["prompt"] for result in results] == prompts, "Results are out of order"
+        baseline = baseline or elapsed
+        print(f"{max_concurrency:>16} {elapsed:>10.3f} {n_prompts / elapsed:>10.1f} {baseline / elapsed:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
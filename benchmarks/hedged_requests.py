@@ -0,0 +1,101 @@
+"""
+Tail latency of a single backend vs `HedgedApi` over two local fake backends with configurable delays.
+Every backend answers in `fast_delay` seconds, but a `slow_share` of requests takes `slow_delay` seconds;
+the primary backend rejects the first `rate_limited_requests` requests with 429, so they are failed over.
+
+Usage: python benchmarks/hedged_requests.py --n_prompts 1000 --slow_share 0.05
+"""
+# SETUP
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.ERROR)
+
+root_dir = os.path.abspath(os.path.join(__file__, '../' * 2))
+sys.path.append(root_dir)
+
+# IMPORTS
+import json
+import random
+import threading
+import time
+import typing as tp
+import click
+
+from src.api.api import LLMBaseApi
+from src.api.hedged import HedgedApi
+from src.api.handler.handler import GenerationHandler
+from src.helpers import ordered_thread_map
+
+
+class FakeRateLimitError(Exception):
+    pass
+
+
+class FakeBackend(LLMBaseApi):
+    """Backend answering with json after a random delay."""
+    def __init__(self, name: str, fast_delay: float, slow_delay: float, slow_share: float,
+                 rate_limited_requests: int = 0, seed: int = 0) -> None:
+        self.model = name
+        self.fast_delay = fast_delay
+        self.slow_delay = slow_delay
+        self.slow_share = slow_share
+        self.rate_limited_requests = rate_limited_requests
+        self.n_requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def __call__(self, prompt: str) -> str:
+        with self._lock:
+            self.n_requests += 1
+            is_rate_limited = self.n_requests <= self.rate_limited_requests
+            is_slow = self._random.random() < self.slow_share
+        if is_rate_limited:
+            raise FakeRateLimitError("429 Too many requests")
+        time.sleep(self.slow_delay if is_slow else self.fast_delay)
+        return json.dumps({"backend": self.model, "prompt": prompt})
+
+
+def percentiles(latencies: tp.List[float]) -> str:
+    latencies = sorted(latencies)
+    return ", ".join(f"p{int(q * 100)} {latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000:.0f} ms"
+                     for q in (0.5, 0.9, 0.99))
+
+
+def measure(generator: tp.Callable[[str], str], prompts: tp.List[str], max_concurrency: int) -> tp.List[float]:
+    handler = GenerationHandler(generator=generator)
+
+    def timed_generate(prompt: str) -> float:
+        start = time.perf_counter()
+        assert handler.generate(prompt) is not None
+        return time.perf_counter() - start
+
+    return list(ordered_thread_map(timed_generate, prompts, max_concurrency=max_concurrency))
+
+
+@click.command()
+@click.option("--n_prompts", default=1000, help="Number of prompts (default: 1000)")
+@click.option("--fast_delay", default=0.02, help="Usual latency of backends in seconds (default: 0.02)")
+@click.option("--slow_delay", default=0.5, help="Latency of slow requests in seconds (default: 0.5)")
+@click.option("--slow_share", default=0.05, help="Share of slow requests (default: 0.05)")
+@click.option("--rate_limited_requests", default=5, help="Number of first requests the primary rejects with 429 (default: 5)")
+@click.option("--max_concurrency", "-j", default=8, help="Number of requests in flight (default: 8)")
+def main(n_prompts: int, fast_delay: float, slow_delay: float, slow_share: float, rate_limited_requests: int,
+         max_concurrency: int) -> None:
+    prompts = [f"prompt_{i}" for i in range(n_prompts)]
+
+    single = FakeBackend("primary", fast_delay, slow_delay, slow_share, seed=0)
+    print(f"single backend: {percentiles(measure(single, prompts, max_concurrency))}")
+
+    primary = FakeBackend("primary", fast_delay, slow_delay, slow_share, rate_limited_requests=rate_limited_requests, seed=0)
+    secondary = FakeBackend("secondary", fast_delay, slow_delay, slow_share, seed=1)
+    hedged = HedgedApi([primary, secondary], hedge_percentile=0.8, initial_hedge_delay=4 * fast_delay, cooldown=0.2,
+                       rate_limit_error_types=[FakeRateLimitError], rate_limit_messages_patterns=None)
+    latencies = measure(hedged, prompts, max_concurrency)
+    hedged.close()
+    print(f"hedged:         {percentiles(latencies)}")
+    print(f"  duplicates sent: {hedged.n_hedged}, failovers: {hedged.n_failovers}, "
+          f"requests to primary/secondary: {primary.n_requests}/{secondary.n_requests}")
+
+if __name__ == "__main__":
+    main()
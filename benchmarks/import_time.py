@@ -0,0 +1,103 @@
+"""
+Import time of the package modules (`python -X importtime`, cumulative, best of several fresh interpreters)
+with a regression budget: the script fails if a module imports longer than the budget, pulls in a heavy dependency
+(pandas, openai, hydra, ...) at import, prints something or touches the log file.
+
+Usage: python benchmarks/import_time.py --budget_ms 150
+"""
+# SETUP
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+root_dir = os.path.abspath(os.path.join(__file__, '../' * 2))
+sys.path.append(root_dir)
+
+# IMPORTS
+import json
+import subprocess
+import typing as tp
+import click
+
+MODULES = (
+    "src.helpers",
+    "src.json_backends",
+    "src.read_write",
+    "src.config_helpers",
+    "src.loggers",
+    "src.metrics",
+    "src.api.api",
+    "src.api.cache",
+    "src.api.clients",
+    "src.api.hedged",
+    "src.api.prompter",
+    "src.api.structured",
+    "src.api.tokens",
+    "src.api.handler.handler",
+    "src.api.handler.packed_handler",
+    "src.api.handler.error_handlers",
+    "src.api.handler.response_processors",
+    "src.api.handler.response_validators",
+    "src.api.handler.grazie_api",
+)
+HEAVY_DEPENDENCIES = ("pandas", "pyarrow", "openai", "httpx", "hydra", "omegaconf", "jsonschema", "fastjsonschema",
+                      "grazie", "tiktoken")
+LOG_FILE = os.path.join(root_dir, "log.log")
+
+
+def _log_file_state() -> tp.Optional[tp.Tuple[int, float]]:
+    return (os.path.getsize(LOG_FILE), os.path.getmtime(LOG_FILE)) if os.path.exists(LOG_FILE) else None
+
+
+def measure_import(module: str) -> tp.Dict[str, tp.Any]:
+    """
+    Imports module in a fresh interpreter
+    :param module: module name
+    :return: cumulative import time in ms, heavy dependencies it imported, its stdout and whether it touched the log file
+    """
+    code = (f"import json, sys; import {module}; "
+            f"print('\\n' + json.dumps(sorted({{name.split('.')[0] for name in sys.modules}} & set({HEAVY_DEPENDENCIES!r}))))")
+    log_state = _log_file_state()
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=root_dir, capture_output=True, text=True,
+                             env={**os.environ, "PYTHONPATH": root_dir}, check=True)
+    stdout, _, heavy = process.stdout.rstrip("\n").rpartition("\n")
+    cumulative_us = 0
+    for line in process.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module:
+            cumulative_us = int(parts[1])
+    return {
+        "ms": cumulative_us / 1000,
+        "heavy": json.loads(heavy),
+        "stdout": stdout.strip(),
+        "touched_log": _log_file_state() != log_state,
+    }
+
+
+@click.command()
+@click.option("--budget_ms", default=150.0, help="Maximal cumulative import time of one module in ms (default: 150)")
+@click.option("--n_repeats", default=5, help="Number of fresh interpreters per module, the best time is reported (default: 5)")
+def main(budget_ms: float, n_repeats: int) -> None:
+    failures = []
+    print(f"{'module':>36} {'import ms':>10}  heavy dependencies")
+    for module in MODULES:
+        runs = [measure_import(module) for _ in range(n_repeats)]
+        best = min(runs, key=lambda run: run["ms"])
+        print(f"{module:>36} {best['ms']:>10.1f}  {', '.join(best['heavy']) or '-'}")
+        if best["ms"] > budget_ms:
+            failures.append(f"{module} imports in {best['ms']:.1f} ms, budget is {budget_ms} ms")
+        if best["heavy"]:
+            failures.append(f"{module} imports {best['heavy']} eagerly")
+        if any(run["stdout"] for run in runs):
+            failures.append(f"{module} prints at import: {best['stdout']!r}")
+        if any(run["touched_log"] for run in runs):
+            failures.append(f"{module} writes {LOG_FILE!r} at import")
+
+    if failures:
+        print("\n".join(["", "Import budget is exceeded:", *failures]))
+        sys.exit(1)
+    print(f"\nAll modules import within {budget_ms} ms without heavy dependencies and side effects")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmark of json backends (orjson, ujson, stdlib json) on a result file built from `data/results/de_a2_test.json`.
+Measures write/read of the whole file (indented and compact) and validation of single responses.
+
+Usage: python benchmarks/json_backends.py --n_records 100000
+"""
+# SETUP
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+root_dir = os.path.abspath(os.path.join(__file__, '../' * 2))
+sys.path.append(root_dir)
+
+# IMPORTS
+import itertools
+import tempfile
+import time
+import typing as tp
+import click
+
+from src.json_backends import available_json_backends
+from src.read_write import read_json, write_json
+from src.api.handler.response_validators import JsonResponseValidator
+
+
+def best_of(func: tp.Callable[[], tp.Any], n_repeats: int) -> float:
+    """Returns the best time of `n_repeats` runs in seconds."""
+    timings = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+@click.command()
+@click.option("--n_records", default=100_000, help="Number of records in the result file (default: 100000)")
+@click.option("--n_repeats", default=3, help="Number of repeats, the best time is reported (default: 3)")
+def main(n_records: int, n_repeats: int) -> None:
+    sample = read_json(os.path.join(root_dir, "data", "results", "de_a2_test.json"), json_backend="json")
+    records = list(itertools.islice(itertools.cycle(sample), n_records))
+    responses = [record["result"] for record in sample]
+
+    print(f"{'backend':>8} {'indent':>7} {'size MB':>8} {'write s':>8} {'read s':>8} {'validate us':>12}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "results.json")
+        for backend, indent in itertools.product(available_json_backends(), (4, None)):
+            write_time = best_of(lambda: write_json(records, path, indent=indent, json_backend=backend), n_repeats)
+            read_time = best_of(lambda: read_json(path, json_backend=backend), n_repeats)
+            assert read_json(path, json_backend=backend) == records
+
+            validator = JsonResponseValidator(json_backend=backend)
+            n_validations = 10_000
+            validate_time = best_of(lambda: [validator.is_response_valid(response)
+                                             for response in itertools.islice(itertools.cycle(responses), n_validations)], n_repeats)
+
+            size = os.path.getsize(path) / 2 ** 20
+            print(f"{backend:>8} {str(indent):>7} {size:>8.1f} {write_time:>8.3f} {read_time:>8.3f} {validate_time / n_validations * 1e6:>12.2f}")
+
+if __name__ == "__main__":
+    main()
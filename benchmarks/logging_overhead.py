@@ -0,0 +1,99 @@
+"""
+Cost of reporting invalid responses (`GenerationHandler._report_gen_error`) in the generation threads:
+the former loggers (a formatter built per console record, the file written on the caller thread) vs the current ones
+written synchronously, through the queue (`queued=True`) and through the queue with repeated errors rate limited.
+Console output goes to /dev/null, files to a temporary directory. Time includes the caller threads only.
+
+Usage: python benchmarks/logging_overhead.py --n_reports 20000 -j 8
+"""
+# SETUP
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+root_dir = os.path.abspath(os.path.join(__file__, '../' * 2))
+sys.path.append(root_dir)
+
+# IMPORTS
+import tempfile
+import time
+import typing as tp
+from concurrent.futures import ThreadPoolExecutor
+import click
+
+from src.loggers import CustomFormatter, DEFAULT_FORMAT, RateLimitFilter, get_colorful_logger, get_file_logger
+
+RESPONSE = "Here is the json you asked for:\n" + '{"word": "Haus", "example": "' + "Das Haus ist gross. " * 100 + '"}'
+
+
+class LegacyCustomFormatter(CustomFormatter):
+    """`CustomFormatter` before formatters were cached."""
+    def format(self, record):
+        return logging.Formatter(self.FORMATS.get(record.levelno)).format(record)
+
+
+def legacy_loggers(file_path: str, console: tp.TextIO) -> tp.Tuple[logging.Logger, logging.Logger]:
+    console_logger, file_logger = logging.getLogger("legacy_console"), logging.getLogger("legacy_file")
+    for logger, handler, formatter in [(console_logger, logging.StreamHandler(console), LegacyCustomFormatter()),
+                                       (file_logger, logging.FileHandler(file_path, mode='w'), logging.Formatter(DEFAULT_FORMAT))]:
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    return console_logger, file_logger
+
+
+def current_loggers(name: str, file_path: str, console: tp.TextIO, queued: bool,
+                    rate_limit: tp.Optional[RateLimitFilter] = None) -> tp.Tuple[logging.Logger, logging.Logger]:
+    stderr, sys.stderr = sys.stderr, console  # the colorful logger writes to sys.stderr
+    try:
+        console_logger = get_colorful_logger(f"{name}_console", queued=queued, rate_limit=rate_limit)
+    finally:
+        sys.stderr = stderr
+    return console_logger, get_file_logger(f"{name}_file", file_path=file_path, queued=queued, max_bytes=50 * 2 ** 20)
+
+
+def run(loggers: tp.Tuple[logging.Logger, logging.Logger], n_reports: int, n_threads: int, legacy: bool = False) -> float:
+    console_logger, file_logger = loggers
+
+    def report(i: int) -> None:
+        description = f"Validator JsonResponseValidator failed for prompt {i}"
+        console_logger.error(description)
+        sep = "\n" + "-" * 20 + "\n"
+        if legacy:
+            file_logger.error(description)
+            file_logger.info(f"Response:\n\n{RESPONSE}{sep}")
+        else:
+            file_logger.error(f"{description}\nResponse:\n\n{RESPONSE}{sep}")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(n_threads) as executor:
+        list(executor.map(report, range(n_reports)))
+    elapsed = time.perf_counter() - start
+    for logger in loggers:
+        for handler in logger.handlers:
+            handler.close()  # waits for the queued records
+        logger.handlers.clear()
+    return elapsed
+
+
+@click.command()
+@click.option("--n_reports", default=20_000, help="Number of reported invalid responses (default: 20000)")
+@click.option("--n_threads", "-j", default=8, help="Number of generation threads (default: 8)")
+def main(n_reports: int, n_threads: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir, open(os.devnull, 'w') as console:
+        def file_path(name: str) -> str:
+            return os.path.join(tmp_dir, f"{name}.log")
+
+        legacy_time = run(legacy_loggers(file_path("legacy"), console), n_reports, n_threads, legacy=True)
+        print(f"{'loggers':>22} {'us per report':>14} {'speedup':>8}")
+        print(f"{'legacy':>22} {legacy_time / n_reports * 1e6:>14.2f} {'1.0x':>8}")
+        for name, queued, rate_limit in [("sync", False, None), ("queued", True, None),
+                                         ("queued + rate limit", True, RateLimitFilter(max_records=20, period=60.0))]:
+            elapsed = run(current_loggers(name.replace(" ", ""), file_path(name.replace(" ", "")), console, queued, rate_limit),
+                          n_reports, n_threads)
+            print(f"{name:>22} {elapsed / n_reports * 1e6:>14.2f} {legacy_time / elapsed:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
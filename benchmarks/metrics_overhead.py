@@ -0,0 +1,53 @@
+"""
+Overhead of GenerationHandler metrics: `generate_many` with an instant generator with and without `GenerationMetrics`
+(the worst case, real requests take milliseconds to seconds). Prints the latency summary of the run with metrics.
+
+Usage: python benchmarks/metrics_overhead.py --n_prompts 100000 -j 8
+"""
+# SETUP
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+root_dir = os.path.abspath(os.path.join(__file__, '../' * 2))
+sys.path.append(root_dir)
+
+# IMPORTS
+import time
+import click
+
+from src.api.handler.handler import GenerationHandler, GenerationMetrics
+from src.api.handler.response_validators import JsonResponseValidator
+
+
+def instant_generator(prompt: str) -> str:
+    return '{"word": "' + prompt + '"}'
+
+
+def run(n_prompts: int, max_concurrency: int, metrics: GenerationMetrics | None) -> float:
+    handler = GenerationHandler(instant_generator, n_attempts=1, response_validators=[JsonResponseValidator()], metrics=metrics)
+    start = time.perf_counter()
+    handler.generate_many((f"word_{i}" for i in range(n_prompts)), max_concurrency=max_concurrency)
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.option("--n_prompts", default=100_000, help="Number of prompts (default: 100000)")
+@click.option("--max_concurrency", "-j", default=8, help="Number of requests in flight (default: 8)")
+def main(n_prompts: int, max_concurrency: int) -> None:
+    run(min(n_prompts, 1000), max_concurrency, None)  # warm up
+    without_metrics = run(n_prompts, max_concurrency, None)
+    metrics = GenerationMetrics()
+    with_metrics = run(n_prompts, max_concurrency, metrics)
+
+    overhead_us = (with_metrics - without_metrics) / n_prompts * 1e6
+    print(f"{'metrics':>8} {'time s':>8} {'us/prompt':>10}")
+    print(f"{'off':>8} {without_metrics:>8.3f} {without_metrics / n_prompts * 1e6:>10.1f}")
+    print(f"{'on':>8} {with_metrics:>8.3f} {with_metrics / n_prompts * 1e6:>10.1f}")
+    print(f"Overhead: {overhead_us:.1f} us per prompt")
+    for stage, stats in metrics.summary()["generation_stage_seconds"].items():
+        print(f"{stage:>15}: p50 {stats['p50'] * 1e6:8.1f} us, p95 {stats['p95'] * 1e6:8.1f} us, p99 {stats['p99'] * 1e6:8.1f} us")
+
+if __name__ == "__main__":
+    main()
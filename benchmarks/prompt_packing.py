@@ -0,0 +1,95 @@
+"""
+Prompt tokens and requests for a dataset (rows of `data/words/de_a2_test.csv` repeated) with one row per prompt vs
+rows packed into prompts by `PackedGenerationHandler` (`conf/prompt/german.yaml`, budget of `conf/model/gpt_3.5_turbo.yaml`).
+Packed runs go through a stand-in model which drops or breaks `--drop_rate` of the answers, so the requests include
+the retries of missing and invalid rows. Tokens are counted with tiktoken if installed, otherwise estimated.
+
+Usage: python benchmarks/prompt_packing.py --n_rows 1000 --drop_rate 0.05
+"""
+# SETUP
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+root_dir = os.path.abspath(os.path.join(__file__, '../' * 2))
+sys.path.append(root_dir)
+
+# IMPORTS
+import csv
+import itertools
+import json
+import random
+import re
+import typing as tp
+import click
+import yaml
+
+from src.api.prompter import PackedPrompter, TemplatePrompter
+from src.api.tokens import TokenBudget, TokenCounter
+from src.api.handler.packed_handler import PackedGenerationHandler
+from src.api.handler.response_validators import JsonResponseValidator
+
+
+class PackedModel:
+    """Stand-in model answering packed prompts: answers every input, `drop_rate` of the answers are missing or invalid."""
+    def __init__(self, counter: TokenCounter, drop_rate: float, seed: int = 0) -> None:
+        self.counter = counter
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.n_requests = self.prompt_tokens = 0
+
+    def __call__(self, prompt: str) -> str:
+        self.n_requests += 1
+        self.prompt_tokens += self.counter.count(prompt)
+        answers = {}
+        for key, word in re.findall(r"^\[(\d+)\] User: (.*?) \(approx", prompt, re.M):
+            if self.random.random() < self.drop_rate:
+                if self.random.random() < 0.5:
+                    answers[key] = {"part_of_speech": "noun"}
+                continue
+            answers[key] = {"part_of_speech": "noun", "plural_or_null": None, "example": f"{word}.",
+                            "example_en": "-", "word_en": "-", "meaning_en": "-"}
+        return json.dumps(answers, ensure_ascii=False)
+
+
+def read_prompt_and_model() -> tp.Tuple[tp.Dict[str, tp.Any], tp.Dict[str, tp.Any]]:
+    configs = []
+    for path in [("prompt", "german.yaml"), ("model", "gpt_3.5_turbo.yaml")]:
+        with open(os.path.join(root_dir, "conf", *path), 'r', encoding='utf-8') as f:
+            configs.append(yaml.safe_load(f))
+    return configs[0], configs[1]
+
+
+@click.command()
+@click.option("--n_rows", default=1000, help="Number of rows, the words file is repeated up to this number (default: 1000)")
+@click.option("--drop_rate", default=0.05, help="Share of missing or invalid answers in packed responses (default: 0.05)")
+@click.option("--output_tokens_per_item", default=80, help="Expected tokens of one answer, limits packs by max_output_tokens (default: 80)")
+def main(n_rows: int, drop_rate: float, output_tokens_per_item: int) -> None:
+    prompt_cfg, model_cfg = read_prompt_and_model()
+    with open(os.path.join(root_dir, "data", "words", "de_a2_test.csv"), 'r', encoding='utf-8') as f:
+        words = list(csv.DictReader(f))
+    rows = [{**word, "word": f"{word['word']} {i}"} for i, word in enumerate(itertools.islice(itertools.cycle(words), n_rows))]
+    counter = TokenCounter(model=model_cfg["model"], encoding=model_cfg["encoding"])
+    budget = TokenBudget(counter, context_length=model_cfg["context_length"], max_output_tokens=model_cfg["max_output_tokens"])
+
+    single_prompter = TemplatePrompter(prompt_cfg["template"])
+    single_tokens = sum(counter.count(prompt) for prompt in single_prompter.render_many(rows))
+    print(f"{n_rows} rows, {'exact' if counter.is_exact else 'estimated'} tokens, {drop_rate:.0%} of answers dropped")
+    print(f"{'max_items':>10} {'requests':>9} {'prompt tokens':>14} {'tokens saved':>13} {'valid rows':>11}")
+    print(f"{'1 (plain)':>10} {n_rows:>9} {single_tokens:>14} {'-':>13} {'-':>11}")
+    for max_items in (5, 10, 20, 50):
+        model = PackedModel(counter, drop_rate)
+        handler = PackedGenerationHandler(model, PackedPrompter(prompt_cfg["template"]), max_items=max_items, budget=budget,
+                                          output_tokens_per_item=output_tokens_per_item,
+                                          response_validators=[JsonResponseValidator(schema=prompt_cfg["schema"])],
+                                          structured=True)
+        results = handler.generate_rows(rows)
+        assert all(result is None or result["example"] == f"{row['word']}." for row, result in zip(rows, results)), \
+            "Answers are mapped to wrong rows"
+        n_valid = sum(result is not None for result in results)
+        print(f"{max_items:>10} {model.n_requests:>9} {model.prompt_tokens:>14} "
+              f"{1 - model.prompt_tokens / single_tokens:>12.0%} {n_valid:>11}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Benchmark of response validation against the schema of `conf/prompt/german.yaml` on responses from `data/results/de_a2_test.json`:
+`jsonschema.validate` on every response (the former behaviour: the schema is checked and the validator is rebuilt each time)
+vs the schema compiled once with each installed backend, for raw responses and for already parsed objects (`validate_many`).
+
+Usage: python benchmarks/schema_validation.py --n_responses 20000
+"""
+# SETUP
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+root_dir = os.path.abspath(os.path.join(__file__, '../' * 2))
+sys.path.append(root_dir)
+
+# IMPORTS
+import itertools
+import time
+import typing as tp
+from importlib.util import find_spec
+import click
+import jsonschema
+import yaml
+
+from src.json_backends import get_json_backend
+from src.read_write import read_json
+from src.api.handler.response_validators import JsonResponseValidator, SCHEMA_BACKENDS_PRIORITY
+
+
+def legacy_is_response_valid(response: str, schema: tp.Dict) -> bool:
+    """`JsonResponseValidator.is_response_valid` before schemas were compiled."""
+    try:
+        jsonschema.validate(get_json_backend().loads(response), schema)
+    except jsonschema.ValidationError:
+        return False
+    return True
+
+
+def timed(func: tp.Callable[[], tp.List[bool]]) -> tp.Tuple[float, tp.List[bool]]:
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+@click.command()
+@click.option("--n_responses", default=20_000, help="Number of validated responses (default: 20000)")
+def main(n_responses: int) -> None:
+    with open(os.path.join(root_dir, "conf", "prompt", "german.yaml"), 'r', encoding='utf-8') as f:
+        schema = yaml.safe_load(f)["schema"]
+    sample = [record["result"] for record in read_json(os.path.join(root_dir, "data", "results", "de_a2_test.json"))]
+    responses = list(itertools.islice(itertools.cycle(sample), n_responses))
+    parsed = [get_json_backend().loads(response) for response in responses]
+
+    legacy_time, expected = timed(lambda: [legacy_is_response_valid(response, schema) for response in responses])
+    print(f"{'backend':>15} {'strings us':>11} {'parsed us':>10} {'speedup':>8}")
+    print(f"{'legacy':>15} {legacy_time / n_responses * 1e6:>11.2f} {'-':>10} {'1.0x':>8}")
+    for backend in SCHEMA_BACKENDS_PRIORITY:
+        if find_spec(backend) is None:
+            print(f"{backend:>15} is not installed")
+            continue
+        validator = JsonResponseValidator(schema, schema_backend=backend)
+        strings_time, strings_valid = timed(lambda: validator.validate_many(responses))
+        parsed_time, parsed_valid = timed(lambda: validator.validate_many(parsed))
+        assert strings_valid == expected and parsed_valid == expected, f"Validation with {backend!r} differs"
+        print(f"{backend:>15} {strings_time / n_responses * 1e6:>11.2f} {parsed_time / n_responses * 1e6:>10.2f} "
+              f"{legacy_time / strings_time:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
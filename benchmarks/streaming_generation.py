@@ -0,0 +1,68 @@
+"""
+Compares `GenerationHandler.generate` and `generate_stream` with `OpenAIApi` against a local fake streaming server
+which answers some prompts with long prose instead of json. Streaming aborts such responses early.
+
+Usage: python benchmarks/streaming_generation.py --n_prompts 20 --broken_share 0.5
+"""
+# SETUP
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+root_dir = os.path.abspath(os.path.join(__file__, '../' * 2))
+sys.path.append(root_dir)
+sys.path.append(os.path.dirname(__file__))
+
+# IMPORTS
+import json
+import statistics
+import time
+import click
+
+from fake_openai_server import FakeOpenAIServer
+from src.api.api import OpenAIApi
+from src.api.handler.handler import GenerationHandler
+from src.api.handler.response_validators import JsonResponseValidator
+
+
+def make_respond(broken_share: float, response_length: int):
+    """Returns function answering every 1/broken_share-th prompt with prose."""
+    period = round(1 / broken_share) if broken_share > 0 else 0
+
+    def respond(prompt: str) -> str:
+        prompt_id = int(prompt.split("_")[-1])
+        if period and prompt_id % period == 0:
+            return ("I am sorry, but I can not answer in json. " * response_length)[:response_length]
+        return json.dumps({"prompt": prompt, "text": "x" * response_length})
+    return respond
+
+
+@click.command()
+@click.option("--n_prompts", default=20, help="Number of prompts (default: 20)")
+@click.option("--broken_share", default=0.5, help="Share of prompts answered with prose (default: 0.5)")
+@click.option("--response_length", default=2000, help="Length of responses in characters (default: 2000)")
+@click.option("--chunk_latency", default=0.002, help="Delay of every 8 characters chunk in seconds (default: 0.002)")
+def main(n_prompts: int, broken_share: float, response_length: int, chunk_latency: float) -> None:
+    prompts = [f"prompt_{i}" for i in range(n_prompts)]
+    respond = make_respond(broken_share, response_length)
+    with FakeOpenAIServer(respond=respond, chunk_latency=chunk_latency) as server:
+        api = OpenAIApi(api_key="fake", model="fake", base_url=server.base_url)
+        timings = []
+        handler = GenerationHandler(generator=api, response_validators=[JsonResponseValidator(max_chars_before_json=200)],
+                                    timing_callback=timings.append)
+        for name in ("generate", "generate_stream"):
+            timings.clear()
+            start = time.perf_counter()
+            results = [getattr(handler, name)(prompt) for prompt in prompts]
+            elapsed = time.perf_counter() - start
+            n_valid = sum(result is not None for result in results)
+            line = f"{name:>16}: {elapsed:.2f} s, valid {n_valid}/{n_prompts}"
+            if timings:
+                ttft = statistics.median(timing.time_to_first_token or 0 for timing in timings)
+                n_aborted = sum(timing.aborted for timing in timings)
+                line += f", median time to first token {ttft * 1000:.1f} ms, aborted {n_aborted}"
+            print(line)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark of result files built from `data/results/de_a2_test.json`: results stored as json strings inside json
+(text mode, every result is parsed again after loading) vs native json (structured mode of GenerationHandler).
+
+Usage: python benchmarks/structured_results.py --n_records 100000
+"""
+# SETUP
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+root_dir = os.path.abspath(os.path.join(__file__, '../' * 2))
+sys.path.append(root_dir)
+
+# IMPORTS
+import itertools
+import tempfile
+import time
+import typing as tp
+import click
+
+from src.json_backends import get_json_backend
+from src.read_write import read_json, write_json
+
+
+def best_of(func: tp.Callable[[], tp.Any], n_repeats: int) -> float:
+    """Returns the best time of `n_repeats` runs in seconds."""
+    timings = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+@click.command()
+@click.option("--n_records", default=100_000, help="Number of records in the result file (default: 100000)")
+@click.option("--n_repeats", default=3, help="Number of repeats, the best time is reported (default: 3)")
+def main(n_records: int, n_repeats: int) -> None:
+    loads = get_json_backend().loads
+    sample = read_json(os.path.join(root_dir, "data", "results", "de_a2_test.json"))
+    text_records = list(itertools.islice(itertools.cycle(sample), n_records))
+    native_records = [{**record, "result": loads(record["result"])} for record in text_records]
+
+    def load_text(path: str) -> tp.List[tp.Dict[str, tp.Any]]:
+        return [{**record, "result": loads(record["result"])} for record in read_json(path)]
+
+    print(f"{'results':>8} {'indent':>7} {'size MB':>8} {'write s':>8} {'load s':>8}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for indent in (4, 2, None):
+            for name, records, load in (("text", text_records, load_text), ("native", native_records, read_json)):
+                path = os.path.join(tmp_dir, f"{name}.json")
+                write_time = best_of(lambda: write_json(records, path, indent=indent), n_repeats)
+                load_time = best_of(lambda: load(path), n_repeats)
+                assert load(path) == native_records
+                print(f"{name:>8} {str(indent):>7} {os.path.getsize(path) / 2 ** 20:>8.1f} {write_time:>8.3f} {load_time:>8.3f}")
+
+if __name__ == "__main__":
+    main()
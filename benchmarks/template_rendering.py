@@ -0,0 +1,59 @@
+"""
+Benchmark of prompt rendering on the templates from `conf/prompt/*.yaml`:
+the former `smart_format` (substring scan + `str.format` on every call) vs the compiled template.
+
+Usage: python benchmarks/template_rendering.py --n_rows 100000
+"""
+# SETUP
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+root_dir = os.path.abspath(os.path.join(__file__, '../' * 2))
+sys.path.append(root_dir)
+
+# IMPORTS
+import glob
+import time
+import typing as tp
+import click
+import yaml
+
+from src.api.prompter import TemplatePrompter
+
+
+def legacy_smart_format(template: str, **kwargs: tp.Any) -> str:
+    """`smart_format` before templates were compiled."""
+    actual_keys = [key for key in kwargs if "{" + key + "}" in template]
+    return template.format(**{key: kwargs[key] for key in actual_keys})
+
+
+def timed(func: tp.Callable[[], tp.List[str]]) -> tp.Tuple[float, tp.List[str]]:
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+@click.command()
+@click.option("--n_rows", default=100_000, help="Number of rendered prompts per template (default: 100000)")
+def main(n_rows: int) -> None:
+    rows = [{"word": f"word_{i}", "translation": f"translation_{i}", "part_of_speech": "noun", "id": i}
+            for i in range(n_rows)]
+
+    print(f"{'template':>10} {'legacy s':>9} {'get_prompt s':>13} {'render_many s':>14} {'speedup':>8}")
+    for path in sorted(glob.glob(os.path.join(root_dir, "conf", "prompt", "*.yaml"))):
+        with open(path, 'r', encoding='utf-8') as f:
+            template = yaml.safe_load(f)["template"]
+        prompter = TemplatePrompter(template)
+
+        legacy_time, expected = timed(lambda: [legacy_smart_format(template, **row) for row in rows])
+        get_prompt_time, prompts = timed(lambda: [prompter.get_prompt(**row) for row in rows])
+        render_many_time, prompts_many = timed(lambda: prompter.render_many(rows))
+        assert prompts == expected and prompts_many == expected, f"Rendering of {path!r} differs"
+
+        name = os.path.splitext(os.path.basename(path))[0]
+        print(f"{name:>10} {legacy_time:>9.3f} {get_prompt_time:>13.3f} {render_many_time:>14.3f} {legacy_time / render_many_time:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -9,77 +9,194 @@ sys.path.append(root_dir)
 logging.info(f"Added {root_dir!r} to PYTHONPATH")
 
 # IMPORTS
+import itertools
 import typing as tp
 import click
+import openai
 from omegaconf import OmegaConf
 from tqdm import tqdm
-import pandas as pd
 
 from src.config_helpers import read_config, pprint_config
-from src.read_write import read_json, write_json, append_json
+from src.read_write import read_json, write_json, JsonlWriter, iter_jsonl, jsonl_to_json, iter_csv_rows
 from src.loggers import get_colorful_logger
 
 from src.api.api import OpenAIApi
-from src.api.prompter import TemplatePrompter, Prompter
+from src.api.cache import ResponseCache
+from src.api.prompter import TemplatePrompter, Prompter, PackedPrompter
+from src.api.tokens import TokenCounter, TokenBudget, BudgetedPrompter, estimate_run
 
+from src.api.handler.error_handlers import BackoffErrorHandler, CircuitBreakerErrorHandler, TokenBucketRateLimiter
 from src.api.handler.response_processors import CodeBlockExtractorProcessor
 from src.api.handler.response_validators import JsonResponseValidator
-from src.api.handler.handler import GenerationHandler
+from src.api.handler.handler import GenerationHandler, GenerationMetrics
+from src.api.handler.packed_handler import PackedGenerationHandler
 
 logger = get_colorful_logger(__name__, level=logging.INFO)
 ReportType = tp.Dict[str, tp.Any]
+PACKS_PER_CHUNK = 8  # packed prompts: number of packs per request in flight read from the words file at once
 
 def form_request(word: tp.Dict, prompter: Prompter, generator_handler: GenerationHandler) -> tp.Optional[str]:
     """
     Forms request to API.
     :param word: word
     :param prompter: Prompter
-    :return: request (None if failed)
+    :return: request (None if failed or skipped by the prompter, e.g. too long for the token budget)
     """
     prompt = prompter.get_prompt(**word)
+    if prompt is None:
+        return None
     result = generator_handler.generate(prompt)
     return result
 
 def start_generating(dataset_cfg: OmegaConf,
                      generator_handler: GenerationHandler,
-                     words: tp.List[tp.Dict],
-                     prompter: Prompter) -> tp.Tuple[tp.List, tp.List]:
+                     words: tp.Iterable[tp.Dict],
+                     prompter: Prompter,
+                     checkpoint_file: str,
+                     max_concurrency: int = 1,
+                     batch_file: tp.Optional[str] = None,
+                     stream: bool = False,
+                     progress_callback: tp.Optional[tp.Callable[[tp.Any, bool], None]] = None) -> tp.List[str]:
     """
-    Starts generating.
+    Starts generating. Each valid result is appended to the checkpoint file as soon as it is ready,
+    so a crash loses at most the requests in flight. Only Batch API keeps all words in memory, packed prompts keep
+    a chunk of words (`PACKS_PER_CHUNK` packs per request in flight).
+    Results are parsed json (the handler is structured), so they are stored as json, not as escaped strings.
+    :param dataset_cfg: dataset config
     :param generator_handler: GenerationHandler
-    :param words: each word has `word` and `translation` fields
+    :param words: each word has `word` and `translation` fields (may be a lazy iterator)
     :param prompter: Prompter
-    :return: Generated results and skipped reports ids
+    :param checkpoint_file: jsonl file to append results to
+    :param max_concurrency: number of requests to keep in flight
+    :param batch_file: if given, all prompts are sent as one request to Batch API, the batch input is saved to this file
+        (not supported by PackedGenerationHandler)
+    :param stream: whether to stream responses (clearly broken ones are aborted early, not supported by PackedGenerationHandler)
+    :param progress_callback: called with id of each word and whether its result is valid
+    :return: skipped reports ids
     """
-    results = []
+    skipped_ids = []
     keys_to_be_saved = dataset_cfg.keys_to_be_saved
-    for word in tqdm(words):
-        result = form_request(word, prompter, generator_handler)
+    id_key = get_id_key(dataset_cfg)
+    if isinstance(generator_handler, PackedGenerationHandler):
+        if batch_file is not None or stream:
+            raise ValueError("Batch API and streaming are not supported with packed prompts")
+        word_results = iter_packed_results(generator_handler, words, max_concurrency=max_concurrency)
+    elif batch_file is not None:
+        words = list(words)
+        prompts = [prompter.get_prompt(**word) for word in words]
+        generated = generator_handler.generate_batch(prompts, batch_file=batch_file, max_concurrency=max_concurrency,
+                                                     deduplicate=True)
+        word_results = zip(words, generated)
+    else:
+        words_in_flight: tp.Dict[int, tp.Dict] = {}  # results come in completion order, the order doesn't matter here
 
-        result_dict = {
-            **{key: word[key] for key in keys_to_be_saved},
-            'result': result
-        }
-        results.append(result_dict)  
+        def iter_prompts() -> tp.Iterator[tp.Optional[str]]:
+            for word_id, word in enumerate(words):
+                words_in_flight[word_id] = word
+                yield prompter.get_prompt(**word)
 
-    return results
+        generated = generator_handler.iter_generate_unordered(iter_prompts(), max_concurrency=max_concurrency, stream=stream)
+        word_results = ((words_in_flight.pop(word_id), result) for word_id, result in generated)
+    with JsonlWriter(checkpoint_file) as checkpoint:
+        for word, result in tqdm(word_results, disable=progress_callback is not None):
+            if progress_callback is not None:
+                progress_callback(word[id_key], result is not None)
+            if result is None:
+                skipped_ids.append(word[id_key])
+                continue
+            result_dict = {
+                id_key: word[id_key],  # resuming and merging find completed words by it
+                **{key: word[key] for key in keys_to_be_saved},
+                'result': result
+            }
+            checkpoint.write(result_dict)
 
-def save_results(results: tp.List, skipped_reports_ids: tp.List, result_cfg: OmegaConf) -> None:
+    return skipped_ids
+
+def iter_packed_results(generator_handler: PackedGenerationHandler, words: tp.Iterable[tp.Dict],
+                        max_concurrency: int = 1) -> tp.Iterator[tp.Tuple[tp.Dict, tp.Any]]:
+    """
+    Generates results for words packed into prompts. Words are read in chunks of `PACKS_PER_CHUNK` packs per request
+    in flight, results of each pack are returned as soon as it is done (not in the order of words).
+    :param generator_handler: PackedGenerationHandler
+    :param words: words (may be a lazy iterator)
+    :param max_concurrency: number of requests to keep in flight
+    :return: iterator over words and their results (None if failed)
+    """
+    words = iter(words)
+    chunk_size = PACKS_PER_CHUNK * generator_handler.max_items * max_concurrency
+    while chunk := list(itertools.islice(words, chunk_size)):
+        for word_id, result in generator_handler.iter_rows(chunk, max_concurrency=max_concurrency):
+            yield chunk[word_id], result
+
+def get_id_key(dataset_cfg: OmegaConf) -> str:
+    """
+    Returns name of the column identifying a word (`id_key` in dataset config, `word` by default).
+    :param dataset_cfg: dataset config
+    """
+    return dataset_cfg.get("id_key", "word")
+
+def get_checkpoint_file(dataset_cfg: OmegaConf) -> str:
+    """
+    Returns path to jsonl checkpoint (`checkpoint_file` in dataset config, `result_raw` with `.jsonl` extension by default).
+    :param dataset_cfg: dataset config
+    """
+    return dataset_cfg.get("checkpoint_file") or os.path.splitext(dataset_cfg.result_raw)[0] + ".jsonl"
+
+def get_batch_file(dataset_cfg: OmegaConf) -> str:
+    """
+    Returns path to save Batch API input (`result_raw` with `.batch.jsonl` extension).
+    :param dataset_cfg: dataset config
+    """
+    return os.path.splitext(dataset_cfg.result_raw)[0] + ".batch.jsonl"
+
+def save_metrics(metrics: GenerationMetrics, checkpoint_file: str) -> None:
+    """
+    Saves metrics of the run next to the checkpoint: json summary (`.metrics.json`) and Prometheus text (`.prom`).
+    :param metrics: metrics of the generation handler
+    :param checkpoint_file: jsonl checkpoint
+    """
+    path = os.path.splitext(checkpoint_file)[0]
+    summary = metrics.summary()
+    write_json(summary, path + ".metrics.json")
+    with open(path + ".prom", "w", encoding="utf-8") as f:
+        f.write(metrics.to_prometheus())
+    total = summary["generation_stage_seconds"].get("total")
+    if total is not None:
+        logger.info(f"Latency p50/p95/p99: {total['p50']:.2f}/{total['p95']:.2f}/{total['p99']:.2f}s, "
+                    f"{summary['requests_per_second']:.2f} words/s, tokens: {summary['generation_tokens_total']}")
+    logger.info(f"Saved metrics to {path + '.metrics.json'}")
+
+def get_completed_ids(checkpoint_file: str, id_key: str) -> tp.Set[str]:
+    """
+    Returns ids of words which already have results in the checkpoint.
+    :param checkpoint_file: jsonl checkpoint
+    :param id_key: name of the id column
+    """
+    if not os.path.exists(checkpoint_file):
+        return set()
+    return {record[id_key] for record in iter_jsonl(checkpoint_file)}
+
+def save_results(checkpoint_file: str, skipped_reports_ids: tp.List, result_cfg: OmegaConf) -> None:
     """
     Saves results.
-    :param results: results
+    :param checkpoint_file: jsonl checkpoint with results
     :param skipped_reports_ids: skipped reports ids
     :param result_cfg: result config
     """
-    result_file_raw = result_cfg.result_file_raw
+    result_file_raw = result_cfg.result_raw
 
-    if skipped_reports_ids:
-        skipped_file = result_cfg.skipped_file
+    skipped_file = result_cfg.get("skipped_file")
+    if skipped_reports_ids and skipped_file:
         write_json(path=skipped_file, data=skipped_reports_ids)
         logger.warning(f"Skipped reports: {len(skipped_reports_ids)}. Saved to {skipped_file!r}")
+    elif skipped_reports_ids:
+        logger.warning(f"Skipped reports: {len(skipped_reports_ids)}")
+    elif skipped_file and os.path.exists(skipped_file):
+        os.remove(skipped_file)  # left from the previous run, all of its words are completed now
 
-    append_json(path=result_file_raw, data=results)
-    logger.info(f"Saved results to {result_file_raw}")
+    n_results = jsonl_to_json(jsonl_path=checkpoint_file, json_path=result_file_raw, indent=2)  # orjson supports only 2
+    logger.info(f"Saved {n_results} results to {result_file_raw}")
 
 def get_generation_handler(cfg: OmegaConf) -> GenerationHandler:
     """
@@ -94,67 +211,206 @@ def get_generation_handler(cfg: OmegaConf) -> GenerationHandler:
     model_name = cfg.model.model
 
     api = OpenAIApi(api_key=api_key, model=model_name)
-    error_handlers = []  # get_too_many_requests_error_handler(sleep_time=sleep_time)
+    server_errors = [openai.APIConnectionError, openai.InternalServerError]
+    error_handlers = [
+        CircuitBreakerErrorHandler(state_file=cfg.generate.circuit_file, error_types=server_errors),
+        TokenBucketRateLimiter(requests_per_minute=cfg.generate.requests_per_minute,
+                               tokens_per_minute=cfg.generate.tokens_per_minute,
+                               token_counter=TokenCounter.from_config(cfg.model).count,
+                               error_types=[openai.RateLimitError],
+                               error_messages_patterns=None),
+        BackoffErrorHandler(max_delay=sleep_time, error_types=server_errors)
+    ]
     response_processors = [CodeBlockExtractorProcessor()]
-    response_validators = [JsonResponseValidator()]
+    schema = cfg.prompt.get("schema")
+    response_validators = [JsonResponseValidator(schema=OmegaConf.to_container(schema) if schema is not None else None)]
+    cache = ResponseCache(cfg.generate.cache_file) if cfg.generate.cache_file else None
+    if cfg.generate.get("max_items", 1) > 1:
+        logger.info(f"Packing up to {cfg.generate.max_items} words into one prompt")
+        return PackedGenerationHandler(
+            generator=api,
+            prompter=PackedPrompter(cfg.prompt.template),
+            max_items=cfg.generate.max_items,
+            budget=TokenBudget.from_config(cfg.model),
+            n_attempts=n_attempts,
+            error_handlers=error_handlers,
+            response_processors=response_processors,
+            response_validators=response_validators,
+            cache=cache,
+            metrics=GenerationMetrics(),
+            structured=True,
+            single_flight=True
+        )
     generation_handler = GenerationHandler(
         generator=api,
         n_attempts=n_attempts,
         error_handlers=error_handlers,
         response_processors=response_processors,
-        response_validators=response_validators
+        response_validators=response_validators,
+        cache=cache,
+        metrics=GenerationMetrics(),
+        structured=True,
+        single_flight=True
     )
     return generation_handler
 
-def get_relevant_words(cfg: OmegaConf) -> tp.List[ReportType]:
+def get_relevant_words(cfg: OmegaConf, exclude_ids: tp.Container[str] = (),
+                       columns: tp.Optional[tp.List[str]] = None,
+                       id_filter: tp.Optional[tp.Callable[[tp.Any], bool]] = None) -> tp.Iterator[ReportType]:
     """
-    Returns relevant words in convenient format.
+    Lazily returns relevant words in convenient format. The words file is parsed chunk by chunk.
     :param cfg: configuration
+    :param exclude_ids: ids of words to skip (e.g. already completed)
+    :param columns: columns to read (None means all)
+    :param id_filter: function selecting ids of words to return (e.g. of one shard), None means all
     :return: relevant reports
     """
-    words_df = pd.read_csv(cfg.dataset.words_file)
-    return words_df.to_dict(orient='records')
+    id_key = get_id_key(cfg.dataset)
+    for word in iter_csv_rows(cfg.dataset.words_file, columns=columns):
+        if word[id_key] not in exclude_ids and (id_filter is None or id_filter(word[id_key])):
+            yield word
 
-def generate_and_save(cfg: OmegaConf) -> None:
+def get_prompter(cfg: OmegaConf) -> Prompter:
     """
-    Generates and saves baseline predictions. Clears results file so that it doesn't contain old results.
-    In case of existing skipped reports file, use only reports from it.
+    Returns prompter. If the model config has `context_length`, too long prompts are truncated to fit into it.
     :param cfg: configuration
     """
-    words = get_relevant_words(cfg)
+    prompter = TemplatePrompter(cfg.prompt.template)
+    if cfg.model.get("context_length") is None:
+        return prompter
+    return BudgetedPrompter(prompter, TokenBudget.from_config(cfg.model, policy="truncate"))
 
+def log_run_estimate(cfg: OmegaConf) -> None:
+    """
+    Logs number of requests, tokens and cost upper bound of the run (completions are assumed to be `max_output_tokens` long).
+    :param cfg: configuration
+    """
     prompter = TemplatePrompter(cfg.prompt.template)
+    estimate = estimate_run(prompter, get_relevant_words(cfg), counter=TokenCounter.from_config(cfg.model),
+                            model_cfg=cfg.model, completion_tokens_per_request=cfg.model.get("max_output_tokens") or 0)
+    logger.info(f"Run estimate: {estimate}")
+
+def generate_to_checkpoint(cfg: OmegaConf, checkpoint_file: str,
+                           id_filter: tp.Optional[tp.Callable[[tp.Any], bool]] = None,
+                           progress_callback: tp.Optional[tp.Callable[[tp.Any, bool], None]] = None) -> tp.List[str]:
+    """
+    Generates results for words which don't have them in the checkpoint yet, appending them as they finish.
+    Failed words are retried up to `n_relaunches` times. Metrics of the run are saved next to the checkpoint.
+    :param cfg: configuration
+    :param checkpoint_file: jsonl checkpoint
+    :param id_filter: function selecting ids of words to generate (e.g. of one shard), None means all
+    :param progress_callback: called with id of each processed word and whether its result is valid
+    :return: ids of words failed in the last launch
+    """
+    prompter = get_prompter(cfg)
     generator_handler = get_generation_handler(cfg)
+    id_key = get_id_key(cfg.dataset)
+    columns = sorted({id_key, *cfg.dataset.keys_to_be_saved, *prompter.field_names})
+
+    if cfg.generate.fresh and os.path.exists(checkpoint_file):
+        logger.warning(f"Removing old checkpoint {checkpoint_file!r}")
+        os.remove(checkpoint_file)
+
+    skipped_ids = []
+    for launch_id in range(1 + cfg.generate.n_relaunches):
+        completed_ids = get_completed_ids(checkpoint_file, id_key)
+        if completed_ids:
+            logger.info(f"Launch {launch_id}: skipping {len(completed_ids)} completed words")
+        words = get_relevant_words(cfg, exclude_ids=completed_ids, columns=columns, id_filter=id_filter)
+        skipped_ids = start_generating(dataset_cfg=cfg.dataset, generator_handler=generator_handler,
+                                       words=words, prompter=prompter, checkpoint_file=checkpoint_file,
+                                       max_concurrency=cfg.generate.max_concurrency,
+                                       batch_file=get_batch_file(cfg.dataset) if cfg.generate.batch else None,
+                                       stream=cfg.generate.stream,
+                                       progress_callback=progress_callback)
+        if not skipped_ids:
+            break
+        logger.warning(f"Launch {launch_id}: {len(skipped_ids)} words failed")
 
+    if generator_handler.cache is not None:
+        logger.info(f"Cache stats: {generator_handler.cache.stats()}")
+    save_metrics(generator_handler.metrics, checkpoint_file)
+    return skipped_ids
 
-    results = start_generating(dataset_cfg=cfg.dataset, generator_handler=generator_handler,
-                                words=words, prompter=prompter)
-    write_json(data=results, path=cfg.dataset.result_raw)
+def generate_and_save(cfg: OmegaConf) -> None:
+    """
+    Generates and saves baseline predictions. Results are appended to the jsonl checkpoint as they finish.
+    Words which already have results in the checkpoint are skipped, so a crashed run can be simply restarted.
+    Failed words are retried up to `n_relaunches` times, the rest is saved to the skipped file.
+    :param cfg: configuration
+    """
+    checkpoint_file = get_checkpoint_file(cfg.dataset)
+    skipped_ids = generate_to_checkpoint(cfg, checkpoint_file)
+    save_results(checkpoint_file, skipped_ids, cfg.dataset)
 
-def set_additional_attributes(cfg: OmegaConf, n_attempts: int, sleep_time: int, n_relaunches: int) -> None:
+def set_additional_attributes(cfg: OmegaConf, n_attempts: int, sleep_time: int, n_relaunches: int,
+                              max_concurrency: int = 1, cache_file: tp.Optional[str] = None,
+                              requests_per_minute: tp.Optional[float] = None,
+                              tokens_per_minute: tp.Optional[float] = None,
+                              fresh: bool = False,
+                              batch: bool = False,
+                              stream: bool = False,
+                              circuit_file: tp.Optional[str] = None,
+                              max_items: int = 1) -> None:
     """
     Sets additional attributes to config.
     :param cfg: configuration
     :param n_attempts: number of attempts to generate response
-    :param sleep_time: time to sleep in seconds
-    :param n_relaunches: number of relaunches
+    :param sleep_time: maximal time to sleep between retries in seconds
+    :param n_relaunches: number of relaunches for failed words
+    :param max_concurrency: number of requests to keep in flight
+    :param cache_file: path to the response cache (None disables caching)
+    :param requests_per_minute: client-side budget of requests per minute (None means unlimited)
+    :param tokens_per_minute: client-side budget of prompt tokens per minute (None means unlimited)
+    :param fresh: whether to ignore the existing checkpoint and start from scratch
+    :param batch: whether to send prompts through Batch API
+    :param stream: whether to stream responses
+    :param circuit_file: file with circuit breaker state shared between processes (None keeps the state in memory)
+    :param max_items: number of words packed into one prompt (1 means no packing)
     """
     cfg.generate = OmegaConf.create()
     cfg.generate.n_attempts = n_attempts
     cfg.generate.sleep_time = sleep_time
     cfg.generate.n_relaunches = n_relaunches
+    cfg.generate.max_concurrency = max_concurrency
+    cfg.generate.cache_file = cache_file
+    cfg.generate.requests_per_minute = requests_per_minute
+    cfg.generate.tokens_per_minute = tokens_per_minute
+    cfg.generate.fresh = fresh
+    cfg.generate.batch = batch
+    cfg.generate.stream = stream
+    cfg.generate.circuit_file = circuit_file
+    cfg.generate.max_items = max_items
 
 @click.command()
 @click.option("--n_attempts", default=2, help="Number of attempts to generate response (default: 5)")
-@click.option("--n_relaunches", default=1, help="Number of relaunches of the whole pipeline (default: 2)")
-@click.option("--sleep_time", default=3600 + 100, help="Time to sleep in seconds (default: 600)")
+@click.option("--n_relaunches", default=1, help="Number of relaunches for failed words (default: 1)")
+@click.option("--sleep_time", default=600, help="Maximal time to sleep between retries in seconds (default: 600)")
+@click.option("--rpm", default=None, type=float, help="Client-side budget of requests per minute (default: unlimited)")
+@click.option("--tpm", default=None, type=float, help="Client-side budget of prompt tokens per minute (default: unlimited)")
+@click.option("--max_concurrency", "-j", default=1, help="Number of requests to keep in flight (default: 1)")
+@click.option("--cache_file", default=None, type=str, help="Path to SQLite cache of valid responses (default: no cache)")
+@click.option("--circuit_file", default=None, type=str, help="File to share circuit breaker state between processes (default: in memory)")
+@click.option("--batch", is_flag=True, help="Send prompts through Batch API (cheaper, but may take up to 24h)")
+@click.option("--stream", is_flag=True, help="Stream responses and abort clearly broken ones early")
+@click.option("--max_items", default=1, help="Number of words packed into one prompt, limited by the model context (default: 1)")
+@click.option("--fresh", is_flag=True, help="Ignore the existing checkpoint and start from scratch")
+@click.option("--dry_run", is_flag=True, help="Only estimate number of tokens and cost of the run")
 @click.option("--verbose", "-v", is_flag=True, help="Whether to print config")
 @click.option("--setup", type=str, help="Name of setup config")
-def main(n_attempts: int, n_relaunches: int, sleep_time: int, verbose: bool, setup: str) -> None:
+def main(n_attempts: int, n_relaunches: int, sleep_time: int, rpm: tp.Optional[float], tpm: tp.Optional[float],
+         max_concurrency: int, cache_file: tp.Optional[str], circuit_file: tp.Optional[str], batch: bool, stream: bool,
+         max_items: int, fresh: bool, dry_run: bool, verbose: bool, setup: str) -> None:
+    if max_items > 1 and (batch or stream):
+        raise click.BadParameter("--batch and --stream can't be used with packed prompts (--max_items > 1)")
     cfg: OmegaConf = read_config(overrides=[f"setup={setup}"])
-    set_additional_attributes(cfg, n_attempts, sleep_time, n_relaunches)
+    set_additional_attributes(cfg, n_attempts, sleep_time, n_relaunches, max_concurrency, cache_file, rpm, tpm, fresh, batch,
+                              stream, circuit_file, max_items)
     if verbose:
         pprint_config(cfg)
+    if dry_run:
+        log_run_estimate(cfg)
+        return
     generate_and_save(cfg)
 
 if __name__ == "__main__":
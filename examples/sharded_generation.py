@@ -0,0 +1,273 @@
+"""
+Multi-process sharded generation. Words are split into shards by a stable hash of their id:
+  - `--shard i/N` selects the i-th of N shards (e.g. one per machine), words of other shards are not touched
+  - each shard is split once more between `--workers` processes, each with its own GenerationHandler
+Every worker appends to its own checkpoint, so a crashed run is resumed by restarting it with the same arguments.
+The parent aggregates progress and failures, and merges worker checkpoints in the order of the words file:
+  - N = 1: into the usual checkpoint and result files (as `generation_example.py` does)
+  - N > 1: into the shard file, run `--merge --shard 0/N` on a machine having all shard files to get the result
+
+Usage:
+    python examples/sharded_generation.py --setup example_generation --workers 4 -j 8
+    python examples/sharded_generation.py --setup example_generation --workers 4 --shard 1/3    # on machine 1 of 3
+    python examples/sharded_generation.py --setup example_generation --merge --shard 0/3
+"""
+
+# SETUP
+import os
+import sys
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+root_dir = os.path.abspath(os.path.join(__file__, '../' * 2))
+sys.path.append(root_dir)
+sys.path.append(os.path.dirname(__file__))
+logging.info(f"Added {root_dir!r} to PYTHONPATH")
+
+# IMPORTS
+import multiprocessing as mp
+import queue
+import traceback
+import typing as tp
+import click
+from omegaconf import OmegaConf
+from tqdm import tqdm
+
+from src.config_helpers import read_config, pprint_config
+from src.helpers import stable_shard
+from src.read_write import JsonlWriter, iter_jsonl, iter_csv_rows
+from src.loggers import get_colorful_logger
+
+from generation_example import generate_to_checkpoint, get_checkpoint_file, get_id_key, save_results, set_additional_attributes
+
+logger = get_colorful_logger(__name__, level=logging.INFO)
+
+WORKER_SALT = "worker:"  # the split between workers is independent of the split between machines
+
+
+def parse_shard(shard: str) -> tp.Tuple[int, int]:
+    """
+    Parses shard in "i/N" format
+    :param shard: shard (e.g. "0/4")
+    :return: shard index and number of shards
+    """
+    try:
+        shard_id, n_shards = map(int, shard.split("/"))
+    except ValueError:
+        raise click.BadParameter(f"Shard must be in 'i/N' format, got {shard!r}")
+    if not 0 <= shard_id < n_shards:
+        raise click.BadParameter(f"Shard index must be in [0, {n_shards}), got {shard_id}")
+    return shard_id, n_shards
+
+def get_shard_file(dataset_cfg: OmegaConf, shard_id: int, n_shards: int) -> str:
+    """
+    Returns path to merged results of the shard (jsonl)
+    :param dataset_cfg: dataset config
+    :param shard_id: index of the shard
+    :param n_shards: number of shards
+    """
+    return os.path.splitext(dataset_cfg.result_raw)[0] + f".shard-{shard_id}-of-{n_shards}.jsonl"
+
+def get_worker_checkpoint_file(dataset_cfg: OmegaConf, shard_id: int, n_shards: int, worker_id: int, n_workers: int) -> str:
+    """
+    Returns path to checkpoint of the worker (jsonl)
+    :param dataset_cfg: dataset config
+    :param shard_id: index of the shard
+    :param n_shards: number of shards
+    :param worker_id: index of the worker
+    :param n_workers: number of workers
+    """
+    return os.path.splitext(dataset_cfg.result_raw)[0] + f".shard-{shard_id}-of-{n_shards}.worker-{worker_id}-of-{n_workers}.jsonl"
+
+class ShardFilter:
+    """Selects ids of the worker of the shard (picklable, so it can be passed to a spawned process)."""
+    def __init__(self, shard_id: int, n_shards: int, worker_id: int = 0, n_workers: int = 1) -> None:
+        self.shard_id = shard_id
+        self.n_shards = n_shards
+        self.worker_id = worker_id
+        self.n_workers = n_workers
+
+    def __call__(self, word_id: tp.Any) -> bool:
+        if self.n_shards > 1 and stable_shard(word_id, self.n_shards) != self.shard_id:
+            return False
+        return self.n_workers == 1 or stable_shard(word_id, self.n_workers, salt=WORKER_SALT) == self.worker_id
+
+def run_worker(cfg_container: tp.Dict[str, tp.Any], shard_filter: ShardFilter, checkpoint_file: str,
+               messages: mp.Queue) -> None:
+    """
+    Worker process: generates results of its part of the shard and reports progress to the parent
+    Messages: ("progress", worker_id, word_id, is_valid), ("done", worker_id, skipped_ids), ("error", worker_id, traceback)
+    :param cfg_container: configuration as a dict
+    :param shard_filter: ids of the worker
+    :param checkpoint_file: checkpoint of the worker
+    :param messages: queue to the parent
+    """
+    worker_id = shard_filter.worker_id
+    try:
+        cfg = OmegaConf.create(cfg_container)
+        skipped_ids = generate_to_checkpoint(
+            cfg, checkpoint_file, id_filter=shard_filter,
+            progress_callback=lambda word_id, is_valid: messages.put(("progress", worker_id, word_id, is_valid))
+        )
+        messages.put(("done", worker_id, skipped_ids))
+    except BaseException:
+        messages.put(("error", worker_id, traceback.format_exc()))
+        sys.exit(1)
+
+def split_budgets(cfg: OmegaConf, n_workers: int) -> OmegaConf:
+    """
+    Returns config of one worker: client-side rate limits are divided between workers
+    :param cfg: configuration
+    :param n_workers: number of workers
+    """
+    worker_cfg = OmegaConf.create(OmegaConf.to_container(cfg))
+    for budget in ("requests_per_minute", "tokens_per_minute"):
+        if worker_cfg.generate.get(budget) is not None:
+            worker_cfg.generate[budget] = worker_cfg.generate[budget] / n_workers
+    return worker_cfg
+
+def run_workers(cfg: OmegaConf, shard_id: int, n_shards: int, n_workers: int) -> tp.Tuple[tp.List[str], tp.List[int]]:
+    """
+    Runs workers of the shard and aggregates their progress and failures
+    :param cfg: configuration
+    :param shard_id: index of the shard
+    :param n_shards: number of shards
+    :param n_workers: number of worker processes
+    :return: checkpoints of all workers and indices of crashed workers
+    """
+    context = mp.get_context("spawn")  # no locks or connections inherited from the parent
+    messages = context.Queue()
+    cfg_container = OmegaConf.to_container(split_budgets(cfg, n_workers))
+    checkpoint_files = [get_worker_checkpoint_file(cfg.dataset, shard_id, n_shards, worker_id, n_workers)
+                        for worker_id in range(n_workers)]
+    processes = [
+        context.Process(target=run_worker, name=f"shard-{shard_id}-worker-{worker_id}",
+                        args=(cfg_container, ShardFilter(shard_id, n_shards, worker_id, n_workers), checkpoint_file, messages))
+        for worker_id, checkpoint_file in enumerate(checkpoint_files)
+    ]
+    for process in processes:
+        process.start()
+
+    running = set(range(n_workers))
+    crashed_ids = []
+    failed_word_ids: tp.Set[tp.Any] = set()
+    with tqdm(desc=f"Shard {shard_id}/{n_shards}", unit="word") as progress:
+        while running:
+            try:
+                message = messages.get(timeout=1.0)
+            except queue.Empty:
+                for worker_id in list(running):
+                    if processes[worker_id].exitcode is not None:  # died without a message (e.g. killed)
+                        logger.error(f"Worker {worker_id} exited with code {processes[worker_id].exitcode}")
+                        running.discard(worker_id)
+                        crashed_ids.append(worker_id)
+                continue
+
+            kind, worker_id = message[:2]
+            if kind == "progress":
+                word_id, is_valid = message[2:]
+                if is_valid:
+                    failed_word_ids.discard(word_id)
+                    progress.update()
+                else:
+                    failed_word_ids.add(word_id)
+                progress.set_postfix(failed=len(failed_word_ids))
+            elif kind == "done":
+                running.discard(worker_id)
+                logger.info(f"Worker {worker_id} finished, {len(message[2])} words failed")
+            elif kind == "error":
+                running.discard(worker_id)
+                crashed_ids.append(worker_id)
+                logger.error(f"Worker {worker_id} crashed:\n{message[2]}")
+
+    for process in processes:
+        process.join()
+    return checkpoint_files, sorted(crashed_ids)
+
+def merge_checkpoints(cfg: OmegaConf, checkpoint_files: tp.List[str], output_file: str,
+                      id_filter: tp.Optional[tp.Callable[[tp.Any], bool]] = None) -> tp.List[tp.Any]:
+    """
+    Merges checkpoints into one jsonl file in the order of the words file (so the result doesn't depend on timing)
+    :param cfg: configuration
+    :param checkpoint_files: jsonl checkpoints (missing ones are ignored)
+    :param output_file: merged jsonl file (overwritten)
+    :param id_filter: function selecting ids of words expected in the checkpoints, None means all
+    :return: ids of expected words without results
+    """
+    id_key = get_id_key(cfg.dataset)
+    results = {}
+    for checkpoint_file in checkpoint_files:
+        if os.path.exists(checkpoint_file):
+            for record in iter_jsonl(checkpoint_file):
+                results[record[id_key]] = record
+
+    missing_ids = []
+    tmp_file = output_file + ".tmp"
+    with JsonlWriter(tmp_file) as writer:
+        for word in iter_csv_rows(cfg.dataset.words_file, columns=[id_key]):
+            word_id = word[id_key]
+            if id_filter is not None and not id_filter(word_id):
+                continue
+            record = results.pop(word_id, None)
+            if record is None:
+                missing_ids.append(word_id)
+            else:
+                writer.write(record)
+    os.replace(tmp_file, output_file)
+    if results:
+        logger.warning(f"{len(results)} results have ids missing in the words file, they are dropped")
+    return missing_ids
+
+@click.command()
+@click.option("--workers", "-w", default=os.cpu_count() or 1, help="Number of worker processes (default: number of CPUs)")
+@click.option("--shard", default="0/1", help="Shard of the dataset to process in 'i/N' format, e.g. one per machine (default: 0/1)")
+@click.option("--merge", "merge_only", is_flag=True, help="Only merge results of all N shards (shard files must be available)")
+@click.option("--n_attempts", default=2, help="Number of attempts to generate response (default: 2)")
+@click.option("--n_relaunches", default=1, help="Number of relaunches for failed words (default: 1)")
+@click.option("--sleep_time", default=600, help="Maximal time to sleep between retries in seconds (default: 600)")
+@click.option("--rpm", default=None, type=float, help="Client-side budget of requests per minute of this machine (default: unlimited)")
+@click.option("--tpm", default=None, type=float, help="Client-side budget of prompt tokens per minute of this machine (default: unlimited)")
+@click.option("--max_concurrency", "-j", default=1, help="Number of requests to keep in flight per worker (default: 1)")
+@click.option("--cache_file", default=None, type=str, help="Path to SQLite cache of valid responses (default: no cache)")
+@click.option("--circuit_file", default=None, type=str, help="File to share circuit breaker state between workers (default: per worker)")
+@click.option("--stream", is_flag=True, help="Stream responses and abort clearly broken ones early")
+@click.option("--fresh", is_flag=True, help="Ignore the existing checkpoints and start from scratch")
+@click.option("--verbose", "-v", is_flag=True, help="Whether to print config")
+@click.option("--setup", type=str, help="Name of setup config")
+def main(workers: int, shard: str, merge_only: bool, n_attempts: int, n_relaunches: int, sleep_time: int,
+         rpm: tp.Optional[float], tpm: tp.Optional[float], max_concurrency: int, cache_file: tp.Optional[str],
+         circuit_file: tp.Optional[str], stream: bool, fresh: bool, verbose: bool, setup: str) -> None:
+    shard_id, n_shards = parse_shard(shard)
+    cfg: OmegaConf = read_config(overrides=[f"setup={setup}"])
+    set_additional_attributes(cfg, n_attempts, sleep_time, n_relaunches, max_concurrency, cache_file, rpm, tpm, fresh,
+                              stream=stream, circuit_file=circuit_file)
+    if verbose:
+        pprint_config(cfg)
+
+    checkpoint_file = get_checkpoint_file(cfg.dataset)
+    if merge_only:
+        shard_files = [get_shard_file(cfg.dataset, shard_id, n_shards) for shard_id in range(n_shards)]
+        absent_files = [shard_file for shard_file in shard_files if not os.path.exists(shard_file)]
+        if absent_files:
+            logger.warning(f"Shard files are not found, their words are reported as skipped: {absent_files}")
+        skipped_ids = merge_checkpoints(cfg, shard_files, checkpoint_file)
+        save_results(checkpoint_file, skipped_ids, cfg.dataset)
+        return
+
+    if fresh and n_shards == 1 and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    checkpoint_files, crashed_ids = run_workers(cfg, shard_id, n_shards, workers)
+    if crashed_ids:
+        logger.error(f"Workers {crashed_ids} crashed, rerun the same command to resume them")
+
+    if n_shards == 1:
+        # results of previous single-process runs are kept (worker results take precedence)
+        skipped_ids = merge_checkpoints(cfg, [checkpoint_file, *checkpoint_files], checkpoint_file)
+        save_results(checkpoint_file, skipped_ids, cfg.dataset)
+    else:
+        shard_file = get_shard_file(cfg.dataset, shard_id, n_shards)
+        skipped_ids = merge_checkpoints(cfg, checkpoint_files, shard_file, id_filter=ShardFilter(shard_id, n_shards))
+        logger.info(f"Saved results of shard {shard_id}/{n_shards} to {shard_file!r}, {len(skipped_ids)} words skipped")
+
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,257 @@
+import logging
+import time
 import typing as tp
+from contextvars import ContextVar
 from abc import ABC, abstractmethod
-import openai
+
+from ..json_backends import get_json_backend
+from .clients import create_openai_client, get_openai_client
+from ..read_write import write_jsonl
+
+logger = logging.getLogger(__name__)
 
 class LLMBaseApi(ABC):
     """Base class for LLM API."""
     def __init__(self, *args: tp.Any, **kwargs: tp.Any) -> None:
         pass
 
+    def pop_usage(self) -> tp.Optional[tp.Dict[str, int]]:
+        """Returns token usage of the last request in the current thread / task (None if API doesn't report it)."""
+        return None
+
     @abstractmethod
     def __call__(self, request: str) -> str:
         """Returns generated text."""
         pass
 
+class AsyncLLMBaseApi(ABC):
+    """Base class for async LLM API."""
+    def __init__(self, *args: tp.Any, **kwargs: tp.Any) -> None:
+        pass
+
+    def pop_usage(self) -> tp.Optional[tp.Dict[str, int]]:
+        """Returns token usage of the last request in the current task (None if API doesn't report it)."""
+        return None
+
+    @abstractmethod
+    async def __call__(self, request: str) -> str:
+        """Returns generated text."""
+        pass
+
+_last_usage: ContextVar[tp.Optional[tp.Dict[str, int]]] = ContextVar("last_usage", default=None)
+
+def _set_usage(usage: tp.Any) -> None:
+    """Remembers token usage of the response for the current thread / task."""
+    if usage is not None:
+        _last_usage.set({"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens})
+
+def _pop_usage() -> tp.Optional[tp.Dict[str, int]]:
+    """Returns token usage remembered for the current thread / task and forgets it."""
+    usage = _last_usage.get()
+    _last_usage.set(None)
+    return usage
+
+def _build_messages(prompt: str) -> tp.List[tp.Dict[str, str]]:
+    """Wraps prompt into chat messages."""
+    return [
+        {
+            "role": "user",
+            "content": prompt
+        }
+    ]
+
 class OpenAIApi(LLMBaseApi):
     """OpenAI API handler."""
     DEFAULT_PARAMS = {
         "temperature": 0.6
     }
-    def __init__(self, api_key: str, model: str, params: tp.Dict[str, tp.Any] | None = None) -> None:
+    BATCH_ENDPOINT = "/v1/chat/completions"
+    BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+    def __init__(self, api_key: str, model: str, params: tp.Dict[str, tp.Any] | None = None,
+                 base_url: str | None = None, pool_options: tp.Dict[str, tp.Any] | None = None,
+                 shared_client: bool = True) -> None:
         """Initializes the API.
         :@param api_key: OpenAI API key.
         :@param model: Name of model to use. (e.g. "text-davinci-003")
         :@param params: Additional parameters for the API.
+        :@param base_url: URL of OpenAI compatible server (default: official OpenAI API).
+        :@param pool_options: Connection pool settings (see `src.api.clients.DEFAULT_POOL_OPTIONS`).
+        :@param shared_client: Whether to reuse the client (and its connections) of other instances with the same
+            key, endpoint and pool settings.
         """
-        self.client = openai.OpenAI(api_key=api_key)
+        if shared_client:
+            self.client = get_openai_client(api_key, base_url=base_url, pool_options=pool_options)
+        else:
+            self.client = create_openai_client(api_key, base_url=base_url, pool_options=pool_options)
         self.model = model
         self.params = params or self.DEFAULT_PARAMS
 
     def __call__(self, prompt: str) -> str:
-        """Returns generated text."""
+        """Returns generated text. Token usage of the request is available through `pop_usage`."""
         response = self.client.chat.completions.create(
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
+            messages=_build_messages(prompt),
             model=self.model,
             **self.params
         )
+        _set_usage(response.usage)
         return response.choices[0].message.content
+
+    def stream(self, prompt: str) -> tp.Iterator[str]:
+        """Yields generated text chunk by chunk. Closing the iterator closes the connection (aborts generation)."""
+        stream = self.client.chat.completions.create(
+            messages=_build_messages(prompt),
+            model=self.model,
+            stream=True,
+            **self.params
+        )
+        with stream:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+    def pop_usage(self) -> tp.Optional[tp.Dict[str, int]]:
+        """Returns token usage of the last non-streamed request in the current thread / task."""
+        return _pop_usage()
+
+    def _batch_request(self, custom_id: str, prompt: str) -> tp.Dict[str, tp.Any]:
+        """Returns line of batch input file."""
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": self.BATCH_ENDPOINT,
+            "body": {"model": self.model, "messages": _build_messages(prompt), **self.params}
+        }
+
+    def submit_batch(self, prompts: tp.Sequence[str], batch_file: str, completion_window: str = "24h") -> str:
+        """Writes prompts to batch input file, uploads it and creates a batch.
+        :@param prompts: rendered prompts, i-th prompt gets custom_id "i".
+        :@param batch_file: path to save batch input file (jsonl).
+        :@param completion_window: time frame within which the batch should be processed.
+        :@return: batch id.
+        """
+        write_jsonl((self._batch_request(str(prompt_id), prompt) for prompt_id, prompt in enumerate(prompts)), batch_file)
+        with open(batch_file, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=self.BATCH_ENDPOINT,
+            completion_window=completion_window
+        )
+        logger.info(f"Submitted batch {batch.id!r} with {len(prompts)} requests")
+        return batch.id
+
+    def wait_batch(self, batch_id: str, poll_interval: float = 30.0, timeout: tp.Optional[float] = None) -> tp.Any:
+        """Polls batch until it is finished.
+        :@param batch_id: batch id.
+        :@param poll_interval: time between polls in seconds.
+        :@param timeout: maximal waiting time in seconds (None means forever).
+        :@return: finished batch object.
+        """
+        start = time.monotonic()
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status in self.BATCH_TERMINAL_STATUSES:
+                logger.info(f"Batch {batch_id!r} is {batch.status}")
+                return batch
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f"Batch {batch_id!r} is still {batch.status} after {timeout} seconds")
+            time.sleep(poll_interval)
+
+    def get_batch_results(self, batch: tp.Any, n_prompts: int) -> tp.List[tp.Optional[str]]:
+        """Downloads results of finished batch.
+        :@param batch: finished batch object.
+        :@param n_prompts: number of prompts in the batch.
+        :@return: generated texts in the order of prompts (None for failed requests).
+        """
+        results: tp.List[tp.Optional[str]] = [None] * n_prompts
+        if batch.output_file_id is None:
+            logger.error(f"Batch {batch.id!r} has no output file (status: {batch.status})")
+            return results
+
+        loads = get_json_backend().loads
+        content = self.client.files.content(batch.output_file_id)
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            record = loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") != 200:
+                logger.error(f"Request {record.get('custom_id')!r} of batch {batch.id!r} failed: {record.get('error') or response}")
+                continue
+            results[int(record["custom_id"])] = response["body"]["choices"][0]["message"]["content"]
+        return results
+
+    def generate_batch(self, prompts: tp.Sequence[str], batch_file: str,
+                       poll_interval: float = 30.0, timeout: tp.Optional[float] = None) -> tp.List[tp.Optional[str]]:
+        """Generates texts for all prompts through Batch API (higher latency, lower cost).
+        :@param prompts: rendered prompts.
+        :@param batch_file: path to save batch input file (jsonl).
+        :@param poll_interval: time between polls in seconds.
+        :@param timeout: maximal waiting time in seconds (None means forever).
+        :@return: generated texts in the order of prompts (None for failed requests).
+        """
+        batch_id = self.submit_batch(prompts, batch_file)
+        batch = self.wait_batch(batch_id, poll_interval=poll_interval, timeout=timeout)
+        return self.get_batch_results(batch, n_prompts=len(prompts))
+
+class AsyncOpenAIApi(AsyncLLMBaseApi):
+    """Async OpenAI API handler. Many requests share one event loop instead of a thread per request."""
+    DEFAULT_PARAMS = OpenAIApi.DEFAULT_PARAMS
+
+    def __init__(self, api_key: str, model: str, params: tp.Dict[str, tp.Any] | None = None,
+                 base_url: str | None = None, pool_options: tp.Dict[str, tp.Any] | None = None,
+                 shared_client: bool = False) -> None:
+        """Initializes the API.
+        :@param api_key: OpenAI API key.
+        :@param model: Name of model to use. (e.g. "gpt-3.5-turbo")
+        :@param params: Additional parameters for the API.
+        :@param base_url: URL of OpenAI compatible server (default: official OpenAI API).
+            Point it to a local stand-in server (e.g. "http://127.0.0.1:8000/v1") for testing.
+        :@param pool_options: Connection pool settings (see `src.api.clients.DEFAULT_POOL_OPTIONS`).
+        :@param shared_client: Whether to reuse the client (and its connections) of other instances with the same
+            key, endpoint and pool settings. Async clients are bound to the event loop of their first request,
+            so share them only if all instances are used within one event loop (one `asyncio.run`).
+        """
+        if shared_client:
+            self.client = get_openai_client(api_key, base_url=base_url, is_async=True, pool_options=pool_options)
+        else:
+            self.client = create_openai_client(api_key, base_url=base_url, is_async=True, pool_options=pool_options)
+        self.model = model
+        self.params = params or self.DEFAULT_PARAMS
+        self._batch_api_kwargs = {"api_key": api_key, "base_url": base_url, "pool_options": pool_options}
+
+    async def __call__(self, prompt: str) -> str:
+        """Returns generated text. Token usage of the request is available through `pop_usage`."""
+        response = await self.client.chat.completions.create(
+            messages=_build_messages(prompt),
+            model=self.model,
+            **self.params
+        )
+        _set_usage(response.usage)
+        return response.choices[0].message.content
+
+    def pop_usage(self) -> tp.Optional[tp.Dict[str, int]]:
+        """Returns token usage of the last non-streamed request in the current task."""
+        return _pop_usage()
+
+    async def stream(self, prompt: str) -> tp.AsyncIterator[str]:
+        """Yields generated text chunk by chunk. Closing the iterator closes the connection (aborts generation)."""
+        stream = await self.client.chat.completions.create(
+            messages=_build_messages(prompt),
+            model=self.model,
+            stream=True,
+            **self.params
+        )
+        async with stream:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+    def generate_batch(self, prompts: tp.Sequence[str], batch_file: str,
+                       poll_interval: float = 30.0, timeout: tp.Optional[float] = None) -> tp.List[tp.Optional[str]]:
+        """Generates texts for all prompts through Batch API (see `OpenAIApi.generate_batch`).
+        Blocks while the batch is polled, `AsyncGenerationHandler.generate_batch` runs it in a thread.
+        """
+        api = OpenAIApi(model=self.model, params=self.params, **self._batch_api_kwargs)
+        return api.generate_batch(prompts, batch_file, poll_interval=poll_interval, timeout=timeout)
@@ -0,0 +1,189 @@
+"""
+Persistent content-addressed cache for LLM responses.
+Entries are stored in SQLite and keyed on a hash of the model, its parameters and the rendered prompt.
+A small in-memory LRU sits in front of the database.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import typing as tp
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(generator: tp.Any, *args: tp.Any, **kwargs: tp.Any) -> str:
+    """
+    Returns key of the request: sha256 of the generator's model, its parameters and the prompt.
+    :param generator: generator (e.g. OpenAIApi), attributes `model` and `params` are used if present
+    :param args: positional arguments of the request (usually the rendered prompt)
+    :param kwargs: keyword arguments of the request
+    :return: hex digest
+    """
+    payload = {
+        "model": getattr(generator, "model", type(generator).__name__),
+        "params": getattr(generator, "params", None),
+        "args": [str(arg) for arg in args],
+        "kwargs": {key: str(value) for key, value in kwargs.items()},
+    }
+    dumped = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(dumped.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite-backed response cache with an in-memory LRU in front of it. Safe to share between threads.
+    """
+    def __init__(self, path: str,
+                 max_entries: tp.Optional[int] = 1_000_000,
+                 max_age: tp.Optional[float] = None,
+                 lru_size: int = 4096) -> None:
+        """
+        :param path: path to SQLite file (created if it doesn't exist)
+        :param max_entries: maximal number of stored entries, the oldest ones are evicted (None means unlimited)
+        :param max_age: maximal age of entry in seconds, older entries are treated as missing (None means forever)
+        :param lru_size: number of entries kept in memory
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.lru_size = lru_size
+
+        self.hits = 0
+        self.misses = 0
+
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._lru: tp.OrderedDict[str, tp.Tuple[str, float]] = OrderedDict()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+        self._connection.commit()
+        self._n_entries = self._count()
+
+    def _count(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def _is_expired(self, created_at: float) -> bool:
+        return self.max_age is not None and time.time() - created_at > self.max_age
+
+    def _remember(self, key: str, value: str, created_at: float) -> None:
+        """Put entry to LRU. Must be called under lock."""
+        self._lru[key] = (value, created_at)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def get(self, key: str) -> tp.Optional[str]:
+        """
+        Returns cached response or None
+        :param key: key of the request (see `make_cache_key`)
+        """
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                self._lru.move_to_end(key)
+            else:
+                row = self._connection.execute(
+                    "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                entry = tuple(row) if row is not None else None
+
+            if entry is None or self._is_expired(entry[1]):
+                if entry is not None:
+                    self._delete(key)
+                self.misses += 1
+                return None
+
+            self._remember(key, *entry)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: str, value: str) -> None:
+        """
+        Stores response
+        :param key: key of the request (see `make_cache_key`)
+        :param value: response
+        """
+        created_at = time.time()
+        with self._lock:
+            is_new = self._connection.execute(
+                "UPDATE responses SET value = ?, created_at = ? WHERE key = ?", (value, created_at, key)
+            ).rowcount == 0
+            if is_new:  # overwriting a key (e.g. a response re-stored after the schema changed) is not a new entry
+                self._connection.execute(
+                    "INSERT INTO responses (key, value, created_at) VALUES (?, ?, ?)", (key, value, created_at)
+                )
+            self._connection.commit()
+            self._remember(key, value, created_at)
+            self._n_entries += is_new
+            if self.max_entries is not None and self._n_entries > self.max_entries:
+                self._evict()
+
+    def _delete(self, key: str) -> None:
+        """Delete entry. Must be called under lock."""
+        self._lru.pop(key, None)
+        self._n_entries -= self._connection.execute("DELETE FROM responses WHERE key = ?", (key,)).rowcount
+        self._connection.commit()
+
+    def _evict(self) -> None:
+        """Delete expired and the oldest entries so that roughly 10% of capacity is free. Must be called under lock."""
+        if self.max_age is not None:
+            self._connection.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age,))
+        self._n_entries = self._count()
+        if self.max_entries is not None and self._n_entries > self.max_entries:
+            n_to_delete = self._n_entries - int(self.max_entries * 0.9)
+            self._connection.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY created_at LIMIT ?)", (n_to_delete,)
+            )
+            self._n_entries -= n_to_delete
+            self._lru.clear()
+            logger.info(f"Evicted {n_to_delete} entries from cache {self.path!r}")
+        self._connection.commit()
+
+    def evict(self) -> None:
+        """Delete expired entries and entries exceeding `max_entries`."""
+        with self._lock:
+            self._evict()
+
+    def clear(self) -> None:
+        """Delete all entries and reset counters."""
+        with self._lock:
+            self._connection.execute("DELETE FROM responses")
+            self._connection.commit()
+            self._lru.clear()
+            self._n_entries = 0
+            self.hits = self.misses = 0
+
+    def stats(self) -> tp.Dict[str, tp.Any]:
+        """Returns hit and miss counters."""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": self._n_entries,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def __len__(self) -> int:
+        return self._n_entries
+
+    def __enter__(self) -> "ResponseCache":
+        return self
+
+    def __exit__(self, *exc_info: tp.Any) -> None:
+        self.close()
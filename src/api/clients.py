@@ -0,0 +1,156 @@
+"""
+Registry of shared API clients. Clients are keyed by endpoint, credentials and connection pool settings,
+so all API instances with the same key reuse one connection pool (keep-alive connections, TLS sessions).
+Registry is thread-safe; in a forked child process the inherited clients are dropped and new ones are created.
+"""
+import hashlib
+import inspect
+import logging
+import os
+import threading
+import typing as tp
+from importlib.util import find_spec
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_OPTIONS: tp.Dict[str, tp.Any] = {
+    "max_connections": 1000,  # limits of openai's own clients, requests beyond them wait for a free connection
+    "max_keepalive_connections": 100,
+    "keepalive_expiry": 30.0,
+    "http2": None,  # None means enabled if `h2` is installed
+    "timeout": 600.0,
+}
+
+_lock = threading.Lock()
+_clients: tp.Dict[tp.Tuple[tp.Any, ...], tp.Any] = {}
+
+
+def _forget_clients() -> None:
+    """Drop clients inherited from the parent process (their sockets belong to the parent)."""
+    global _lock
+    _lock = threading.Lock()
+    _clients.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_clients)
+
+
+def _hash_secret(secret: tp.Optional[str]) -> tp.Optional[str]:
+    """Credentials are kept in the key only as a hash."""
+    return None if secret is None else hashlib.sha256(secret.encode("utf-8")).hexdigest()
+
+
+def get_shared_client(kind: str, endpoint: tp.Optional[str], credentials: tp.Optional[str],
+                      factory: tp.Callable[[], tp.Any], **options: tp.Any) -> tp.Any:
+    """
+    Returns client from the registry, creating it with `factory` on the first call
+    :param kind: kind of client (e.g. "openai", "openai_async", "grazie")
+    :param endpoint: URL of the API (None means the default one)
+    :param credentials: API key or token
+    :param factory: function creating a new client
+    :param options: settings of the client, part of the key
+    :return: client
+    """
+    key = (kind, endpoint, _hash_secret(credentials), tuple(sorted(options.items())))
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _lock:
+        if key not in _clients:
+            logger.debug(f"Creating shared {kind} client for {endpoint or 'default endpoint'}")
+            _clients[key] = factory()
+        return _clients[key]
+
+
+def _resolve_pool_options(pool_options: tp.Optional[tp.Dict[str, tp.Any]]) -> tp.Dict[str, tp.Any]:
+    unknown_options = set(pool_options or {}) - set(DEFAULT_POOL_OPTIONS)
+    if unknown_options:
+        raise ValueError(f"Unknown pool options {sorted(unknown_options)}, expected some of {list(DEFAULT_POOL_OPTIONS)}")
+    options = {**DEFAULT_POOL_OPTIONS, **(pool_options or {})}
+    if options["http2"] is None:
+        options["http2"] = find_spec("h2") is not None
+    elif options["http2"] and find_spec("h2") is None:
+        logger.warning("HTTP/2 requires `h2` package (pip install httpx[http2]), falling back to HTTP/1.1")
+        options["http2"] = False
+    return options
+
+
+def _make_http_client(is_async: bool, options: tp.Dict[str, tp.Any]) -> tp.Any:
+    import httpx
+    limits = httpx.Limits(max_connections=options["max_connections"],
+                          max_keepalive_connections=options["max_keepalive_connections"],
+                          keepalive_expiry=options["keepalive_expiry"])
+    client_class = httpx.AsyncClient if is_async else httpx.Client
+    return client_class(limits=limits, http2=options["http2"], timeout=options["timeout"], follow_redirects=True)
+
+
+def _make_openai_client(api_key: str, base_url: tp.Optional[str], is_async: bool, options: tp.Dict[str, tp.Any]) -> tp.Any:
+    import openai
+    client_class = openai.AsyncOpenAI if is_async else openai.OpenAI
+    return client_class(api_key=api_key, base_url=base_url, timeout=options["timeout"],
+                        http_client=_make_http_client(is_async, options))
+
+
+def create_openai_client(api_key: str, base_url: tp.Optional[str] = None, is_async: bool = False,
+                         pool_options: tp.Optional[tp.Dict[str, tp.Any]] = None) -> tp.Any:
+    """
+    Returns new (not shared) `openai.OpenAI` (or `openai.AsyncOpenAI`) client with the connection pool settings
+    :param api_key: OpenAI API key
+    :param base_url: URL of OpenAI compatible server (None means the official OpenAI API)
+    :param is_async: whether to return async client
+    :param pool_options: connection pool settings overriding DEFAULT_POOL_OPTIONS
+        (max_connections, max_keepalive_connections, keepalive_expiry, http2, timeout)
+    :return: client
+    """
+    return _make_openai_client(api_key, base_url, is_async, _resolve_pool_options(pool_options))
+
+
+def get_openai_client(api_key: str, base_url: tp.Optional[str] = None, is_async: bool = False,
+                      pool_options: tp.Optional[tp.Dict[str, tp.Any]] = None) -> tp.Any:
+    """
+    Returns shared `openai.OpenAI` (or `openai.AsyncOpenAI`) client
+    Async clients are bound to the event loop of their first request, so a shared async client fails
+    ("Event loop is closed") after `asyncio.run` is called again; share them only within one event loop
+    :param api_key: OpenAI API key
+    :param base_url: URL of OpenAI compatible server (None means the official OpenAI API)
+    :param is_async: whether to return async client
+    :param pool_options: connection pool settings overriding DEFAULT_POOL_OPTIONS
+        (max_connections, max_keepalive_connections, keepalive_expiry, http2, timeout)
+    :return: client
+    """
+    options = _resolve_pool_options(pool_options)
+    kind = "openai_async" if is_async else "openai"
+    return get_shared_client(kind, base_url, api_key, lambda: _make_openai_client(api_key, base_url, is_async, options),
+                             **options)
+
+
+def n_shared_clients() -> int:
+    """Returns number of clients in the registry."""
+    return len(_clients)
+
+
+def close_shared_clients() -> None:
+    """Close sync clients and clear the registry (async clients are dropped, close them with `aclose_shared_clients`)."""
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        close = getattr(client, "close", None)
+        if close is not None and not inspect.iscoroutinefunction(close):
+            close()
+
+
+async def aclose_shared_clients() -> None:
+    """Close all clients (sync and async) and clear the registry."""
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        close = getattr(client, "close", None)
+        if close is None:
+            continue
+        if inspect.iscoroutinefunction(close):
+            await close()
+        else:
+            close()
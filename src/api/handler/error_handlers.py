@@ -1,4 +1,11 @@
+import asyncio
+import contextvars
+import email.utils
+import json
 import logging
+import os
+import random
+import threading
 import typing as tp
 import time
 
@@ -26,6 +33,91 @@ class BaseErrorHandler(ABC):
         """
         pass
 
+    async def ahandle(self, exception: Exception) -> bool:
+        """
+        Async version of `handle`. By default, runs `handle` in a separate thread so that the event loop is not blocked
+        :param exception: exception to handle
+        :return: True if exception was handled, False otherwise
+        """
+        return await asyncio.to_thread(self.handle, exception)
+
+    def before_request(self, *args: tp.Any, **kwargs: tp.Any) -> None:
+        """
+        Called by GenerationHandler before each request with the arguments of the request. By default, does nothing
+        """
+        pass
+
+    async def abefore_request(self, *args: tp.Any, **kwargs: tp.Any) -> None:
+        """
+        Async version of `before_request`. Must be overridden if `before_request` blocks
+        """
+        self.before_request(*args, **kwargs)
+
+    def after_request(self, exception: tp.Optional[Exception] = None) -> None:
+        """
+        Called by GenerationHandler after each request (before the error is handled). By default, does nothing
+        :param exception: error raised by the request (None if response was received)
+        """
+        pass
+
+    async def aafter_request(self, exception: tp.Optional[Exception] = None) -> None:
+        """
+        Async version of `after_request`. Must be overridden if `after_request` blocks
+        """
+        self.after_request(exception)
+
+RATE_LIMIT_STATUS_CODE = 429
+RATE_LIMIT_MESSAGES_PATTERNS = ["rate limit", "too many requests"]
+
+def is_rate_limit_error(exception: Exception) -> bool:
+    """
+    Check if exception is a rate limit error: HTTP status 429 (`status_code` of the exception or of its response,
+    e.g. openai.RateLimitError) or a message with one of RATE_LIMIT_MESSAGES_PATTERNS (e.g. "Too many requests" of Grazie)
+    :param exception: exception raised by API client
+    """
+    status_code = getattr(exception, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(exception, "response", None), "status_code", None)
+    if status_code == RATE_LIMIT_STATUS_CODE:
+        return True
+    message = str(exception).lower()
+    return any(pattern in message for pattern in RATE_LIMIT_MESSAGES_PATTERNS)
+
+def get_retry_after(exception: Exception) -> tp.Optional[float]:
+    """
+    Extract the server hint on how long to wait before retrying (`Retry-After` header or `retry_after` attribute)
+    :param exception: exception raised by API client
+    :return: time to wait in seconds or None if there is no hint
+    """
+    retry_after = getattr(exception, "retry_after", None)
+    if retry_after is not None:
+        return float(retry_after)
+
+    response = getattr(exception, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
 class SleepErrorHandler(BaseErrorHandler):
     def __init__(self, sleep_time: int = 5,
                  error_types: tp.List[tp.Type[Exception]] = [Exception],
@@ -57,10 +149,356 @@ class SleepErrorHandler(BaseErrorHandler):
                 
         return False
     
+    def get_sleep_time(self, exception: Exception) -> float:
+        """
+        Time to sleep after the exception
+        """
+        return self.sleep_time
+
     def handle(self, exception: Exception) -> bool:
         if self.is_error_to_be_handled(exception):
-            logger.error(f"Error {exception} occured. Sleeping for {self.sleep_time} seconds.")
-            time.sleep(self.sleep_time)
+            sleep_time = self.get_sleep_time(exception)
+            logger.error(f"Error {exception} occured. Sleeping for {sleep_time:.2f} seconds.")
+            time.sleep(sleep_time)
+            return True
+        return False
+
+    async def ahandle(self, exception: Exception) -> bool:
+        if self.is_error_to_be_handled(exception):
+            sleep_time = self.get_sleep_time(exception)
+            logger.error(f"Error {exception} occured. Sleeping for {sleep_time:.2f} seconds.")
+            await asyncio.sleep(sleep_time)
             return True
         return False
 
+class BackoffErrorHandler(SleepErrorHandler):
+    """
+    Sleeps exponentially longer after consecutive errors, with full jitter, honoring `Retry-After` hints.
+    Consecutive errors are counted per thread (per task for async code).
+    """
+    def __init__(self, base_delay: float = 1.0,
+                 max_delay: float = 60.0,
+                 multiplier: float = 2.0,
+                 reset_after: tp.Optional[float] = None,
+                 error_types: tp.List[tp.Type[Exception]] = [Exception],
+                 error_messages_patterns: tp.Optional[tp.List[tp.Optional[str]]] = None) -> None:
+        """
+        :param base_delay: upper bound of the first delay in seconds
+        :param max_delay: maximal delay in seconds (a larger `Retry-After` hint is still honored)
+        :param multiplier: growth factor of the delay bound after each consecutive error
+        :param reset_after: number of seconds without errors after which the delay bound is reset (default: 2 * max_delay)
+        :param error_types: list of error types to handle
+        :param error_messages_patterns: list of error messages patterns to handle (see SleepErrorHandler)
+        """
+        super().__init__(sleep_time=base_delay, error_types=error_types, error_messages_patterns=error_messages_patterns)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.reset_after = reset_after if reset_after is not None else 2 * max_delay
+        self._state: contextvars.ContextVar[tp.Tuple[int, float]] = contextvars.ContextVar(f"backoff_{id(self)}", default=(0, 0.0))
+
+    def get_sleep_time(self, exception: Exception) -> float:
+        n_errors, last_error_time = self._state.get()
+        now = time.monotonic()
+        if now - last_error_time > self.reset_after:
+            n_errors = 0
+        self._state.set((n_errors + 1, now))
+
+        bound = min(self.max_delay, self.base_delay * self.multiplier ** n_errors)
+        delay = random.uniform(0, bound)
+        retry_after = get_retry_after(exception)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+class TokenBucketRateLimiter(SleepErrorHandler):
+    """
+    Client-side rate limiter with requests-per-minute and tokens-per-minute budgets.
+    Share one instance between all workers: before each request it waits until both buckets have enough budget.
+    On a rate limit error it pauses all workers for the `Retry-After` hint (or `pause_time`) and empties the buckets,
+    so that the throughput recovers smoothly instead of stalling for a long fixed sleep.
+    """
+    def __init__(self, requests_per_minute: tp.Optional[float] = None,
+                 tokens_per_minute: tp.Optional[float] = None,
+                 token_counter: tp.Optional[tp.Callable[[str], int]] = None,
+                 pause_time: float = 10.0,
+                 error_types: tp.Optional[tp.List[tp.Type[Exception]]] = None,
+                 error_messages_patterns: tp.Optional[tp.List[tp.Optional[str]]] = None) -> None:
+        """
+        :param requests_per_minute: budget of requests per minute (None means unlimited)
+        :param tokens_per_minute: budget of prompt tokens per minute (None means unlimited)
+        :param token_counter: function counting tokens in the prompt (default: one token per 4 characters)
+        :param pause_time: pause after a rate limit error without `Retry-After` hint in seconds
+        :param error_types: list of rate limit error types (None means errors detected by `is_rate_limit_error`)
+        :param error_messages_patterns: list of rate limit error messages patterns (see SleepErrorHandler)
+        """
+        super().__init__(sleep_time=pause_time, error_types=error_types or [], error_messages_patterns=error_messages_patterns)
+        self.detect_rate_limits = error_types is None
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.token_counter = token_counter or (lambda prompt: len(prompt) // 4 + 1)
+
+        self._lock = threading.Lock()
+        self._last_refill = time.monotonic()
+        self._requests_level = requests_per_minute or 0.0
+        self._tokens_level = tokens_per_minute or 0.0
+        self._paused_until = 0.0
+
+    def is_error_to_be_handled(self, exception: Exception) -> bool:
+        if self.detect_rate_limits:
+            return is_rate_limit_error(exception)
+        return super().is_error_to_be_handled(exception)
+
+    def _refill(self, now: float) -> None:
+        """Refill buckets. Must be called under lock."""
+        elapsed = max(0.0, now - self._last_refill)
+        self._last_refill = max(self._last_refill, now)
+        if self.requests_per_minute is not None:
+            self._requests_level = min(self.requests_per_minute, self._requests_level + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute is not None:
+            self._tokens_level = min(self.tokens_per_minute, self._tokens_level + elapsed * self.tokens_per_minute / 60)
+
+    def reserve(self, n_tokens: int = 0) -> float:
+        """
+        Take one request and `n_tokens` tokens from the buckets (the level may become negative, i.e. borrowed from the future)
+        :param n_tokens: number of tokens of the request
+        :return: time in seconds the caller has to wait before sending the request
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # buckets are refilled only after the pause, so the deficit is waited on top of it (callers come back spaced out)
+            pause_time = max(0.0, self._paused_until - now)
+            deficit_time = 0.0
+            if self.requests_per_minute is not None:
+                self._requests_level -= 1
+                deficit_time = max(deficit_time, -self._requests_level * 60 / self.requests_per_minute)
+            if self.tokens_per_minute is not None:
+                self._tokens_level -= min(n_tokens, self.tokens_per_minute)
+                deficit_time = max(deficit_time, -self._tokens_level * 60 / self.tokens_per_minute)
+            return pause_time + deficit_time
+
+    def _count_tokens(self, *args: tp.Any, **kwargs: tp.Any) -> int:
+        if self.tokens_per_minute is None:
+            return 0
+        return sum(self.token_counter(str(arg)) for arg in (*args, *kwargs.values()))
+
+    def before_request(self, *args: tp.Any, **kwargs: tp.Any) -> None:
+        wait_time = self.reserve(self._count_tokens(*args, **kwargs))
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    async def abefore_request(self, *args: tp.Any, **kwargs: tp.Any) -> None:
+        wait_time = self.reserve(self._count_tokens(*args, **kwargs))
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+
+    def get_sleep_time(self, exception: Exception) -> float:
+        """
+        Pause all workers and return time left until the end of the pause
+        """
+        retry_after = get_retry_after(exception)
+        pause_time = retry_after if retry_after is not None else self.sleep_time
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + pause_time)
+            self._last_refill = self._paused_until
+            self._requests_level = min(self._requests_level, 0.0)
+            self._tokens_level = min(self._tokens_level, 0.0)
+            return self._paused_until - now
+
+class CircuitOpenError(Exception):
+    """Raised before the request when the circuit is open. GenerationHandler gives up the prompt without retries."""
+    pass
+
+class _CircuitState:
+    """In-process circuit state."""
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._state: tp.Dict[str, tp.Any] = {}
+
+    def update(self, func: tp.Callable[[tp.Dict[str, tp.Any]], tp.Optional[tp.Dict[str, tp.Any]]]) -> tp.Dict[str, tp.Any]:
+        """
+        Atomically apply func to the state
+        :param func: returns new state or None if the state is not changed
+        :return: resulting state
+        """
+        with self._lock:
+            new_state = func(dict(self._state))
+            if new_state is not None:
+                self._state = new_state
+            return dict(self._state)
+
+    def read(self) -> tp.Dict[str, tp.Any]:
+        """
+        Returns the state without locking (the state is replaced, never changed in place)
+        """
+        return dict(self._state)
+
+class _FileCircuitState(_CircuitState):
+    """Circuit state in a small json file shared by processes (guarded by `fcntl.flock`)."""
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self.path = path
+        self._file_stamp: tp.Optional[tp.Tuple[int, ...]] = None  # stamp of the file the cached state was read from
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+
+    @staticmethod
+    def _get_stamp(st: os.stat_result) -> tp.Tuple[int, ...]:
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def update(self, func: tp.Callable[[tp.Dict[str, tp.Any]], tp.Optional[tp.Dict[str, tp.Any]]]) -> tp.Dict[str, tp.Any]:
+        import fcntl
+        with self._lock, open(self.path, "a+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                try:
+                    state = json.loads(content) if content else {}
+                except ValueError:
+                    logger.warning(f"Circuit state file {self.path!r} is corrupted, resetting it")
+                    state = {}
+                new_state = func(dict(state))
+                if new_state is not None:
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(new_state))
+                    f.flush()
+                    state = new_state
+                self._state, self._file_stamp = state, self._get_stamp(os.fstat(f.fileno()))
+                return dict(state)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read(self) -> tp.Dict[str, tp.Any]:
+        """
+        Returns cached state, the file is read again (under the lock) only if another process changed it
+        """
+        try:
+            stamp = self._get_stamp(os.stat(self.path))
+        except FileNotFoundError:
+            stamp = None
+        if stamp is None or stamp != self._file_stamp:
+            return self.update(lambda state: None)
+        return super().read()
+
+class CircuitBreakerErrorHandler(BaseErrorHandler):
+    """
+    Circuit breaker: after `failure_threshold` consecutive errors the circuit opens and requests fail fast
+    (GenerationHandler gives up the prompt instead of burning its attempts). After `recovery_time` one probe request
+    is let through (half-open state): its success closes the circuit, its failure opens it again.
+    The state is shared by all threads using the instance, and by all processes using the same `state_file`
+    (it is cached, the file is locked only to change the state or to read it again after another process changed it).
+    The handler only observes results of requests, so put it together with a retrying handler (e.g. BackoffErrorHandler).
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 5,
+                 recovery_time: float = 30.0,
+                 probe_timeout: tp.Optional[float] = None,
+                 state_file: tp.Optional[str] = None,
+                 error_types: tp.List[tp.Type[Exception]] = [Exception],
+                 error_messages_patterns: tp.Optional[tp.List[tp.Optional[str]]] = None) -> None:
+        """
+        :param failure_threshold: number of consecutive errors opening the circuit
+        :param recovery_time: time in seconds after which the open circuit lets a probe request through
+        :param probe_timeout: time in seconds after which a probe without result is considered lost and a new one is let through
+            (default: recovery_time)
+        :param state_file: json file to share the state between processes (None means the state is kept in memory)
+        :param error_types: list of error types counted as failures
+        :param error_messages_patterns: list of error messages patterns counted as failures (see SleepErrorHandler)
+        """
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.probe_timeout = probe_timeout if probe_timeout is not None else recovery_time
+        self.state_file = state_file
+        self._failure_matcher = SleepErrorHandler(error_types=error_types, error_messages_patterns=error_messages_patterns)
+        self._state = _FileCircuitState(state_file) if state_file is not None else _CircuitState()
+
+    def is_error_to_be_handled(self, exception: Exception) -> bool:
+        """
+        Errors are only counted (see `after_request`), never handled
+        """
+        return False
+
+    def handle(self, exception: Exception) -> bool:
+        return False
+
+    @property
+    def state(self) -> str:
+        """Current state: "closed", "open" or "half_open"."""
+        return self._state.read().get("state", self.CLOSED)
+
+    def _is_closed(self) -> bool:
+        """
+        Whether the circuit is closed without errors, read without locking (nothing to change before and after a request)
+        """
+        state = self._state.read()
+        return state.get("state", self.CLOSED) == self.CLOSED and not state.get("n_failures")
+
+    def before_request(self, *args: tp.Any, **kwargs: tp.Any) -> None:
+        """
+        Raise CircuitOpenError if the circuit is open (or half-open with a probe in flight)
+        """
+        if self._state.read().get("state", self.CLOSED) == self.CLOSED:
+            return
+        is_allowed = True
+
+        def transition(state: tp.Dict[str, tp.Any]) -> tp.Optional[tp.Dict[str, tp.Any]]:
+            nonlocal is_allowed
+            circuit_state = state.get("state", self.CLOSED)
+            if circuit_state == self.CLOSED:
+                return None
+            now = time.time()
+            if circuit_state == self.OPEN and now - state["opened_at"] < self.recovery_time:
+                is_allowed = False
+                return None
+            if circuit_state == self.HALF_OPEN and now - state["probe_started_at"] < self.probe_timeout:
+                is_allowed = False
+                return None
+            logger.info("Circuit is half-open, sending probe request")
+            return {**state, "state": self.HALF_OPEN, "probe_started_at": now}
+
+        state = self._state.update(transition)
+        if not is_allowed:
+            retry_in = max(0.0, state.get("opened_at", 0.0) + self.recovery_time - time.time())
+            raise CircuitOpenError(f"Circuit is {state['state']} after {state.get('n_failures')} consecutive errors, "
+                                   f"next probe in {retry_in:.1f} seconds")
+
+    def after_request(self, exception: tp.Optional[Exception] = None) -> None:
+        """
+        Count consecutive errors, close the circuit after a successful request
+        """
+        if exception is None:
+            if not self._is_closed():
+                self._state.update(self._on_success)
+        elif not isinstance(exception, CircuitOpenError) and self._failure_matcher.is_error_to_be_handled(exception):
+            self._state.update(self._on_failure)
+
+    async def abefore_request(self, *args: tp.Any, **kwargs: tp.Any) -> None:
+        """
+        Closed circuit is checked on the event loop, state transitions (file lock) run in a thread
+        """
+        if self._state.read().get("state", self.CLOSED) != self.CLOSED:
+            await asyncio.to_thread(self.before_request, *args, **kwargs)
+
+    async def aafter_request(self, exception: tp.Optional[Exception] = None) -> None:
+        if exception is not None or not self._is_closed():
+            await asyncio.to_thread(self.after_request, exception)
+
+    def _on_success(self, state: tp.Dict[str, tp.Any]) -> tp.Optional[tp.Dict[str, tp.Any]]:
+        if state.get("state", self.CLOSED) == self.CLOSED and not state.get("n_failures"):
+            return None  # nothing to change, the state is not written
+        if state.get("state") != self.CLOSED:
+            logger.info("Circuit is closed")
+        return {"state": self.CLOSED, "n_failures": 0}
+
+    def _on_failure(self, state: tp.Dict[str, tp.Any]) -> tp.Dict[str, tp.Any]:
+        n_failures = state.get("n_failures", 0) + 1
+        circuit_state = state.get("state", self.CLOSED)
+        if circuit_state == self.HALF_OPEN or (circuit_state == self.CLOSED and n_failures >= self.failure_threshold):
+            logger.error(f"Circuit is open after {n_failures} consecutive errors, failing fast for {self.recovery_time} seconds")
+            return {"state": self.OPEN, "n_failures": n_failures, "opened_at": time.time()}
+        return {**state, "state": circuit_state, "n_failures": n_failures}
@@ -1,13 +1,7 @@
 import typing as tp
-from grazie.api.client.chat.prompt import ChatPrompt
-from grazie.api.client.endpoints import GrazieApiGatewayUrls
-from grazie.api.client.gateway import AuthType, GrazieAgent, GrazieApiGatewayClient, RequestFailedException
-from grazie.api.client.llm_parameters import LLMParameters
-from grazie.api.client.parameters import Parameters
-from grazie.api.client.profiles import Profile
 
-from ..prompter import Prompt
-from .error_handlers import SleepErrorHandler
+from ..clients import get_shared_client
+from .error_handlers import BackoffErrorHandler
 
 class GrazieApi:
     """Grazie API handler."""
@@ -23,20 +17,36 @@ class GrazieApi:
         :@param iamtoken: Grazie API token.
         :@param model: Name of model to use.
         :@param supports_system: Whether the model supports system messages.
+        Instances with the same token share one gateway client (see `src.api.clients`).
         """
-        self.client = GrazieApiGatewayClient(
-            grazie_agent=GrazieAgent(name="Rodion.Khvorostov", version="dev"),
-            url=GrazieApiGatewayUrls.STAGING,
-            auth_type=AuthType.USER,
-            grazie_jwt_token=iamtoken
+        from grazie.api.client.endpoints import GrazieApiGatewayUrls
+        from grazie.api.client.gateway import AuthType, GrazieAgent, GrazieApiGatewayClient
+
+        self.client = get_shared_client(
+            "grazie", GrazieApiGatewayUrls.STAGING, iamtoken,
+            factory=lambda: GrazieApiGatewayClient(
+                grazie_agent=GrazieAgent(name="Rodion.Khvorostov", version="dev"),
+                url=GrazieApiGatewayUrls.STAGING,
+                auth_type=AuthType.USER,
+                grazie_jwt_token=iamtoken
+            )
         )
         self.model = model
         self.supports_system = model in self.MODELS_SUPPORTING_SYSTEM
 
-    def __call__(self, prompt: Prompt) -> str:
-        """Returns generated text."""
-        if self.supports_system:
-            chat=ChatPrompt().add_system(prompt.system).add_user(prompt.get_prompt())
+    def __call__(self, prompt: tp.Any) -> str:
+        """Returns generated text.
+        :@param prompt: text (e.g. rendered by TemplatePrompter), or prompt with `system` and `get_prompt()` parts;
+            the system part is sent as a system message if the model supports them.
+        """
+        from grazie.api.client.chat.prompt import ChatPrompt
+        from grazie.api.client.llm_parameters import LLMParameters
+        from grazie.api.client.parameters import Parameters
+        from grazie.api.client.profiles import Profile
+
+        system = getattr(prompt, "system", None)
+        if self.supports_system and system is not None:
+            chat=ChatPrompt().add_system(system).add_user(prompt.get_prompt())
         else:
             chat=ChatPrompt().add_user(str(prompt))
         
@@ -50,7 +60,12 @@ class GrazieApi:
 
         return res.content
     
-def get_too_many_requests_error_handler(sleep_time: int = 600) -> tp.Callable[[Exception], bool]:
+def get_too_many_requests_error_handler(sleep_time: int = 600) -> BackoffErrorHandler:
+    """
+    Returns handler which retries "Too many requests" errors with exponential backoff
+    :param sleep_time: maximal time to sleep in seconds
+    """
+    from grazie.api.client.gateway import RequestFailedException
     error_types = [RequestFailedException]
     error_messages_patterns = ["Too many requests"]
-    return SleepErrorHandler(sleep_time=sleep_time, error_types=error_types, error_messages_patterns=error_messages_patterns)
+    return BackoffErrorHandler(max_delay=sleep_time, error_types=error_types, error_messages_patterns=error_messages_patterns)
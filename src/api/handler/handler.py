@@ -1,25 +1,86 @@
-# SETUP
-import os
-import sys
-import logging
-logging.basicConfig(level=logging.INFO)
-
-root_dir = os.path.abspath(os.path.join(__file__, '../../../..'))
-sys.path.append(root_dir)
-logging.info(f"Added {root_dir!r} to PYTHONPATH")
-
-# IMPORTS
+import asyncio
+import threading
+import time
 import typing as tp
 import logging
+from concurrent.futures import Future
+from contextlib import nullcontext
 
-from src.loggers import get_colorful_logger, get_file_logger
+from src.loggers import get_colorful_logger, get_file_logger, RateLimitFilter
+from src.helpers import deduplicate, ordered_async_map, ordered_thread_map, unordered_async_map, unordered_thread_map
+from src.metrics import MetricsRegistry
+from src.json_backends import get_json_backend
 
-from .error_handlers import BaseErrorHandler
+from ..cache import ResponseCache, make_cache_key
+from ..structured import build_output
+from .error_handlers import BaseErrorHandler, CircuitOpenError
 from .response_processors import BaseResponseProcessor
-from .response_validators import BaseResponseValidator
+from .response_validators import BaseResponseValidator, NOT_PARSED
+
+# records are written by background threads, repeated errors are rate limited in the console, the file is rotated at 50 MB
+logger = get_colorful_logger(__name__, level=logging.INFO, queued=True, rate_limit=RateLimitFilter(max_records=20, period=60.0))
+file_logger = get_file_logger('invalid_responses', level=logging.DEBUG, queued=True, max_bytes=50 * 2 ** 20)
+
+
+class StreamTiming(tp.NamedTuple):
+    """Timing of one streamed request"""
+    time_to_first_token: tp.Optional[float]  # seconds, None if nothing was received
+    total_latency: float  # seconds
+    n_chunks: int
+    aborted: bool  # whether generation was aborted by early validation
+
+
+class GenerationMetrics:
+    """
+    Metrics of GenerationHandler in a MetricsRegistry:
+      - generation_stage_seconds{stage}: cache lookup, before_request (rate limiter waits), request, error_handling
+        (retry sleeps), processing, validation and total time of `generate`
+      - generation_attempts_total{outcome}: attempts by outcome (valid, invalid, error, aborted)
+      - generation_errors_total{error_type}: errors of requests by exception class
+      - generation_requests_total{result}: calls of `generate` by result (generated, cached, failed)
+      - generation_tokens_total{kind}: prompt and completion tokens reported by the API (generator's `pop_usage`)
+      - generation_time_to_first_token_seconds: of streamed requests
+      - generation_saved_calls_total{reason}: requests not sent for duplicate prompts (single_flight, deduplicated)
+    An observation takes about a microsecond (see benchmarks/metrics_overhead.py), so metrics can be left on.
+    """
+    def __init__(self, registry: tp.Optional[MetricsRegistry] = None) -> None:
+        """
+        :param registry: registry to export metrics to (default: a new one)
+        """
+        self.registry = registry or MetricsRegistry()
+        self.stage_seconds = self.registry.histogram("generation_stage_seconds", "Time spent in each stage of generation", ["stage"])
+        self.attempts = self.registry.counter("generation_attempts_total", "Attempts by outcome", ["outcome"])
+        self.errors = self.registry.counter("generation_errors_total", "Errors of requests by type", ["error_type"])
+        self.requests = self.registry.counter("generation_requests_total", "Generations by result", ["result"])
+        self.tokens = self.registry.counter("generation_tokens_total", "Tokens reported by the API", ["kind"])
+        self.time_to_first_token = self.registry.histogram("generation_time_to_first_token_seconds",
+                                                           "Time to first token of streamed requests")
+        self.saved_calls = self.registry.counter("generation_saved_calls_total", "Requests saved on duplicate prompts", ["reason"])
+        self._start = time.perf_counter()
 
-logger = get_colorful_logger(__name__, level=logging.INFO)
-file_logger = get_file_logger('invalid_responses', level=logging.DEBUG)
+    def observe_usage(self, generator: tp.Any) -> None:
+        """Counts tokens of the last request if generator reports them (e.g. OpenAIApi.pop_usage)."""
+        pop_usage = getattr(generator, "pop_usage", None)
+        usage = pop_usage() if pop_usage is not None else None
+        if usage:
+            self.tokens.inc("prompt", value=usage.get("prompt_tokens") or 0)
+            self.tokens.inc("completion", value=usage.get("completion_tokens") or 0)
+
+    def summary(self) -> tp.Dict[str, tp.Any]:
+        """
+        Returns json serializable summary: all metrics plus wall time and throughput since creation
+        """
+        wall_time = time.perf_counter() - self._start
+        n_requests = sum(self.requests.summary().values())
+        return {
+            **self.registry.summary(),
+            "wall_time_seconds": wall_time,
+            "requests_per_second": n_requests / wall_time if wall_time > 0 else 0.0,
+        }
+
+    def to_prometheus(self) -> str:
+        """Returns metrics in Prometheus text exposition format."""
+        return self.registry.to_prometheus()
 
 
 class GenerationHandler:
@@ -31,19 +92,47 @@ class GenerationHandler:
                  n_attempts: int = 1,
                  error_handlers: tp.Optional[tp.List[BaseErrorHandler]] = None,
                  response_processors: tp.Optional[tp.List[BaseResponseProcessor]] = None,
-                 response_validators: tp.Optional[tp.List[BaseResponseValidator]] = None) -> None:
+                 response_validators: tp.Optional[tp.List[BaseResponseValidator]] = None,
+                 cache: tp.Optional[ResponseCache] = None,
+                 stream_check_chars: int = 64,
+                 timing_callback: tp.Optional[tp.Callable[[StreamTiming], None]] = None,
+                 metrics: tp.Optional[GenerationMetrics] = None,
+                 structured: bool = False,
+                 output_type: tp.Optional[tp.Callable[..., tp.Any]] = None,
+                 single_flight: bool = False) -> None:
         """
         :param generator: function to generate response
+            (`generate_stream` needs its `stream` method yielding chunks of response, e.g. OpenAIApi)
         :param n_attempts: number of attempts to generate response
         :param error_handlers: list of error handlers
         :param response_processors: list of response processors
         :param response_validators: list of response validators
+        :param cache: cache of valid responses (only responses passed validation are stored)
+        :param stream_check_chars: streamed response is validated each time this number of characters is received
+        :param timing_callback: called with StreamTiming of each streamed request
+        :param metrics: where to record stage latencies, attempts, errors and token usage (None means no metrics)
+        :param structured: whether to return objects parsed by validators (e.g. JsonResponseValidator) instead of text
+        :param output_type: class built from parsed json objects in structured mode with `output_type(**obj)`
+            (e.g. dataclass or `src.api.structured.make_record_class(schema)`), implies `structured`
+            - if None, parsed json is returned as is
+        :param single_flight: whether identical prompts in flight at the same time share one request and its result
+            (the same object in structured mode), saved requests are counted in `n_saved_calls`
         """
         self.generator = generator
         self.n_attempts = n_attempts
         self.error_handlers = error_handlers or []
         self.response_processors = response_processors or []
         self.response_validators = response_validators or []
+        self.cache = cache
+        self.stream_check_chars = stream_check_chars
+        self.timing_callback = timing_callback
+        self.metrics = metrics
+        self.structured = structured or output_type is not None
+        self.output_type = output_type
+        self.single_flight = single_flight
+        self.n_saved_calls = 0  # requests not sent thanks to single flight and deduplication
+        self._flights: tp.Dict[tp.Hashable, tp.Any] = {}  # key of prompt in flight -> future of its result
+        self._flights_lock = threading.Lock()
 
     def _report_gen_error(self, response: str | None, description: str) -> None:
         """
@@ -52,11 +141,25 @@ class GenerationHandler:
         :param description: description of error
         """
         logger.error(description)
-        file_logger.error(description)
-        
-        if response is not None:
+        if response is None:
+            file_logger.error(description)
+        else:
             sep = "\n" + "-" * 20 + "\n"
-            file_logger.info(f"Response:\n\n{response}{sep}")
+            file_logger.error(f"{description}\nResponse:\n\n{response}{sep}")
+
+    def check_response(self, response: str, parsed: tp.Any = NOT_PARSED) -> tp.Tuple[bool, tp.Any]:
+        """
+        Check if response is valid, the object parsed by a validator (e.g. json) is passed to the next ones
+        :param response: response to check
+        :param parsed: object already parsed from response (e.g. an item of a packed response), NOT_PARSED if none
+        :return: whether response is valid and the parsed object (NOT_PARSED if no validator parsed it)
+        """
+        for response_validator in self.response_validators:
+            is_valid, parsed = response_validator.validate(response, parsed)
+            if not is_valid:
+                self._report_gen_error(response, f"Validator {response_validator.__class__.__name__} failed")
+                return False, parsed
+        return True, parsed
 
     def is_response_valid(self, response: str) -> bool:
         """
@@ -64,12 +167,49 @@ class GenerationHandler:
         :param response: response to check
         :return: True if response is valid, False otherwise
         """
+        return self.check_response(response)[0]
+    
+    def is_partial_response_valid(self, response: str) -> bool:
+        """
+        Check if received part of streamed response can still become valid
+        :param response: received part of response (not processed)
+        :return: False if generation should be aborted, True otherwise
+        """
+        for response_processor in self.response_processors:
+            response = response_processor.process_partial(response)
         for response_validator in self.response_validators:
-            if not response_validator.is_response_valid(response):
-                self._report_gen_error(response, f"Validator {response_validator.__class__.__name__} failed")
+            if not response_validator.is_partial_response_valid(response):
+                self._report_gen_error(response, f"Validator {response_validator.__class__.__name__} aborted streamed response")
                 return False
         return True
-    
+
+    def check_result(self, response: str, parsed: tp.Any = NOT_PARSED) -> tp.Tuple[bool, tp.Any]:
+        """
+        Check if response is valid and build the result: response itself or, in structured mode, the parsed object
+        :param response: processed response
+        :param parsed: object already parsed from response, NOT_PARSED if none
+        :return: whether response is valid and the result
+        """
+        is_valid, parsed = self.check_response(response, parsed)
+        if not is_valid or not self.structured:
+            return is_valid, response
+        try:
+            if parsed is NOT_PARSED:
+                parsed = get_json_backend().loads(response)
+            return True, build_output(self.output_type, parsed)
+        except Exception as e:
+            self._report_gen_error(response, f"Could not build structured result: {e}")
+            return False, None
+
+    def _cached_result(self, cached: str) -> tp.Any:
+        """
+        Returns result of cached response (None if it doesn't pass validation anymore, e.g. the schema has changed)
+        """
+        if not self.structured:
+            return cached
+        is_valid, result = self.check_result(cached)
+        return result if is_valid else None
+
     def process_response(self, response: str) -> str:
         """
         Process response
@@ -92,24 +232,627 @@ class GenerationHandler:
                 return error_handler.handle(exception)
         return False
 
-    def generate(self, *args, **kwargs) -> tp.Optional[str]:
+    def _get_cached(self, *args, **kwargs) -> tp.Tuple[tp.Optional[str], tp.Optional[str]]:
         """
-        Generate response
-        :return: response or None if could not generate response
+        Look up response in cache
+        :return: cache key (None if there is no cache) and cached response (None if missing)
+        """
+        if self.cache is None:
+            return None, None
+        key = make_cache_key(self.generator, *args, **kwargs)
+        return key, self.cache.get(key)
+
+    def _store_cached(self, key: tp.Optional[str], response: str) -> None:
+        """
+        Store valid response in cache
+        """
+        if key is not None:
+            self.cache.set(key, response)
+
+    def before_request(self, *args, **kwargs) -> None:
+        """
+        Let error handlers prepare for the request (e.g. wait for rate limiter budget)
+        """
+        for error_handler in self.error_handlers:
+            error_handler.before_request(*args, **kwargs)
+
+    def after_request(self, exception: tp.Optional[Exception] = None) -> None:
+        """
+        Let error handlers observe the result of the request (e.g. circuit breaker)
+        :param exception: error raised by the request (None if response was received)
         """
+        for error_handler in self.error_handlers:
+            error_handler.after_request(exception)
+
+    def _timed(self, stage: str) -> tp.ContextManager[None]:
+        """
+        Measure time of the block as the stage (no-op without metrics)
+        """
+        return self.metrics.stage_seconds.time(stage) if self.metrics is not None else nullcontext()
+
+    def _count_attempt(self, outcome: str, exception: tp.Optional[Exception] = None) -> None:
+        if self.metrics is not None:
+            self.metrics.attempts.inc(outcome)
+            if exception is not None:
+                self.metrics.errors.inc(type(exception).__name__)
+
+    def _count_request(self, result: str, start: float) -> None:
+        if self.metrics is not None:
+            self.metrics.requests.inc(result)
+            self.metrics.stage_seconds.observe(time.perf_counter() - start, "total")
+
+    def _count_saved(self, reason: str, n_calls: int = 1) -> None:
+        with self._flights_lock:
+            self.n_saved_calls += n_calls
+        if self.metrics is not None:
+            self.metrics.saved_calls.inc(reason, value=n_calls)
+
+    def _flight_key(self, args: tp.Tuple, kwargs: tp.Dict[str, tp.Any]) -> tp.Hashable:
+        """
+        Returns key identifying the request: the arguments themselves if hashable (e.g. rendered prompt),
+        otherwise their digest (e.g. for lists of chat messages)
+        """
+        key = (args, tuple(sorted(kwargs.items()))) if kwargs else args
+        try:
+            hash(key)
+        except TypeError:
+            return make_cache_key(self.generator, *args, **kwargs)
+        return key
+
+    def _deduplicate(self, prompts: tp.Iterable[tp.Any]) -> tp.Tuple[tp.List[tp.Any], tp.List[int]]:
+        """
+        Returns unique prompts and index of the unique prompt for each prompt, duplicates are counted as saved calls
+        """
+        unique_prompts, inverse = deduplicate(prompts, key=lambda prompt: self._flight_key((prompt,), {}))
+        n_duplicates = len(inverse) - len(unique_prompts)
+        if n_duplicates:
+            logger.info(f"{n_duplicates} of {len(inverse)} prompts are duplicates, each unique prompt is generated once")
+            self._count_saved("deduplicated", n_duplicates)
+        return unique_prompts, inverse
+
+    def _report_timing(self, timing: StreamTiming) -> None:
+        """
+        Report timing of streamed request
+        """
+        logger.debug(f"Time to first token: {timing.time_to_first_token}, total latency: {timing.total_latency:.3f}s, "
+                     f"chunks: {timing.n_chunks}, aborted: {timing.aborted}")
+        if self.metrics is not None and timing.time_to_first_token is not None:
+            self.metrics.time_to_first_token.observe(timing.time_to_first_token)
+        if self.timing_callback is not None:
+            self.timing_callback(timing)
+
+    def _receive_stream(self, *args, **kwargs) -> tp.Optional[str]:
+        """
+        Receive streamed response, validating it on the fly
+        :return: response or None if generation was aborted
+        """
+        start = time.perf_counter()
+        time_to_first_token = None
+        chunks = []
+        n_chars = n_checked_chars = 0
+        aborted = False
+        stream = self.generator.stream(*args, **kwargs)
+        try:
+            for chunk in stream:
+                if time_to_first_token is None:
+                    time_to_first_token = time.perf_counter() - start
+                chunks.append(chunk)
+                n_chars += len(chunk)
+                if n_chars - n_checked_chars >= self.stream_check_chars:
+                    n_checked_chars = n_chars
+                    if not self.is_partial_response_valid("".join(chunks)):
+                        aborted = True
+                        break
+        finally:
+            stream.close()
+        self._report_timing(StreamTiming(time_to_first_token, time.perf_counter() - start, len(chunks), aborted))
+        return None if aborted else "".join(chunks)
+
+    def _generate(self, request: tp.Callable[..., tp.Optional[str]], *args, **kwargs) -> tp.Optional[tp.Any]:
+        """
+        Generate response with retries
+        :param request: function returning raw response (None means the attempt is failed)
+        :return: response (parsed object in structured mode) or None if could not generate response
+        """
+        start = time.perf_counter()
+        with self._timed("cache"):
+            cache_key, cached = self._get_cached(*args, **kwargs)
+            result = self._cached_result(cached) if cached is not None else None
+        if result is not None:
+            self._count_request("cached", start)
+            return result
+
         for attempt_id in range(self.n_attempts):
             try:
-                response = self.generator(*args, **kwargs)
+                with self._timed("before_request"):
+                    self.before_request(*args, **kwargs)
+                with self._timed("request"):
+                    response = request(*args, **kwargs)
+            except CircuitOpenError as e:
+                self._report_gen_error(response=None, description=f"Failing fast during attempt {attempt_id}: {e}")
+                self._count_attempt("error", e)
+                self._count_request("failed", start)
+                return None
             except Exception as e:
-                if not self.handle_error(e):
+                self._count_attempt("error", e)
+                self.after_request(e)
+                with self._timed("error_handling"):
+                    is_handled = self.handle_error(e)
+                if not is_handled:
                     msg = f"Unhandled error occurred during attempt {attempt_id}: {e}"
                     self._report_gen_error(response=None, description=msg)
                 continue
-            
-            response = self.process_response(response)
-            if self.is_response_valid(response):
-                return response
+            self.after_request()
+            if response is None:
+                self._count_attempt("aborted")
+                continue
+
+            if self.metrics is not None:
+                self.metrics.observe_usage(self.generator)
+            with self._timed("processing"):
+                response = self.process_response(response)
+            with self._timed("validation"):
+                is_valid, result = self.check_result(response)
+            if is_valid:
+                self._count_attempt("valid")
+                self._store_cached(cache_key, response)
+                self._count_request("generated", start)
+                return result
+            self._count_attempt("invalid")
         
         logger.error(f"Could not generate response after {self.n_attempts} attempts")
+        self._count_request("failed", start)
         
         return None
+
+    def _single_flight(self, request: tp.Callable[..., tp.Optional[str]], *args, **kwargs) -> tp.Optional[tp.Any]:
+        """
+        Generate response, calls with the same arguments made while it is in flight wait for it and share its result
+        (without `single_flight` it is just `_generate`)
+        """
+        if not self.single_flight:
+            return self._generate(request, *args, **kwargs)
+        key = self._flight_key(args, kwargs)
+        with self._flights_lock:
+            future = self._flights.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._flights[key] = Future()
+        if not is_leader:
+            self._count_saved("single_flight")
+            return future.result()
+
+        try:
+            result = self._generate(request, *args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+        return result
+
+    def generate(self, *args, **kwargs) -> tp.Optional[tp.Any]:
+        """
+        Generate response
+        :return: response (parsed object in structured mode) or None if could not generate response
+        """
+        return self._single_flight(self.generator, *args, **kwargs)
+
+    def generate_stream(self, *args, **kwargs) -> tp.Optional[tp.Any]:
+        """
+        Generate response in streaming mode: the received part of response is checked by validators
+        (`is_partial_response_valid`) every `stream_check_chars` characters, clearly broken responses are aborted
+        and retried without waiting for the full output. Timing of each request goes to `timing_callback`
+        :return: response (parsed object in structured mode) or None if could not generate response
+        """
+        return self._single_flight(self._receive_stream, *args, **kwargs)
+
+    def iter_generate(self, prompts: tp.Iterable[tp.Any], max_concurrency: int = 1,
+                      stream: bool = False) -> tp.Iterator[tp.Optional[tp.Any]]:
+        """
+        Lazily generate responses for many prompts, keeping up to `max_concurrency` requests in flight
+        Each prompt goes through the same pipeline as `generate` (error handlers, processors and validators)
+        :param prompts: prompts, each is passed to `generate` as the only positional argument;
+            None prompts (skipped by the prompter, e.g. `BudgetedPrompter`) are not sent and get None
+        :param max_concurrency: maximal number of simultaneous requests
+        :param stream: whether to use `generate_stream`
+        :return: iterator over responses (None for failed and skipped ones) in the order of prompts
+        """
+        return ordered_thread_map(self._prompt_generator(stream), prompts, max_concurrency=max_concurrency)
+
+    def iter_generate_unordered(self, prompts: tp.Iterable[tp.Any], max_concurrency: int = 1,
+                                stream: bool = False) -> tp.Iterator[tp.Tuple[int, tp.Optional[tp.Any]]]:
+        """
+        Lazily generate responses for many prompts in completion order (see `iter_generate`):
+        a slow prompt (e.g. waiting for a rate limit) doesn't delay responses to the next ones
+        :param prompts: prompts, None prompts are not sent and get None
+        :param max_concurrency: maximal number of simultaneous requests
+        :param stream: whether to use `generate_stream`
+        :return: iterator over positions of prompts in `prompts` and their responses (None for failed and skipped ones)
+        """
+        return unordered_thread_map(self._prompt_generator(stream), prompts, max_concurrency=max_concurrency)
+
+    def _prompt_generator(self, stream: bool) -> tp.Callable[[tp.Any], tp.Optional[tp.Any]]:
+        """
+        Returns function generating response for one prompt, None prompts (skipped by the prompter) are not sent
+        """
+        request = self.generate_stream if stream else self.generate
+
+        def generate(prompt: tp.Any) -> tp.Optional[tp.Any]:
+            return None if prompt is None else request(prompt)
+
+        return generate
+
+    def generate_many(self, prompts: tp.Iterable[tp.Any], max_concurrency: int = 1,
+                      stream: bool = False, deduplicate: bool = False) -> tp.List[tp.Optional[tp.Any]]:
+        """
+        Generate responses for many prompts concurrently
+        :param prompts: prompts, each is passed to `generate` as the only positional argument
+        :param max_concurrency: maximal number of simultaneous requests
+        :param stream: whether to use `generate_stream`
+        :param deduplicate: whether to generate each unique prompt once and give its result to all its duplicates
+        :return: responses (None for failed ones) in the order of prompts
+        """
+        if deduplicate:
+            unique_prompts, inverse = self._deduplicate(prompts)
+            responses = self.generate_many(unique_prompts, max_concurrency=max_concurrency, stream=stream)
+            return [responses[i] for i in inverse]
+        return list(self.iter_generate(prompts, max_concurrency=max_concurrency, stream=stream))
+
+    def generate_batch(self, prompts: tp.Sequence[tp.Any], retry_failed: bool = True, max_concurrency: int = 1,
+                       deduplicate: bool = False, **batch_kwargs) -> tp.List[tp.Optional[tp.Any]]:
+        """
+        Generate responses for all prompts with one batch request (generator must have `generate_batch`, e.g. OpenAIApi)
+        Cached prompts are not sent. Responses go through the same processors and validators as in `generate`,
+        invalid and failed ones are regenerated one by one with `generate` if `retry_failed`
+        :param prompts: prompts, None prompts (skipped by the prompter) are not sent and get None
+        :param retry_failed: whether to regenerate invalid and failed responses with regular requests
+        :param max_concurrency: maximal number of simultaneous regular requests when retrying
+        :param deduplicate: whether to send each unique prompt once and give its result to all its duplicates
+        :param batch_kwargs: arguments of the generator's `generate_batch` (e.g. batch_file, poll_interval)
+        :return: responses (None for failed ones) in the order of prompts
+        """
+        if deduplicate:
+            unique_prompts, inverse = self._deduplicate(prompts)
+            responses = self.generate_batch(unique_prompts, retry_failed=retry_failed, max_concurrency=max_concurrency,
+                                            **batch_kwargs)
+            return [responses[i] for i in inverse]
+        responses, failed_ids = self._send_batch(prompts, **batch_kwargs)
+        if failed_ids and retry_failed:
+            logger.info(f"Regenerating {len(failed_ids)} failed responses of the batch one by one")
+            regenerated = self.iter_generate((prompts[prompt_id] for prompt_id in failed_ids), max_concurrency=max_concurrency)
+            for prompt_id, response in zip(failed_ids, regenerated):
+                responses[prompt_id] = response
+
+        return responses
+
+    def _send_batch(self, prompts: tp.Sequence[tp.Any], **batch_kwargs) -> tp.Tuple[tp.List[tp.Optional[tp.Any]], tp.List[int]]:
+        """
+        Send prompts missing in the cache with one batch request (blocks until the batch is finished)
+        :return: responses (None for failed ones) in the order of prompts and ids of failed prompts
+        """
+        responses: tp.List[tp.Any] = [None] * len(prompts)
+        cache_keys: tp.List[tp.Optional[str]] = [None] * len(prompts)
+        ids_to_send = []
+        for prompt_id, prompt in enumerate(prompts):
+            if prompt is None:
+                continue
+            cache_keys[prompt_id], cached = self._get_cached(prompt)
+            responses[prompt_id] = self._cached_result(cached) if cached is not None else None
+            if responses[prompt_id] is None:
+                ids_to_send.append(prompt_id)
+
+        failed_ids = []
+        if ids_to_send:
+            raw_responses = self.generator.generate_batch([prompts[prompt_id] for prompt_id in ids_to_send], **batch_kwargs)
+            for prompt_id, response in zip(ids_to_send, raw_responses):
+                if response is None:
+                    self._report_gen_error(response=None, description=f"Batch request for prompt {prompt_id} failed")
+                    failed_ids.append(prompt_id)
+                    continue
+                response = self.process_response(response)
+                is_valid, result = self.check_result(response)
+                if is_valid:
+                    self._store_cached(cache_keys[prompt_id], response)
+                    responses[prompt_id] = result
+                else:
+                    failed_ids.append(prompt_id)
+        return responses, failed_ids
+
+
+def _is_cancelling() -> bool:
+    """
+    Whether the current task itself is being cancelled (before Python 3.11 it can't be told, so it is assumed not)
+    """
+    cancelling = getattr(asyncio.current_task(), "cancelling", None)
+    return cancelling is not None and cancelling() > 0
+
+
+class AsyncGenerationHandler(GenerationHandler):
+    """
+    Async version of GenerationHandler: generator is a coroutine function (e.g. AsyncOpenAIApi),
+    error handlers are awaited via `ahandle`. Processors and validators are the same as in GenerationHandler
+    """
+    def __init__(self,
+                 generator: tp.Callable[..., tp.Awaitable[str]],
+                 n_attempts: int = 1,
+                 error_handlers: tp.Optional[tp.List[BaseErrorHandler]] = None,
+                 response_processors: tp.Optional[tp.List[BaseResponseProcessor]] = None,
+                 response_validators: tp.Optional[tp.List[BaseResponseValidator]] = None,
+                 cache: tp.Optional[ResponseCache] = None,
+                 stream_check_chars: int = 64,
+                 timing_callback: tp.Optional[tp.Callable[[StreamTiming], None]] = None,
+                 metrics: tp.Optional[GenerationMetrics] = None,
+                 structured: bool = False,
+                 output_type: tp.Optional[tp.Callable[..., tp.Any]] = None,
+                 single_flight: bool = False) -> None:
+        """
+        :param generator: coroutine function to generate response
+            (`generate_stream` needs its `stream` method returning async iterator over chunks, e.g. AsyncOpenAIApi)
+        :param n_attempts: number of attempts to generate response
+        :param error_handlers: list of error handlers
+        :param response_processors: list of response processors
+        :param response_validators: list of response validators
+        :param cache: cache of valid responses (only responses passed validation are stored)
+        :param stream_check_chars: streamed response is validated each time this number of characters is received
+        :param timing_callback: called with StreamTiming of each streamed request
+        :param metrics: where to record stage latencies, attempts, errors and token usage (None means no metrics)
+        :param structured: whether to return objects parsed by validators (e.g. JsonResponseValidator) instead of text
+        :param output_type: class built from parsed json objects in structured mode with `output_type(**obj)`
+            (e.g. dataclass or `src.api.structured.make_record_class(schema)`), implies `structured`
+            - if None, parsed json is returned as is
+        :param single_flight: whether identical prompts in flight at the same time share one request and its result
+            (the same object in structured mode), saved requests are counted in `n_saved_calls`
+        """
+        super().__init__(generator=generator,
+                         n_attempts=n_attempts,
+                         error_handlers=error_handlers,
+                         response_processors=response_processors,
+                         response_validators=response_validators,
+                         cache=cache,
+                         stream_check_chars=stream_check_chars,
+                         timing_callback=timing_callback,
+                         metrics=metrics,
+                         structured=structured,
+                         output_type=output_type,
+                         single_flight=single_flight)
+
+    async def handle_error(self, exception: Exception) -> bool:
+        """
+        Handle error without blocking the event loop
+        :param exception: exception to handle
+        :return: True if error was handled, False otherwise
+        """
+        for error_handler in self.error_handlers:
+            if error_handler.is_error_to_be_handled(exception):
+                logger.info(f"Error handler {error_handler.__class__.__name__} is handling error of type {type(exception).__name__}")
+                return await error_handler.ahandle(exception)
+        return False
+
+    async def before_request(self, *args, **kwargs) -> None:
+        """
+        Let error handlers prepare for the request without blocking the event loop
+        """
+        for error_handler in self.error_handlers:
+            await error_handler.abefore_request(*args, **kwargs)
+
+    async def after_request(self, exception: tp.Optional[Exception] = None) -> None:
+        """
+        Let error handlers observe the result of the request without blocking the event loop
+        """
+        for error_handler in self.error_handlers:
+            await error_handler.aafter_request(exception)
+
+    async def _receive_stream(self, *args, **kwargs) -> tp.Optional[str]:
+        """
+        Receive streamed response, validating it on the fly
+        :return: response or None if generation was aborted
+        """
+        start = time.perf_counter()
+        time_to_first_token = None
+        chunks = []
+        n_chars = n_checked_chars = 0
+        aborted = False
+        stream = self.generator.stream(*args, **kwargs)
+        try:
+            async for chunk in stream:
+                if time_to_first_token is None:
+                    time_to_first_token = time.perf_counter() - start
+                chunks.append(chunk)
+                n_chars += len(chunk)
+                if n_chars - n_checked_chars >= self.stream_check_chars:
+                    n_checked_chars = n_chars
+                    if not self.is_partial_response_valid("".join(chunks)):
+                        aborted = True
+                        break
+        finally:
+            await stream.aclose()
+        self._report_timing(StreamTiming(time_to_first_token, time.perf_counter() - start, len(chunks), aborted))
+        return None if aborted else "".join(chunks)
+
+    async def _generate(self, request: tp.Callable[..., tp.Awaitable[tp.Optional[str]]], *args, **kwargs) -> tp.Optional[tp.Any]:
+        """
+        Generate response with retries
+        :param request: coroutine function returning raw response (None means the attempt is failed)
+        :return: response (parsed object in structured mode) or None if could not generate response
+        """
+        start = time.perf_counter()
+        with self._timed("cache"):
+            cache_key, cached = self._get_cached(*args, **kwargs)
+            result = self._cached_result(cached) if cached is not None else None
+        if result is not None:
+            self._count_request("cached", start)
+            return result
+
+        for attempt_id in range(self.n_attempts):
+            try:
+                with self._timed("before_request"):
+                    await self.before_request(*args, **kwargs)
+                with self._timed("request"):
+                    response = await request(*args, **kwargs)
+            except CircuitOpenError as e:
+                self._report_gen_error(response=None, description=f"Failing fast during attempt {attempt_id}: {e}")
+                self._count_attempt("error", e)
+                self._count_request("failed", start)
+                return None
+            except Exception as e:
+                self._count_attempt("error", e)
+                await self.after_request(e)
+                with self._timed("error_handling"):
+                    is_handled = await self.handle_error(e)
+                if not is_handled:
+                    msg = f"Unhandled error occurred during attempt {attempt_id}: {e}"
+                    self._report_gen_error(response=None, description=msg)
+                continue
+            await self.after_request()
+            if response is None:
+                self._count_attempt("aborted")
+                continue
+
+            if self.metrics is not None:
+                self.metrics.observe_usage(self.generator)
+            with self._timed("processing"):
+                response = self.process_response(response)
+            with self._timed("validation"):
+                is_valid, result = self.check_result(response)
+            if is_valid:
+                self._count_attempt("valid")
+                self._store_cached(cache_key, response)
+                self._count_request("generated", start)
+                return result
+            self._count_attempt("invalid")
+
+        logger.error(f"Could not generate response after {self.n_attempts} attempts")
+        self._count_request("failed", start)
+
+        return None
+
+    async def _single_flight(self, request: tp.Callable[..., tp.Awaitable[tp.Optional[str]]],
+                             *args, **kwargs) -> tp.Optional[tp.Any]:
+        """
+        Generate response, calls with the same arguments made while it is in flight wait for it and share its result
+        (see `GenerationHandler._single_flight`)
+        """
+        if not self.single_flight:
+            return await self._generate(request, *args, **kwargs)
+        key = self._flight_key(args, kwargs)
+        while (future := self._flights.get(key)) is not None:
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if future.cancelled() and not _is_cancelling():
+                    logger.debug("Request shared by identical calls was cancelled, one of the waiting calls takes it over")
+                    continue
+                raise
+            except BaseException:
+                self._count_saved("single_flight")
+                raise
+            self._count_saved("single_flight")
+            return result
+
+        future = self._flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await self._generate(request, *args, **kwargs)
+        except asyncio.CancelledError:
+            future.cancel()  # waiting calls don't share the cancellation, the first of them sends the request again
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # marks the exception as retrieved, waiting calls (if any) re-raise it
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self._flights[key]
+        return result
+
+    async def generate(self, *args, **kwargs) -> tp.Optional[tp.Any]:
+        """
+        Generate response
+        :return: response (parsed object in structured mode) or None if could not generate response
+        """
+        return await self._single_flight(self.generator, *args, **kwargs)
+
+    async def generate_stream(self, *args, **kwargs) -> tp.Optional[tp.Any]:
+        """
+        Generate response in streaming mode (see `GenerationHandler.generate_stream`)
+        :return: response (parsed object in structured mode) or None if could not generate response
+        """
+        return await self._single_flight(self._receive_stream, *args, **kwargs)
+
+    def iter_generate(self, prompts: tp.Iterable[tp.Any], max_concurrency: int = 1,
+                      stream: bool = False) -> tp.AsyncIterator[tp.Optional[tp.Any]]:
+        """
+        Lazily generate responses for many prompts, keeping up to `max_concurrency` requests in flight on the event loop
+        :param prompts: prompts, each is passed to `generate` as the only positional argument;
+            None prompts (skipped by the prompter, e.g. `BudgetedPrompter`) are not sent and get None
+        :param max_concurrency: maximal number of simultaneous requests
+        :param stream: whether to use `generate_stream`
+        :return: async iterator over responses (None for failed and skipped ones) in the order of prompts
+        """
+        return ordered_async_map(self._prompt_generator(stream), prompts, max_concurrency=max_concurrency)
+
+    def iter_generate_unordered(self, prompts: tp.Iterable[tp.Any], max_concurrency: int = 1,
+                                stream: bool = False) -> tp.AsyncIterator[tp.Tuple[int, tp.Optional[tp.Any]]]:
+        """
+        Lazily generate responses for many prompts in completion order (see `GenerationHandler.iter_generate_unordered`)
+        :param prompts: prompts, None prompts are not sent and get None
+        :param max_concurrency: maximal number of simultaneous requests
+        :param stream: whether to use `generate_stream`
+        :return: async iterator over positions of prompts in `prompts` and their responses (None for failed and skipped ones)
+        """
+        return unordered_async_map(self._prompt_generator(stream), prompts, max_concurrency=max_concurrency)
+
+    def _prompt_generator(self, stream: bool) -> tp.Callable[[tp.Any], tp.Awaitable[tp.Optional[tp.Any]]]:
+        request = self.generate_stream if stream else self.generate
+
+        async def generate(prompt: tp.Any) -> tp.Optional[tp.Any]:
+            return None if prompt is None else await request(prompt)
+
+        return generate
+
+    async def generate_many(self, prompts: tp.Iterable[tp.Any], max_concurrency: int = 1,
+                            stream: bool = False, deduplicate: bool = False) -> tp.List[tp.Optional[tp.Any]]:
+        """
+        Generate responses for many prompts concurrently
+        :param prompts: prompts, each is passed to `generate` as the only positional argument
+        :param max_concurrency: maximal number of simultaneous requests
+        :param stream: whether to use `generate_stream`
+        :param deduplicate: whether to generate each unique prompt once and give its result to all its duplicates
+        :return: responses (None for failed ones) in the order of prompts
+        """
+        if deduplicate:
+            unique_prompts, inverse = self._deduplicate(prompts)
+            responses = await self.generate_many(unique_prompts, max_concurrency=max_concurrency, stream=stream)
+            return [responses[i] for i in inverse]
+        return [response async for response in self.iter_generate(prompts, max_concurrency=max_concurrency, stream=stream)]
+
+    async def generate_batch(self, prompts: tp.Sequence[tp.Any], retry_failed: bool = True, max_concurrency: int = 1,
+                             deduplicate: bool = False, **batch_kwargs) -> tp.List[tp.Optional[tp.Any]]:
+        """
+        Generate responses for all prompts with one batch request (see `GenerationHandler.generate_batch`)
+        Polling of the batch is synchronous, so it runs in a thread; failed responses are regenerated on the event loop
+        :param prompts: prompts
+        :param retry_failed: whether to regenerate invalid and failed responses with regular requests
+        :param max_concurrency: maximal number of simultaneous regular requests when retrying
+        :param deduplicate: whether to send each unique prompt once and give its result to all its duplicates
+        :param batch_kwargs: arguments of the generator's `generate_batch` (e.g. batch_file, poll_interval)
+        :return: responses (None for failed ones) in the order of prompts
+        """
+        if deduplicate:
+            unique_prompts, inverse = self._deduplicate(prompts)
+            responses = await self.generate_batch(unique_prompts, retry_failed=retry_failed,
+                                                  max_concurrency=max_concurrency, **batch_kwargs)
+            return [responses[i] for i in inverse]
+        responses, failed_ids = await asyncio.to_thread(self._send_batch, prompts, **batch_kwargs)
+        if failed_ids and retry_failed:
+            logger.info(f"Regenerating {len(failed_ids)} failed responses of the batch one by one")
+            regenerated = await self.generate_many([prompts[prompt_id] for prompt_id in failed_ids],
+                                                   max_concurrency=max_concurrency)
+            for prompt_id, response in zip(failed_ids, regenerated):
+                responses[prompt_id] = response
+
+        return responses
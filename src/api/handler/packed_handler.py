@@ -0,0 +1,210 @@
+"""
+Generation with several rows packed into one prompt (see `PackedPrompter`): the few-shot preamble is sent once per pack,
+the response is split into the answers for each row, and each answer is checked by the validators on its own.
+"""
+import logging
+import typing as tp
+
+from src.json_backends import get_json_backend
+
+from ..cache import ResponseCache
+from ..prompter import PackedPrompter
+from ..tokens import TokenBudget
+from .error_handlers import BaseErrorHandler
+from .handler import GenerationHandler, GenerationMetrics
+from .response_processors import BaseResponseProcessor
+from .response_validators import BaseResponseValidator, NOT_PARSED
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class PackedGenerationHandler(GenerationHandler):
+    """
+    GenerationHandler for packed prompts. Processors get the whole response (e.g. extract the json from a code block),
+    validators get the answer for each row, so they are the same as for one row (e.g. JsonResponseValidator with the schema
+    of `conf/prompt/*.yaml`). `generate` returns answers by keys of the rows, `iter_rows` / `generate_rows` give a result for each row:
+    missing and invalid answers are generated again in packs half the size, the number of rows in a pack is limited
+    by `max_items` and by the token budget of the model (prompt tokens and tokens of the answers)
+    """
+    def __init__(self,
+                 generator: tp.Callable[..., str],
+                 prompter: PackedPrompter,
+                 max_items: int = 10,
+                 budget: tp.Optional[TokenBudget] = None,
+                 output_tokens_per_item: int = 150,
+                 n_item_attempts: int = 3,
+                 n_attempts: int = 1,
+                 error_handlers: tp.Optional[tp.List[BaseErrorHandler]] = None,
+                 response_processors: tp.Optional[tp.List[BaseResponseProcessor]] = None,
+                 response_validators: tp.Optional[tp.List[BaseResponseValidator]] = None,
+                 cache: tp.Optional[ResponseCache] = None,
+                 metrics: tp.Optional[GenerationMetrics] = None,
+                 structured: bool = False,
+                 output_type: tp.Optional[tp.Callable[..., tp.Any]] = None,
+                 single_flight: bool = False) -> None:
+        """
+        :param generator: function to generate response
+        :param prompter: prompter packing rows into one prompt
+        :param max_items: maximal number of rows in one prompt
+        :param budget: token budget of the model (e.g. `TokenBudget.from_config(cfg.model)`), None means only `max_items`
+            limits the packs; the prompt has to fit into its prompt tokens and the answers into its `max_output_tokens`
+            (if it is not set, the prompt and the expected answers have to fit into the context together)
+        :param output_tokens_per_item: expected number of tokens in the answer for one row
+        :param n_item_attempts: number of rounds of packing rows without a valid answer
+        :param n_attempts: number of attempts to generate response for one pack
+        :param error_handlers: list of error handlers
+        :param response_processors: list of response processors, applied to the whole response
+        :param response_validators: list of response validators, applied to the answer for each row
+        :param cache: cache of valid responses (responses with at least one valid answer are stored)
+        :param metrics: where to record stage latencies, attempts, errors and token usage (None means no metrics)
+        :param structured: whether to return objects parsed by validators (e.g. JsonResponseValidator) instead of text
+        :param output_type: class built from parsed json objects in structured mode with `output_type(**obj)`
+        :param single_flight: whether identical prompts in flight at the same time share one request and its result
+        """
+        super().__init__(generator=generator,
+                         n_attempts=n_attempts,
+                         error_handlers=error_handlers,
+                         response_processors=response_processors,
+                         response_validators=response_validators,
+                         cache=cache,
+                         metrics=metrics,
+                         structured=structured,
+                         output_type=output_type,
+                         single_flight=single_flight)
+        if max_items < 1:
+            raise ValueError(f"max_items must be positive, got {max_items}")
+        self.prompter = prompter
+        self.max_items = max_items
+        self.budget = budget
+        self.output_tokens_per_item = output_tokens_per_item
+        self.n_item_attempts = n_item_attempts
+        self._static_tokens: tp.Dict[int, int] = {}
+
+    def check_result(self, response: str, parsed: tp.Any = NOT_PARSED) -> tp.Tuple[bool, tp.Dict[str, tp.Any]]:
+        """
+        Split response into the answers for each row and check each of them
+        :param response: processed response
+        :param parsed: unused, packed responses are always parsed here
+        :return: whether at least one answer is valid and the results of valid answers by keys of the rows
+        """
+        json_backend = get_json_backend()
+        try:
+            answers = self.prompter.split_answers(json_backend.loads(response))
+        except json_backend.decode_errors as e:
+            self._report_gen_error(response, f"Packed response is not valid json: {e}")
+            return False, {}
+
+        results = {}
+        for key, answer in answers.items():
+            is_valid, result = super().check_result(json_backend.dumps(answer), parsed=answer)
+            if is_valid:
+                results[key] = result
+        if not results:
+            self._report_gen_error(response, "Packed response has no valid answers")
+        return bool(results), results
+
+    def _cached_result(self, cached: str) -> tp.Optional[tp.Dict[str, tp.Any]]:
+        """
+        Returns answers of cached response (None if none of them passes validation anymore)
+        """
+        is_valid, results = self.check_result(cached)
+        return results if is_valid else None
+
+    def _count_static_tokens(self, n_items: int) -> int:
+        """
+        Returns cached number of tokens sent once per prompt with `n_items` rows
+        """
+        n_tokens = self._static_tokens.get(n_items)
+        if n_tokens is None:
+            n_tokens = self._static_tokens[n_items] = self.budget.counter.count(self.prompter.static_text(n_items))
+        return n_tokens
+
+    def pack(self, rows: tp.Sequence[tp.Mapping[str, tp.Any]], row_ids: tp.Iterable[int],
+             max_items: tp.Optional[int] = None) -> tp.List[tp.List[int]]:
+        """
+        Splits rows into packs (in order), a pack is closed when the next row exceeds `max_items` or the token budget
+        :param rows: values of the template fields for each row
+        :param row_ids: ids of rows to pack
+        :param max_items: maximal number of rows in one pack (default: `self.max_items`)
+        :return: ids of rows of each pack
+        """
+        max_items = max_items or self.max_items
+        # answers have their own budget of `max_output_tokens`, without it they share the context with the prompt
+        output_tokens_per_item = 0
+        if self.budget is not None and self.budget.max_output_tokens:
+            max_items = max(1, min(max_items, self.budget.max_output_tokens // max(self.output_tokens_per_item, 1)))
+        elif self.budget is not None:
+            output_tokens_per_item = self.output_tokens_per_item
+
+        def count_item_tokens(n_items: int, row_id: int) -> int:
+            if self.budget is None:
+                return 0
+            return self.budget.counter.count(self.prompter.render_item(str(n_items), rows[row_id]))
+
+        packs: tp.List[tp.List[int]] = []
+        pack: tp.List[int] = []
+        n_tokens = 0
+        for row_id in row_ids:
+            item_tokens = count_item_tokens(len(pack) + 1, row_id)
+            is_full = len(pack) >= max_items or (
+                self.budget is not None
+                and self._count_static_tokens(len(pack) + 1) + n_tokens + item_tokens
+                + (len(pack) + 1) * output_tokens_per_item > self.budget.max_prompt_tokens)
+            if pack and is_full:
+                packs.append(pack)
+                pack, n_tokens = [], 0
+                item_tokens = count_item_tokens(1, row_id)
+            pack.append(row_id)
+            n_tokens += item_tokens
+        if pack:
+            packs.append(pack)
+        return packs
+
+    def iter_rows(self, rows: tp.Sequence[tp.Mapping[str, tp.Any]],
+                  max_concurrency: int = 1) -> tp.Iterator[tp.Tuple[int, tp.Optional[tp.Any]]]:
+        """
+        Lazily generate results for rows packed into prompts, rows without a valid answer are packed again
+        (in smaller packs) up to `n_item_attempts` times
+        :param rows: values of the template fields for each row
+        :param max_concurrency: maximal number of simultaneous requests
+        :return: iterator over ids of rows and their results: valid ones as soon as their pack is done,
+            failed ones (None) after the last attempt
+        """
+        pending = list(range(len(rows)))
+        max_items = self.max_items
+        n_requests = 0
+        for item_attempt_id in range(self.n_item_attempts):
+            if not pending:
+                break
+            packs = self.pack(rows, pending, max_items=max_items)
+            n_requests += len(packs)
+            prompts = (self.prompter.get_prompt([rows[row_id] for row_id in pack]) for pack in packs)
+            pending = []
+            for pack_id, answers in self.iter_generate_unordered(prompts, max_concurrency=max_concurrency):
+                pack = packs[pack_id]
+                for key, row_id in zip(self.prompter.keys(len(pack)), pack):
+                    if answers is not None and key in answers:
+                        yield row_id, answers[key]
+                    else:
+                        pending.append(row_id)
+            max_items = max(1, max_items // 2)
+            if pending and item_attempt_id + 1 < self.n_item_attempts:
+                logger.info(f"{len(pending)} rows have no valid answer, packing them again by up to {max_items}")
+
+        logger.info(f"Generated {len(rows) - len(pending)} of {len(rows)} rows with {n_requests} packed requests")
+        for row_id in pending:
+            yield row_id, None
+
+    def generate_rows(self, rows: tp.Sequence[tp.Mapping[str, tp.Any]],
+                      max_concurrency: int = 1) -> tp.List[tp.Optional[tp.Any]]:
+        """
+        Generate results for rows packed into prompts (see `iter_rows`)
+        :param rows: values of the template fields for each row
+        :param max_concurrency: maximal number of simultaneous requests
+        :return: results (None for failed ones) in the order of rows
+        """
+        results: tp.List[tp.Optional[tp.Any]] = [None] * len(rows)
+        for row_id, result in self.iter_rows(rows, max_concurrency=max_concurrency):
+            results[row_id] = result
+        return results
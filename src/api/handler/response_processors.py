@@ -15,6 +15,15 @@ class BaseResponseProcessor(ABC):
         """
         pass
 
+    def process_partial(self, response: str) -> str:
+        """
+        Process prefix of streamed response (used for early validation)
+        By default the prefix is returned unchanged
+        :param response: received part of response
+        :return: processed part of response
+        """
+        return response
+
 
 class CodeBlockExtractorProcessor(BaseResponseProcessor):
     """
@@ -39,6 +48,19 @@ class CodeBlockExtractorProcessor(BaseResponseProcessor):
         response_extracted = response[block_open_index_end:block_close_index_start]
         return response_extracted
 
+    def process_partial(self, response: str) -> str:
+        """
+        Extract the received part of the code block (prefix is returned unchanged until the block is opened)
+        """
+        block_open_index_start = response.find(f"```{self.lang}")
+        if block_open_index_start == -1:
+            return response
+        block_open_index_end = block_open_index_start + len(self.lang) + 3
+        block_close_index_start = response.find("```", block_open_index_end)
+        if block_close_index_start == -1:
+            return response[block_open_index_end:]
+        return response[block_open_index_end:block_close_index_start]
+
 class CodeBlockStripperProcessor(BaseResponseProcessor):
     """
     Strip code blocks from response
@@ -49,3 +71,9 @@ class CodeBlockStripperProcessor(BaseResponseProcessor):
         """
         response_stripped = response.lstrip("```json").lstrip("```").rstrip("```")
         return response_stripped
+
+    def process_partial(self, response: str) -> str:
+        """
+        Strip opening of code block from the received part of response
+        """
+        return response.lstrip("```json").lstrip("```")
@@ -1,13 +1,65 @@
-
+import functools
+import json
 import logging
 import typing as tp
-import jsonschema
-import json
 from abc import ABC, abstractmethod
+from importlib.util import find_spec
+
+from src.json_backends import get_json_backend
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+SCHEMA_BACKENDS_PRIORITY = ("fastjsonschema", "jsonschema")
+NOT_PARSED = object()  # marks that none of the previous validators parsed the response
+
+
+class SchemaValidationError(ValueError):
+    """Raised by compiled schemas when an object doesn't match the schema."""
+    pass
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_schema(schema_json: str, backend: str) -> tp.Callable[[tp.Any], None]:
+    schema = json.loads(schema_json)
+    if backend == "fastjsonschema":
+        import fastjsonschema
+        validate = fastjsonschema.compile(schema)
+
+        def validate_fast(obj: tp.Any) -> None:
+            try:
+                validate(obj)
+            except fastjsonschema.JsonSchemaException as e:
+                raise SchemaValidationError(e.message) from e
+        return validate_fast
+
+    import jsonschema
+    validator_class = jsonschema.validators.validator_for(schema)
+    validator_class.check_schema(schema)
+    validator = validator_class(schema)
+
+    def validate_jsonschema(obj: tp.Any) -> None:
+        try:
+            validator.validate(obj)
+        except jsonschema.ValidationError as e:
+            raise SchemaValidationError(e.message) from e
+    return validate_jsonschema
+
+
+def compile_schema(schema: tp.Dict, backend: tp.Optional[str] = None) -> tp.Callable[[tp.Any], None]:
+    """
+    Returns function validating objects against the schema, raising SchemaValidationError on mismatch.
+    The schema is checked and compiled once, equal schemas share the compiled function.
+    :param schema: json schema
+    :param backend: "fastjsonschema" or "jsonschema" (default: fastjsonschema if installed)
+    """
+    if backend is None:
+        backend = next(name for name in SCHEMA_BACKENDS_PRIORITY if name == "jsonschema" or find_spec(name) is not None)
+    if backend not in SCHEMA_BACKENDS_PRIORITY:
+        raise ValueError(f"Unknown schema backend {backend!r}, expected one of {list(SCHEMA_BACKENDS_PRIORITY)}")
+    return _compile_schema(json.dumps(schema, sort_keys=True), backend)
+
+
 class BaseResponseValidator(ABC):
     @abstractmethod
     def is_response_valid(self, response: str) -> bool:
@@ -18,33 +70,88 @@ class BaseResponseValidator(ABC):
         """
         pass
 
+    def validate(self, response: str, parsed: tp.Any = NOT_PARSED) -> tp.Tuple[bool, tp.Any]:
+        """
+        Check response, reusing object parsed from it by the previous validators
+        By default calls `is_response_valid` and passes `parsed` on
+        :param response: response to check
+        :param parsed: object parsed from response (NOT_PARSED if nothing parsed it yet)
+        :return: whether response is valid and parsed object for the next validators
+        """
+        return self.is_response_valid(response), parsed
+
+    def is_partial_response_valid(self, response: str) -> bool:
+        """
+        Check if prefix of streamed response can still become valid (False aborts generation)
+        By default any prefix is accepted
+        :param response: received (and processed) part of response
+        :return: False if response is clearly broken, True otherwise
+        """
+        return True
+
 
 class JsonResponseValidator(BaseResponseValidator):
     """
     Check if response is valid json matching the schema
     """
-    def __init__(self, schema: tp.Optional[tp.Dict] = None) -> None:
+    def __init__(self, schema: tp.Optional[tp.Dict] = None, json_backend: tp.Optional[str] = None,
+                 max_chars_before_json: tp.Optional[int] = 500, schema_backend: tp.Optional[str] = None) -> None:
         """
         :param schema: schema to check response against (look in jsonschema documentation for more info)
             - if None, response will be checked for valid json
+        :param json_backend: "orjson", "ujson" or "json" (default: the fastest installed one, see `src.json_backends`)
+        :param max_chars_before_json: streamed response is aborted if json doesn't start within this number of characters
+            - if None, streamed responses are never aborted
+        :param schema_backend: "fastjsonschema" or "jsonschema" (default: fastjsonschema if installed, see `compile_schema`)
         """
         self.schema = schema
+        self.json_backend = get_json_backend(json_backend)
+        self.max_chars_before_json = max_chars_before_json
+        self._validate_schema = compile_schema(schema, schema_backend) if schema is not None else None
 
-    def is_response_valid(self, response: str) -> bool:
+    def validate(self, response: str, parsed: tp.Any = NOT_PARSED) -> tp.Tuple[bool, tp.Any]:
         """
-        Check if response is valid json matching the schema
+        Check if response is valid json matching the schema, the response is parsed only if `parsed` is not given
+        :return: whether response is valid and parsed json (`parsed` if invalid)
         """
         try:
-            json_response = json.loads(response)
-            if self.schema is not None:
-                jsonschema.validate(json_response, self.schema)
-        except jsonschema.ValidationError as e:
+            json_response = self.json_backend.loads(response) if parsed is NOT_PARSED else parsed
+            if self._validate_schema is not None:
+                self._validate_schema(json_response)
+        except SchemaValidationError as e:
             logger.error(f"Response is not valid json matching the schema: {e}")
-            return False
-        except json.decoder.JSONDecodeError as e:
+            return False, parsed
+        except self.json_backend.decode_errors as e:
             logger.error(f"Response is not valid json: {e}")
-            return False
+            return False, parsed
         except Exception as e:
             logger.error(f"Unknown error: {e}")
-            return False
-        return True
+            return False, parsed
+        return True, json_response
+
+    def is_response_valid(self, response: str) -> bool:
+        """
+        Check if response is valid json matching the schema
+        """
+        return self.validate(response)[0]
+
+    def validate_many(self, responses: tp.Iterable[tp.Any]) -> tp.List[bool]:
+        """
+        Check many responses (e.g. re-validating a stored result file against a new schema)
+        :param responses: json strings or already parsed objects (those are only checked against the schema)
+        :return: whether each response is valid
+        """
+        results = []
+        for response in responses:
+            parsed = NOT_PARSED if isinstance(response, (str, bytes)) else response
+            results.append(self.validate(response, parsed=parsed)[0])
+        return results
+
+    def is_partial_response_valid(self, response: str) -> bool:
+        """
+        Check if json starts (with "{" or "[") within the first `max_chars_before_json` characters
+        """
+        if self.max_chars_before_json is None or len(response) < self.max_chars_before_json:
+            return True
+        head = response[:self.max_chars_before_json]
+        return "{" in head or "[" in head
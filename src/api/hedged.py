@@ -0,0 +1,286 @@
+"""
+Hedged requests over several LLM backends (e.g. OpenAIApi and GrazieApi).
+If the primary backend doesn't answer within a percentile of its recent latencies, a duplicate request is sent
+to the next backend and the first valid response wins. Failed and rate limited backends are failed over.
+"""
+import asyncio
+import logging
+import threading
+import time
+import typing as tp
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from .api import AsyncLLMBaseApi, LLMBaseApi
+from .handler.error_handlers import get_retry_after, is_rate_limit_error
+
+logger = logging.getLogger(__name__)
+
+
+class _HedgingPolicy:
+    """Latency statistics and rate limit cooldowns of backends, shared by sync and async hedged APIs."""
+    def __init__(self, backends: tp.Sequence[tp.Any],
+                 hedge_percentile: float = 0.95,
+                 initial_hedge_delay: float = 1.0,
+                 min_samples: int = 20,
+                 window: int = 200,
+                 max_in_flight: int = 2,
+                 is_valid: tp.Optional[tp.Callable[[str], bool]] = None,
+                 cooldown: float = 30.0,
+                 rate_limit_error_types: tp.Optional[tp.List[tp.Type[Exception]]] = None,
+                 rate_limit_messages_patterns: tp.Optional[tp.List[tp.Optional[str]]] = None) -> None:
+        """
+        :param backends: backends in the order of preference, the first healthy one is the primary
+        :param hedge_percentile: duplicate is sent if the request takes longer than this percentile of backend latencies
+        :param initial_hedge_delay: hedge delay in seconds until `min_samples` latencies of the backend are collected
+        :param min_samples: number of latencies needed to use the percentile
+        :param window: number of recent latencies kept per backend
+        :param max_in_flight: maximal number of simultaneous requests for one prompt
+        :param is_valid: function checking response (e.g. JsonResponseValidator().is_response_valid),
+            invalid responses don't win the race (default: any response is valid)
+        :param cooldown: time in seconds a rate limited backend is moved to the end of the queue (if there is no `Retry-After` hint)
+        :param rate_limit_error_types: list of rate limit error types (None means errors detected by `is_rate_limit_error`)
+        :param rate_limit_messages_patterns: list of rate limit error messages patterns (see SleepErrorHandler)
+        """
+        if not backends:
+            raise ValueError("At least one backend is required")
+        if max_in_flight < 1:
+            raise ValueError(f"max_in_flight must be positive, got {max_in_flight}")
+        self.backends = list(backends)
+        self.hedge_percentile = hedge_percentile
+        self.initial_hedge_delay = initial_hedge_delay
+        self.min_samples = min_samples
+        self.max_in_flight = max_in_flight
+        self.is_valid = is_valid
+        self.cooldown = cooldown
+        self.rate_limit_error_types = rate_limit_error_types
+        self.rate_limit_messages_patterns = rate_limit_messages_patterns or [None] * len(rate_limit_error_types or [])
+
+        self.model = "hedged(" + ",".join(str(getattr(backend, "model", type(backend).__name__)) for backend in self.backends) + ")"
+        self.params = None
+        self.n_hedged = 0
+        self.n_failovers = 0
+
+        self._lock = threading.Lock()
+        self._latencies: tp.List[tp.Deque[float]] = [deque(maxlen=window) for _ in self.backends]
+        self._cooldown_until = [0.0] * len(self.backends)
+
+    def _ordered_backend_ids(self) -> tp.List[int]:
+        """Healthy backends in the order of preference, then rate limited ones by the end of their cooldown."""
+        now = time.monotonic()
+        with self._lock:
+            cooldown_until = list(self._cooldown_until)
+        healthy = [backend_id for backend_id, until in enumerate(cooldown_until) if until <= now]
+        cooling = sorted((backend_id for backend_id, until in enumerate(cooldown_until) if until > now),
+                         key=cooldown_until.__getitem__)
+        return healthy + cooling
+
+    def hedge_delay(self, backend_id: int) -> float:
+        """
+        Returns time in seconds after which a duplicate of the request to the backend is sent
+        :param backend_id: index of the backend
+        """
+        with self._lock:
+            latencies = sorted(self._latencies[backend_id])
+        if len(latencies) < self.min_samples:
+            return self.initial_hedge_delay
+        return latencies[min(len(latencies) - 1, int(self.hedge_percentile * len(latencies)))]
+
+    def _record_latency(self, backend_id: int, latency: float) -> None:
+        with self._lock:
+            self._latencies[backend_id].append(latency)
+
+    def _is_rate_limit_error(self, exception: Exception) -> bool:
+        if self.rate_limit_error_types is None:
+            return is_rate_limit_error(exception)
+        for error_type, error_message_pattern in zip(self.rate_limit_error_types, self.rate_limit_messages_patterns):
+            if isinstance(exception, error_type):
+                if error_message_pattern is None or error_message_pattern.lower() in str(exception).lower():
+                    return True
+        return False
+
+    def _on_error(self, backend_id: int, exception: Exception) -> None:
+        """Put rate limited backend to cooldown."""
+        backend_name = type(self.backends[backend_id]).__name__
+        if not self._is_rate_limit_error(exception):
+            logger.warning(f"Backend {backend_id} ({backend_name}) failed: {exception}")
+            return
+        cooldown = get_retry_after(exception)
+        cooldown = self.cooldown if cooldown is None else cooldown
+        with self._lock:
+            self._cooldown_until[backend_id] = max(self._cooldown_until[backend_id], time.monotonic() + cooldown)
+        logger.warning(f"Backend {backend_id} ({backend_name}) is rate limited, moving it back for {cooldown:.1f} seconds")
+
+    def _count_hedge(self) -> None:
+        logger.debug("Primary backend is slow, sending duplicate request")
+        with self._lock:
+            self.n_hedged += 1
+
+    def _count_failover(self) -> None:
+        logger.debug("All requests failed, failing over to the next backend")
+        with self._lock:
+            self.n_failovers += 1
+
+    def _is_valid(self, response: str) -> bool:
+        return self.is_valid is None or self.is_valid(response)
+
+    def latency_stats(self) -> tp.List[tp.Dict[str, tp.Any]]:
+        """Returns number of recorded latencies and current hedge delay of each backend."""
+        return [
+            {"backend": type(backend).__name__, "n_samples": len(self._latencies[backend_id]), "hedge_delay": self.hedge_delay(backend_id)}
+            for backend_id, backend in enumerate(self.backends)
+        ]
+
+
+class HedgedApi(_HedgingPolicy, LLMBaseApi):
+    """
+    Hedged requests over several sync backends (see module docstring).
+    Threads can't be interrupted, so the losing request is cancelled only if it hasn't started yet,
+    otherwise its result is dropped when it arrives.
+    """
+    def __init__(self, backends: tp.Sequence[tp.Callable[[str], str]], max_workers: int = 32, **kwargs: tp.Any) -> None:
+        """
+        :param backends: backends in the order of preference (e.g. [OpenAIApi(...), GrazieApi(...)])
+        :param max_workers: number of threads running requests (shared by all prompts)
+        :param kwargs: hedging parameters (see `_HedgingPolicy`)
+        """
+        super().__init__(backends, **kwargs)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedged")
+
+    def _request(self, backend_id: int, prompt: str) -> str:
+        start = time.perf_counter()
+        response = self.backends[backend_id](prompt)
+        self._record_latency(backend_id, time.perf_counter() - start)
+        return response
+
+    def __call__(self, prompt: str) -> str:
+        """
+        Returns the first valid response (or the last invalid one if there is no valid response)
+        Raises the last error if all backends failed
+        """
+        backend_ids = self._ordered_backend_ids()
+        in_flight: tp.Dict[Future, int] = {}
+        n_launched = 0
+        hedge_at = 0.0
+        last_error: tp.Optional[Exception] = None
+        last_response: tp.Optional[str] = None
+
+        def launch() -> None:
+            nonlocal n_launched, hedge_at
+            backend_id = backend_ids[n_launched]
+            n_launched += 1
+            in_flight[self._executor.submit(self._request, backend_id, prompt)] = backend_id
+            hedge_at = time.monotonic() + self.hedge_delay(backend_id)
+
+        launch()
+        try:
+            while in_flight:
+                can_hedge = n_launched < len(backend_ids) and len(in_flight) < self.max_in_flight
+                timeout = max(0.0, hedge_at - time.monotonic()) if can_hedge else None
+                done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    self._count_hedge()
+                    launch()
+                    continue
+
+                for future in done:
+                    backend_id = in_flight.pop(future)
+                    try:
+                        response = future.result()
+                    except Exception as e:
+                        self._on_error(backend_id, e)
+                        last_error = e
+                        continue
+                    if self._is_valid(response):
+                        return response
+                    logger.warning(f"Backend {backend_id} ({type(self.backends[backend_id]).__name__}) returned invalid response")
+                    last_response = response
+
+                if not in_flight and n_launched < len(backend_ids):
+                    self._count_failover()
+                    launch()
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+        if last_response is not None:
+            return last_response
+        raise last_error
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AsyncHedgedApi(_HedgingPolicy, AsyncLLMBaseApi):
+    """Hedged requests over several async backends (see module docstring), the losing request is cancelled."""
+    def __init__(self, backends: tp.Sequence[tp.Callable[[str], tp.Awaitable[str]]], **kwargs: tp.Any) -> None:
+        """
+        :param backends: async backends in the order of preference (e.g. [AsyncOpenAIApi(...), AsyncOpenAIApi(...)])
+        :param kwargs: hedging parameters (see `_HedgingPolicy`)
+        """
+        super().__init__(backends, **kwargs)
+
+    async def _request(self, backend_id: int, prompt: str) -> str:
+        start = time.perf_counter()
+        try:
+            response = await self.backends[backend_id](prompt)
+        except asyncio.CancelledError:
+            # the loser is slow: its elapsed time is a lower bound of the latency, without it only fast samples are kept
+            self._record_latency(backend_id, time.perf_counter() - start)
+            raise
+        self._record_latency(backend_id, time.perf_counter() - start)
+        return response
+
+    async def __call__(self, prompt: str) -> str:
+        """
+        Returns the first valid response (or the last invalid one if there is no valid response)
+        Raises the last error if all backends failed
+        """
+        backend_ids = self._ordered_backend_ids()
+        in_flight: tp.Dict[asyncio.Task, int] = {}
+        n_launched = 0
+        hedge_at = 0.0
+        last_error: tp.Optional[Exception] = None
+        last_response: tp.Optional[str] = None
+
+        def launch() -> None:
+            nonlocal n_launched, hedge_at
+            backend_id = backend_ids[n_launched]
+            n_launched += 1
+            in_flight[asyncio.ensure_future(self._request(backend_id, prompt))] = backend_id
+            hedge_at = time.monotonic() + self.hedge_delay(backend_id)
+
+        launch()
+        try:
+            while in_flight:
+                can_hedge = n_launched < len(backend_ids) and len(in_flight) < self.max_in_flight
+                timeout = max(0.0, hedge_at - time.monotonic()) if can_hedge else None
+                done, _ = await asyncio.wait(in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self._count_hedge()
+                    launch()
+                    continue
+
+                for task in done:
+                    backend_id = in_flight.pop(task)
+                    try:
+                        response = task.result()
+                    except Exception as e:
+                        self._on_error(backend_id, e)
+                        last_error = e
+                        continue
+                    if self._is_valid(response):
+                        return response
+                    logger.warning(f"Backend {backend_id} ({type(self.backends[backend_id]).__name__}) returned invalid response")
+                    last_response = response
+
+                if not in_flight and n_launched < len(backend_ids):
+                    self._count_failover()
+                    launch()
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+        if last_response is not None:
+            return last_response
+        raise last_error
@@ -1,7 +1,13 @@
 import typing as tp
 from abc import ABC, abstractmethod
 
-from ..helpers import smart_format
+from ..helpers import compile_template
+
+PACKING_INSTRUCTION = (
+    "You're given {n_items} inputs at once, each of them starts with its key in square brackets.\n"
+    "Answer with one JSON object mapping the key of each input (without brackets) to the JSON you would give "
+    'for this input alone, e.g. {{"1": ..., "2": ...}}.'
+)
 
 class Prompter(ABC):
     """Prompter interface."""
@@ -12,9 +18,94 @@ class Prompter(ABC):
 
 
 class TemplatePrompter:
-    """Prompter using a template for the prompt message."""
+    """Prompter using a template for the prompt message. The template is parsed once, at construction."""
     def __init__(self, template: str):
         self.template = template
+        self.compiled_template = compile_template(template)
+
+    @property
+    def field_names(self) -> tp.Tuple[str, ...]:
+        """Names of the template fields."""
+        return self.compiled_template.field_names
 
     def get_prompt(self, **kwargs: tp.Any) -> str:
-        return smart_format(self.template, **kwargs)
+        return self.compiled_template.render(**kwargs)
+
+    def render_many(self, rows: tp.Any) -> tp.List[str]:
+        """Renders prompts for a DataFrame or a list of dicts."""
+        return self.compiled_template.render_many(rows)
+
+
+class PackedPrompter(Prompter):
+    """
+    Puts several rows into one prompt, so the few-shot preamble of the template is sent once for all of them.
+    The last paragraph of the template with fields is the input block, its lines with fields are rendered for each row
+    (prefixed with the key of the row: "[1] ", "[2] ", ...), everything before it is the preamble.
+    The model is asked to answer with a json object mapping the keys to the answers for the rows (see `split_answers`).
+    """
+    def __init__(self, template: str, instruction: str = PACKING_INSTRUCTION, key_field: str = "key"):
+        """
+        :param template: template for one row (e.g. `template` of `conf/prompt/german.yaml`)
+        :param instruction: instruction put between the preamble and the inputs, `{n_items}` is the number of rows
+        :param key_field: field with the key in answers given as a json array of objects instead of a json object
+        """
+        self.template = template
+        self.instruction = instruction
+        self.key_field = key_field
+        paragraphs = template.split("\n\n")
+        input_id = max((i for i, paragraph in enumerate(paragraphs) if compile_template(paragraph).field_names), default=None)
+        if input_id is None:
+            raise ValueError("Template has no fields to pack")
+        preamble = compile_template("\n\n".join(paragraphs[:input_id]))
+        if preamble.field_names:
+            raise ValueError(f"Only the last paragraph of the template may have fields, got {list(preamble.field_names)} before it")
+        lines = "\n\n".join(paragraphs[input_id:]).split("\n")
+        item_ids = [i for i, line in enumerate(lines) if compile_template(line).field_names]
+        self.preamble = preamble.render()
+        self.head = compile_template("\n".join(lines[:item_ids[0]])).render()
+        self.item_template = compile_template("\n".join(lines[item_ids[0]:item_ids[-1] + 1]))
+        self.tail = compile_template("\n".join(lines[item_ids[-1] + 1:])).render()
+
+    @property
+    def field_names(self) -> tp.Tuple[str, ...]:
+        """Names of the template fields."""
+        return self.item_template.field_names
+
+    def static_text(self, n_items: int) -> str:
+        """Text sent once per prompt with `n_items` rows (to estimate its tokens)."""
+        return "\n\n".join([self.preamble, self.instruction.format(n_items=n_items), self.head + self.tail])
+
+    @staticmethod
+    def keys(n_items: int) -> tp.List[str]:
+        """Keys of the rows in a prompt with `n_items` rows."""
+        return [str(i) for i in range(1, n_items + 1)]
+
+    def render_item(self, key: str, row: tp.Mapping[str, tp.Any]) -> str:
+        """Renders input line(s) of one row."""
+        return f"[{key}] " + self.item_template.render(**row)
+
+    def get_prompt(self, rows: tp.Sequence[tp.Mapping[str, tp.Any]]) -> str:
+        """
+        Renders prompt for the rows
+        :param rows: values of the template fields for each row
+        """
+        items = "\n".join(self.render_item(key, row) for key, row in zip(self.keys(len(rows)), rows))
+        inputs = "\n".join(part for part in (self.head, items, self.tail) if part)
+        return "\n\n".join(part for part in (self.preamble, self.instruction.format(n_items=len(rows)), inputs) if part)
+
+    def split_answers(self, parsed: tp.Any) -> tp.Dict[str, tp.Any]:
+        """
+        Splits parsed response into the answers for each row
+        :param parsed: json object mapping keys to answers or json array of objects with `key_field`
+        :return: answers by keys (rows without an answer are missing)
+        """
+        if isinstance(parsed, dict):
+            return {str(key): answer for key, answer in parsed.items()}
+        if isinstance(parsed, list):
+            answers = {}
+            for answer in parsed:
+                if isinstance(answer, dict) and self.key_field in answer:
+                    answer = dict(answer)
+                    answers[str(answer.pop(self.key_field))] = answer
+            return answers
+        return {}
@@ -0,0 +1,79 @@
+"""
+Structured outputs: typed results built from parsed and validated json responses (see `GenerationHandler(structured=True)`).
+Results can be plain json (dicts and lists), dataclasses or light `__slots__` records generated from a json schema.
+"""
+import dataclasses
+import keyword
+import typing as tp
+
+
+class Record:
+    """Base of records generated by `make_record_class`: `__slots__` attributes named after the schema properties."""
+    __slots__ = ()
+    _fields: tp.Tuple[str, ...] = ()
+    _required: tp.FrozenSet[str] = frozenset()
+
+    def __init__(self, **kwargs: tp.Any) -> None:
+        missing = self._required.difference(kwargs)
+        if missing:
+            raise TypeError(f"{type(self).__name__} is missing required fields {sorted(missing)}")
+        for field in self._fields:
+            setattr(self, field, kwargs.get(field))
+
+    def to_dict(self) -> tp.Dict[str, tp.Any]:
+        return {field: getattr(self, field) for field in self._fields}
+
+    def __eq__(self, other: tp.Any) -> bool:
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(" + ", ".join(f"{field}={getattr(self, field)!r}" for field in self._fields) + ")"
+
+
+def make_record_class(schema: tp.Dict[str, tp.Any], name: str = "Record") -> tp.Type[Record]:
+    """
+    Returns record class with a slot for each property of the object schema (or of the items of the array schema).
+    Properties missing in the response are None, unknown ones are dropped.
+    :param schema: json schema of an object (e.g. `schema` of `conf/prompt/german.yaml`)
+    :param name: name of the class
+    """
+    if schema.get("type") == "array":
+        schema = schema.get("items", {})
+    fields = tuple(schema.get("properties", {}))
+    if not fields:
+        raise ValueError("Schema of a record must be an object with properties")
+    invalid_fields = [field for field in fields if not field.isidentifier() or keyword.iskeyword(field)]
+    if invalid_fields:
+        raise ValueError(f"Properties {invalid_fields} can't be record fields, use dicts (structured=True) instead")
+    return type(name, (Record,), {"__slots__": fields, "_fields": fields, "_required": frozenset(schema.get("required", ()))})
+
+
+def build_output(output_type: tp.Optional[tp.Callable[..., tp.Any]], parsed: tp.Any) -> tp.Any:
+    """
+    Builds typed result from parsed json
+    :param output_type: class built from json objects with `output_type(**obj)` (e.g. dataclass or record class),
+        None means parsed json as is
+    :param parsed: parsed json, arrays become lists of `output_type` instances
+    :return: result (raises TypeError if json doesn't fit `output_type`)
+    """
+    if output_type is None:
+        return parsed
+    if isinstance(parsed, list):
+        return [build_output(output_type, item) for item in parsed]
+    if not isinstance(parsed, dict):
+        raise TypeError(f"Expected json object for {getattr(output_type, '__name__', output_type)}, got {type(parsed).__name__}")
+    return output_type(**parsed)
+
+
+def to_json_compatible(result: tp.Any) -> tp.Any:
+    """
+    Converts structured result back to plain json (e.g. to write it to a result file)
+    :param result: text, parsed json, dataclass, record or list of them
+    """
+    if isinstance(result, Record):
+        return result.to_dict()
+    if dataclasses.is_dataclass(result) and not isinstance(result, type):
+        return dataclasses.asdict(result)
+    if isinstance(result, list):
+        return [to_json_compatible(item) for item in result]
+    return result
@@ -0,0 +1,233 @@
+"""
+Token counting and prompt-length budgeting. Uses tiktoken when installed (its encodings are downloaded once
+and cached locally, see TIKTOKEN_CACHE_DIR), otherwise a rough estimate of 4 characters per token.
+"""
+import functools
+import logging
+import math
+import typing as tp
+from importlib.util import find_spec
+
+from .prompter import Prompter, TemplatePrompter
+
+logger = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 4
+DEFAULT_ENCODING = "cl100k_base"
+
+
+class PromptTooLongError(ValueError):
+    """Raised when a prompt doesn't fit into the model context."""
+    pass
+
+
+class TokenCounter:
+    """Counts tokens of texts for a model. Counts of repeated texts (e.g. static parts of templates) are cached."""
+    def __init__(self, model: tp.Optional[str] = None, encoding: tp.Optional[str] = None, cache_size: int = 4096) -> None:
+        """
+        :param model: name of the model (e.g. "gpt-3.5-turbo"), used to pick the tiktoken encoding
+        :param encoding: name of tiktoken encoding, overrides the model one (e.g. "cl100k_base")
+        :param cache_size: number of cached counts
+        """
+        self.model = model
+        self._encoding = self._load_encoding(model, encoding)
+        self.is_exact = self._encoding is not None
+        self.count = functools.lru_cache(maxsize=cache_size)(self._count)
+
+    @staticmethod
+    def _load_encoding(model: tp.Optional[str], encoding: tp.Optional[str]) -> tp.Any:
+        if find_spec("tiktoken") is None:
+            logger.warning("tiktoken is not installed, token counts are estimated as characters / 4")
+            return None
+        import tiktoken
+        if encoding is None and model is not None:
+            try:
+                return tiktoken.encoding_for_model(model)
+            except KeyError:
+                logger.warning(f"Unknown model {model!r} for tiktoken, using {DEFAULT_ENCODING!r}")
+        return tiktoken.get_encoding(encoding or DEFAULT_ENCODING)
+
+    @classmethod
+    def from_config(cls, model_cfg: tp.Any) -> "TokenCounter":
+        """
+        Creates counter from model config (see `conf/model/*.yaml`)
+        :param model_cfg: config with `model` and optional `encoding` fields
+        """
+        return cls(model=model_cfg.get("model"), encoding=model_cfg.get("encoding"))
+
+    def _count(self, text: str) -> int:
+        """Returns number of tokens in text."""
+        if self._encoding is None:
+            return math.ceil(len(text) / CHARS_PER_TOKEN)
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """
+        Cuts text to at most `max_tokens` tokens
+        :param text: text to truncate
+        :param max_tokens: maximal number of tokens
+        :return: text prefix
+        """
+        if max_tokens <= 0:
+            return ""
+        if self._encoding is None:
+            return text[:max_tokens * CHARS_PER_TOKEN]
+        tokens = self._encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return self._encoding.decode(tokens[:max_tokens])
+
+    def count_prompt(self, prompter: TemplatePrompter, **kwargs: tp.Any) -> int:
+        """
+        Fast estimate of tokens in rendered prompt: cached count of the static part of the template plus counts of the fields.
+        May differ from the exact count by a few tokens because of merges on the field boundaries.
+        :param prompter: prompter
+        :param kwargs: values of the template fields
+        """
+        template = prompter.compiled_template
+        static_tokens = self.count(template.static_text)
+        return static_tokens + sum(self.count(str(kwargs[name])) * template.field_counts[name] for name in template.field_names)
+
+
+class TokenBudget:
+    """
+    Pre-flight check of prompts against the model context.
+    Policies for prompts which don't fit:
+      - "error": raise PromptTooLongError
+      - "skip": return None
+      - "truncate": cut the longest template fields until the prompt fits
+    """
+    POLICIES = ("error", "skip", "truncate")
+
+    def __init__(self, counter: TokenCounter, context_length: int, max_output_tokens: int = 0,
+                 policy: str = "truncate", safety_margin: int = 16) -> None:
+        """
+        :param counter: token counter of the model
+        :param context_length: context length of the model in tokens
+        :param max_output_tokens: tokens reserved for the response
+        :param policy: what to do with prompts which don't fit ("error", "skip" or "truncate")
+        :param safety_margin: tokens reserved for chat formatting and estimation error
+        """
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown policy {policy!r}, expected one of {self.POLICIES}")
+        self.counter = counter
+        self.context_length = context_length
+        self.max_output_tokens = max_output_tokens
+        self.policy = policy
+        self.safety_margin = safety_margin
+
+    @classmethod
+    def from_config(cls, model_cfg: tp.Any, policy: str = "truncate") -> "TokenBudget":
+        """
+        Creates budget from model config (see `conf/model/*.yaml`)
+        :param model_cfg: config with `model`, `context_length` and optional `encoding`, `max_output_tokens` fields
+        :param policy: what to do with prompts which don't fit
+        """
+        return cls(counter=TokenCounter.from_config(model_cfg),
+                   context_length=model_cfg.context_length,
+                   max_output_tokens=model_cfg.get("max_output_tokens", 0) or 0,
+                   policy=policy)
+
+    @property
+    def max_prompt_tokens(self) -> int:
+        return self.context_length - self.max_output_tokens - self.safety_margin
+
+    def fits(self, prompt: str) -> bool:
+        """Checks whether rendered prompt fits into the budget."""
+        return self.counter.count(prompt) <= self.max_prompt_tokens
+
+    def _too_long(self, n_tokens: int) -> None:
+        """Applies "error" policy."""
+        raise PromptTooLongError(f"Prompt has ~{n_tokens} tokens, budget is {self.max_prompt_tokens}")
+
+    def fit(self, prompter: TemplatePrompter, **kwargs: tp.Any) -> tp.Optional[str]:
+        """
+        Renders prompt making sure it fits into the budget (see policies in the class docstring)
+        :param prompter: prompter
+        :param kwargs: values of the template fields
+        :return: prompt or None if it is skipped
+        """
+        n_tokens = self.counter.count_prompt(prompter, **kwargs)
+        if n_tokens <= self.max_prompt_tokens:
+            return prompter.get_prompt(**kwargs)
+        if self.policy == "skip":
+            logger.warning(f"Skipping prompt with ~{n_tokens} tokens, budget is {self.max_prompt_tokens}")
+            return None
+        if self.policy == "error":
+            self._too_long(n_tokens)
+
+        template = prompter.compiled_template
+        values = {name: str(kwargs[name]) for name in template.field_names}
+        field_tokens = {name: self.counter.count(value) * template.field_counts[name] for name, value in values.items()}
+        excess = n_tokens - self.max_prompt_tokens
+        for name in sorted(field_tokens, key=field_tokens.get, reverse=True):
+            if excess <= 0:
+                break
+            n_occurrences = template.field_counts[name]
+            cut = min(field_tokens[name], math.ceil(excess / n_occurrences) * n_occurrences)
+            values[name] = self.counter.truncate(values[name], (field_tokens[name] - cut) // n_occurrences)
+            excess -= cut
+        if excess > 0:
+            self._too_long(n_tokens)
+        logger.warning(f"Truncated prompt from ~{n_tokens} tokens to the budget of {self.max_prompt_tokens}")
+        return prompter.get_prompt(**{**kwargs, **values})
+
+
+class BudgetedPrompter(Prompter):
+    """TemplatePrompter which makes sure every prompt fits into the token budget."""
+    def __init__(self, prompter: TemplatePrompter, budget: TokenBudget) -> None:
+        """
+        :param prompter: prompter to wrap
+        :param budget: token budget (its policy decides what to do with too long prompts)
+        """
+        self.prompter = prompter
+        self.budget = budget
+
+    @property
+    def field_names(self) -> tp.Tuple[str, ...]:
+        return self.prompter.field_names
+
+    def get_prompt(self, **kwargs: tp.Any) -> tp.Optional[str]:
+        return self.budget.fit(self.prompter, **kwargs)
+
+
+def estimate_cost(prompt_tokens: int, completion_tokens: int, model_cfg: tp.Any) -> tp.Optional[float]:
+    """
+    Estimates cost of requests in dollars
+    :param prompt_tokens: number of prompt tokens
+    :param completion_tokens: number of completion tokens
+    :param model_cfg: config with `price_per_1k_prompt_tokens` and `price_per_1k_completion_tokens` fields
+    :return: cost or None if prices are unknown
+    """
+    prompt_price = model_cfg.get("price_per_1k_prompt_tokens")
+    completion_price = model_cfg.get("price_per_1k_completion_tokens")
+    if prompt_price is None or completion_price is None:
+        return None
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+def estimate_run(prompter: TemplatePrompter, rows: tp.Iterable[tp.Dict[str, tp.Any]], counter: TokenCounter,
+                 model_cfg: tp.Any, completion_tokens_per_request: int = 0) -> tp.Dict[str, tp.Any]:
+    """
+    Estimates size and cost of the run before it starts
+    :param prompter: prompter
+    :param rows: values of the template fields for each request
+    :param counter: token counter of the model
+    :param model_cfg: model config (see `estimate_cost`)
+    :param completion_tokens_per_request: expected number of response tokens
+    :return: number of requests, prompt/completion tokens, the longest prompt and cost in dollars (None if unknown)
+    """
+    n_requests = prompt_tokens = max_prompt_tokens = 0
+    for row in rows:
+        n_tokens = counter.count_prompt(prompter, **row)
+        n_requests += 1
+        prompt_tokens += n_tokens
+        max_prompt_tokens = max(max_prompt_tokens, n_tokens)
+    completion_tokens = n_requests * completion_tokens_per_request
+    return {
+        "n_requests": n_requests,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "max_prompt_tokens": max_prompt_tokens,
+        "cost": estimate_cost(prompt_tokens, completion_tokens, model_cfg),
+    }
@@ -1,52 +1,116 @@
 """
 Helper functions for reading and printing configs
+hydra and omegaconf are imported on the first use, importing this module is cheap and prints nothing
+Composed configs are cached per process (see `read_config`), the cache is invalidated when a config file changes
 """
-from omegaconf import OmegaConf
 import json
+import threading
 import typing as tp
 import os
-from hydra import initialize_config_dir, compose
-from copy import deepcopy
 import logging
 
-__ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../" * 2))
+if tp.TYPE_CHECKING:
+    from omegaconf import OmegaConf
+
+logger = logging.getLogger(__name__)
+
+__ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 __CONFIG_DIR = os.path.join(__ROOT_DIR, "conf")
-print(f"Added {__ROOT_DIR!r} to PYTHONPATH")
-print(f"Config dir: {__CONFIG_DIR!r}")
+LONG_FIELD_LENGTH = 150
+
+_CacheKey = tp.Tuple[str, tp.Tuple[str, ...]]
+_config_cache: tp.Dict[_CacheKey, tp.Tuple[tp.Tuple[tp.Tuple[str, int], ...], tp.Dict[str, tp.Any]]] = {}
+_config_cache_lock = threading.Lock()
+
+
+def _config_files_signature(config_dir: str) -> tp.Tuple[tp.Tuple[str, int], ...]:
+    """Paths and mtimes of all yaml files in the config directory (any of them can be pulled in by the overrides)."""
+    signature = []
+    for dir_path, _, file_names in os.walk(config_dir):
+        for file_name in file_names:
+            if file_name.endswith((".yaml", ".yml")):
+                path = os.path.join(dir_path, file_name)
+                signature.append((path, os.stat(path).st_mtime_ns))
+    return tuple(sorted(signature))
+
 
+def _compose_container(overrides: tp.Sequence[str]) -> tp.Dict[str, tp.Any]:
+    """Composes config inside an initialized hydra context and resolves it to plain containers."""
+    from hydra import compose
+    from omegaconf import OmegaConf
 
-def read_config(config_dir: str = __CONFIG_DIR, overrides: tp.Optional[tp.List[str]] = None) -> OmegaConf:
+    return OmegaConf.to_container(compose(config_name="config", overrides=list(overrides)), resolve=True)
+
+
+def read_configs(list_of_overrides: tp.Sequence[tp.Optional[tp.Sequence[str]]], config_dir: str = __CONFIG_DIR,
+                 use_cache: bool = True) -> tp.List["OmegaConf"]:
     """
+    Reads many configs (e.g. a parameter sweep over `setup` and `model`), hydra is initialized once for all of them
+    :@param list_of_overrides: list of overrides for each config (e.g. [["model=gpt_4"], ["model=gpt_3.5_turbo"]])
     :@param config_dir: path to config directory
-    :@param overrides: list of overrides (e.g. ["dataset=model_eval"])
-    :@param set_to_none_empty_with_warn: if True, set empty values to None and print warning
-    :@return: OmegaConf object
+    :@param use_cache: if True, configs composed before with the same overrides are reused while config files don't change
+    :@return: list of OmegaConf objects in the order of `list_of_overrides`, each is a fresh object safe to modify
     """
+    from hydra import initialize_config_dir
+    from omegaconf import OmegaConf
+
     config_dir = os.path.abspath(config_dir)
-    with initialize_config_dir(config_dir=config_dir, version_base=None):
-        cfg = compose(config_name="config", overrides=overrides)
-        cfg = OmegaConf.create(OmegaConf.to_yaml(cfg, resolve=True))
-    return cfg
-
-def _remove_long_fields_recurse(cfg: OmegaConf) -> OmegaConf:
-    """Remove long fields from config."""
-    for key, value in cfg.items():
-        if isinstance(value, str) and len(value) > 150:
-            cfg[key] = "..."
-        elif hasattr(value, "items"):
-            cfg[key] = _remove_long_fields_recurse(value)
-        elif isinstance(value, list):
-            cfg[key] = [_remove_long_fields_recurse(x) if isinstance(x, dict) else x for x in value]
-    return cfg
-
-def _remove_long_fields(cfg: OmegaConf) -> OmegaConf:
-    """Remove long fields from config."""
-    cfg = deepcopy(cfg)
-    return _remove_long_fields_recurse(cfg)
-
-
-def pprint_config(cfg: OmegaConf, show_long_fields: bool = False) -> None:
-    """Pretty print config. By default, it doesn't show long fields (str of length > 100)."""
+    keys = [(config_dir, tuple(overrides or ())) for overrides in list_of_overrides]
+    signature = _config_files_signature(config_dir) if use_cache else ()
+    containers: tp.Dict[_CacheKey, tp.Dict[str, tp.Any]] = {}
+    if use_cache:
+        with _config_cache_lock:
+            for key in keys:
+                cached = _config_cache.get(key)
+                if cached is not None and cached[0] == signature:
+                    containers[key] = cached[1]
+
+    missing = [key for key in dict.fromkeys(keys) if key not in containers]
+    if missing:
+        logger.debug(f"Composing {len(missing)} configs from {config_dir!r}")
+        with initialize_config_dir(config_dir=config_dir, version_base=None):
+            for key in missing:
+                containers[key] = _compose_container(key[1])
+        if use_cache:
+            with _config_cache_lock:
+                _config_cache.update((key, (signature, containers[key])) for key in missing)
+    return [OmegaConf.create(containers[key]) for key in keys]
+
+
+def read_config(config_dir: str = __CONFIG_DIR, overrides: tp.Optional[tp.List[str]] = None,
+                use_cache: bool = True) -> "OmegaConf":
+    """
+    :@param config_dir: path to config directory
+    :@param overrides: list of overrides (e.g. ["dataset=model_eval"])
+    :@param use_cache: if True, the config composed before with the same overrides is reused while config files don't change
+    :@return: resolved OmegaConf object (a fresh one on every call, safe to modify)
+    """
+    logger.debug(f"Reading config from {config_dir!r} with overrides {overrides}")
+    return read_configs([overrides], config_dir=config_dir, use_cache=use_cache)[0]
+
+
+def clear_config_cache() -> None:
+    """Drops configs cached by `read_config` and `read_configs`."""
+    with _config_cache_lock:
+        _config_cache.clear()
+
+
+def _remove_long_fields(value: tp.Any) -> tp.Any:
+    """Returns copy of plain config container with long strings replaced by "..."."""
+    if isinstance(value, str) and len(value) > LONG_FIELD_LENGTH:
+        return "..."
+    if isinstance(value, dict):
+        return {key: _remove_long_fields(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_remove_long_fields(item) for item in value]
+    return value
+
+
+def pprint_config(cfg: "OmegaConf", show_long_fields: bool = False) -> None:
+    """Pretty print config. By default, it doesn't show long fields (str of length > LONG_FIELD_LENGTH)."""
+    from omegaconf import OmegaConf
+
+    container = OmegaConf.to_container(cfg)
     if not show_long_fields:
-        cfg = _remove_long_fields(cfg)
-    print(json.dumps(OmegaConf.to_container(cfg), indent=2, ensure_ascii=False))
+        container = _remove_long_fields(container)
+    print(json.dumps(container, indent=2, ensure_ascii=False))
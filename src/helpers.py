@@ -1,9 +1,232 @@
 """
 Set of helper functions
 """
+import asyncio
+import functools
+import hashlib
+import itertools
+import re
+import string
 import typing as tp
+import collections
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+T = tp.TypeVar("T")
+R = tp.TypeVar("R")
+
+class CompiledTemplate:
+    """
+    `str.format` template parsed once. Knows its field names, rendering is a join of precomputed literal parts.
+    Templates with conversions, format specs or attribute/index access (e.g. "{x!r}", "{x:>5}", "{x.y}")
+    are rendered with `str.format`.
+    """
+    def __init__(self, template: str) -> None:
+        """
+        :param template: template in `str.format` syntax
+        """
+        self.template = template
+        self._parts: tp.List[tp.Optional[str]] = []
+        self._slots: tp.List[tp.Tuple[int, str]] = []
+        self.is_simple = True
+
+        field_names = []
+        for literal, field_name, format_spec, conversion in string.Formatter().parse(template):
+            if literal:
+                self._parts.append(literal)
+            if field_name is None:
+                continue
+            if not field_name.isidentifier() or format_spec or conversion:
+                self.is_simple = False
+                field_name = re.split(r"[.\[]", field_name, maxsplit=1)[0]
+            if field_name and not field_name.isdigit():  # positional fields are not names
+                field_names.append(field_name)
+            self._slots.append((len(self._parts), field_name))
+            self._parts.append(None)
+        self.field_names: tp.Tuple[str, ...] = tuple(dict.fromkeys(field_names))
+        self.field_counts: tp.Dict[str, int] = dict(collections.Counter(field_names))
+        self.static_text = "".join(part for part in self._parts if part is not None)
+
+    def render(self, **kwargs: tp.Any) -> str:
+        """
+        Render template. Redundant arguments are ignored, a missing one raises KeyError (as `str.format` does)
+        """
+        if not self.is_simple:
+            return self.template.format(**kwargs)
+        parts = self._parts.copy()
+        for part_id, field_name in self._slots:
+            value = kwargs[field_name]
+            parts[part_id] = value if type(value) is str else format(value)
+        return "".join(parts)
+
+    def render_many(self, rows: tp.Union[tp.Iterable[tp.Mapping[str, tp.Any]], tp.Any]) -> tp.List[str]:
+        """
+        Render template for each row
+        :param rows: list of dicts or pandas DataFrame (only columns used by the template are read)
+        :return: rendered templates in the order of rows
+        """
+        if hasattr(rows, "columns"):
+            columns = [rows[field_name].tolist() for field_name in self.field_names]
+            rows = (dict(zip(self.field_names, values)) for values in zip(*columns))
+        return [self.render(**row) for row in rows]
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(field_names={self.field_names})"
+
+
+@functools.lru_cache(maxsize=256)
+def compile_template(template: str) -> CompiledTemplate:
+    """Returns compiled template, compiled templates are cached"""
+    return CompiledTemplate(template)
+
 
 def smart_format(template, **kwargs: tp.Any) -> str:
     """Smart format. If there is a redundant key among the arguments, it will be ignored"""
-    actual_keys = [key for key in kwargs if "{" + key + "}" in template]
-    return template.format(**{key: kwargs[key] for key in actual_keys})
\ No newline at end of file
+    return compile_template(template).render(**kwargs)
+
+def stable_shard(key: tp.Any, n_shards: int, salt: str = "") -> int:
+    """
+    Returns shard of the key, stable across processes and machines (unlike built-in `hash` of str)
+    :param key: key (e.g. id of a row), converted to str
+    :param n_shards: number of shards
+    :param salt: salt to get a split independent of the splits with other salts
+    :return: shard index in [0, n_shards)
+    """
+    digest = hashlib.blake2b(f"{salt}{key}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % n_shards
+
+def deduplicate(items: tp.Iterable[T], key: tp.Optional[tp.Callable[[T], tp.Hashable]] = None) -> tp.Tuple[tp.List[T], tp.List[int]]:
+    """
+    Returns unique items in the order of their first occurrence and index of the unique item for each of the items,
+    so results computed for the unique items fan back out with `[results[i] for i in inverse]`
+    :param items: items (hashable unless `key` is given)
+    :param key: function returning hashable key of an item, items with equal keys are duplicates (default: item itself)
+    :return: unique items and the inverse indices
+    """
+    positions: tp.Dict[tp.Hashable, int] = {}
+    unique: tp.List[T] = []
+    inverse: tp.List[int] = []
+    for item in items:
+        item_key = item if key is None else key(item)
+        position = positions.get(item_key)
+        if position is None:
+            position = positions[item_key] = len(unique)
+            unique.append(item)
+        inverse.append(position)
+    return unique, inverse
+
+def unordered_thread_map(func: tp.Callable[[T], R], items: tp.Iterable[T], max_concurrency: int = 1) -> tp.Iterator[tp.Tuple[int, R]]:
+    """
+    Lazily maps func over items on a thread pool, yielding results as soon as they are ready.
+    `max_concurrency` calls are kept running: a slow call doesn't hold back the next items,
+    and items are consumed only as calls finish, so memory stays bounded for arbitrarily long iterables.
+    :param func: function to apply
+    :param items: items to map over
+    :param max_concurrency: maximal number of calls running at the same time
+    :return: iterator over positions of items in `items` and their results in completion order
+    """
+    for item_id, future in _iter_completed_futures(func, items, max_concurrency):
+        yield item_id, future.result()
+
+def _iter_completed_futures(func: tp.Callable[[T], R], items: tp.Iterable[T],
+                            max_concurrency: int) -> tp.Iterator[tp.Tuple[int, Future]]:
+    """
+    Yields positions of items and finished futures of func(item) in completion order, keeping `max_concurrency` calls running
+    """
+    if max_concurrency < 1:
+        raise ValueError(f"max_concurrency must be positive, got {max_concurrency}")
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        running: tp.Dict[Future, int] = {}
+        n_submitted = 0
+        while True:
+            for item in itertools.islice(items, max_concurrency - len(running)):
+                running[executor.submit(func, item)] = n_submitted
+                n_submitted += 1
+            if not running:
+                return
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield running.pop(future), future
+
+def ordered_thread_map(func: tp.Callable[[T], R], items: tp.Iterable[T], max_concurrency: int = 1) -> tp.Iterator[R]:
+    """
+    Lazily maps func over items on a thread pool, yielding results in input order.
+    `max_concurrency` calls are kept running; results finished ahead of a slow call are buffered until it is done,
+    so memory is bounded by the number of calls finished meanwhile (use `unordered_thread_map` if the order doesn't matter).
+    :param func: function to apply
+    :param items: items to map over
+    :param max_concurrency: maximal number of calls running at the same time
+    :return: iterator over results in input order
+    """
+    if max_concurrency < 1:
+        raise ValueError(f"max_concurrency must be positive, got {max_concurrency}")
+    if max_concurrency == 1:
+        yield from map(func, items)
+        return
+
+    finished: tp.Dict[int, Future] = {}
+    next_id = 0
+    for item_id, future in _iter_completed_futures(func, items, max_concurrency):
+        finished[item_id] = future
+        while next_id in finished:
+            yield finished.pop(next_id).result()
+            next_id += 1
+
+async def unordered_async_map(func: tp.Callable[[T], tp.Awaitable[R]], items: tp.Iterable[T],
+                              max_concurrency: int = 1) -> tp.AsyncIterator[tp.Tuple[int, R]]:
+    """
+    Async counterpart of `unordered_thread_map`: runs coroutines func(item) as tasks of the current event loop,
+    keeping `max_concurrency` of them running and yielding results as soon as they are ready.
+    :param func: coroutine function to apply
+    :param items: items to map over
+    :param max_concurrency: maximal number of coroutines running at the same time
+    :return: async iterator over positions of items in `items` and their results in completion order
+    """
+    async for item_id, task in _iter_completed_tasks(func, items, max_concurrency):
+        yield item_id, task.result()
+
+async def _iter_completed_tasks(func: tp.Callable[[T], tp.Awaitable[R]], items: tp.Iterable[T],
+                                max_concurrency: int) -> tp.AsyncIterator[tp.Tuple[int, asyncio.Task]]:
+    """
+    Yields positions of items and finished tasks of func(item) in completion order, keeping `max_concurrency` tasks running
+    Tasks still running when the iterator is closed are cancelled
+    """
+    if max_concurrency < 1:
+        raise ValueError(f"max_concurrency must be positive, got {max_concurrency}")
+    items = iter(items)
+    running: tp.Dict[asyncio.Task, int] = {}
+    n_submitted = 0
+    try:
+        while True:
+            for item in itertools.islice(items, max_concurrency - len(running)):
+                running[asyncio.ensure_future(func(item))] = n_submitted
+                n_submitted += 1
+            if not running:
+                return
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield running.pop(task), task
+    finally:
+        for task in running:
+            task.cancel()
+
+async def ordered_async_map(func: tp.Callable[[T], tp.Awaitable[R]], items: tp.Iterable[T], max_concurrency: int = 1) -> tp.AsyncIterator[R]:
+    """
+    Async counterpart of `ordered_thread_map`: runs coroutines func(item) as tasks of the current event loop,
+    keeping `max_concurrency` of them running and yielding results in input order (finished ones are buffered).
+    :param func: coroutine function to apply
+    :param items: items to map over
+    :param max_concurrency: maximal number of coroutines running at the same time
+    :return: async iterator over results in input order
+    """
+    finished: tp.Dict[int, asyncio.Task] = {}
+    next_id = 0
+    completed = _iter_completed_tasks(func, items, max_concurrency)
+    try:
+        async for item_id, task in completed:
+            finished[item_id] = task
+            while next_id in finished:
+                yield finished.pop(next_id).result()
+                next_id += 1
+    finally:
+        await completed.aclose()
@@ -0,0 +1,108 @@
+"""
+Pluggable json serializers: orjson or ujson when installed, stdlib json as fallback.
+"""
+import json
+import typing as tp
+from importlib.util import find_spec
+
+BACKENDS_PRIORITY = ("orjson", "ujson", "json")
+
+
+class JsonBackend:
+    """Stdlib json backend. Other backends override `loads`/`dumps`."""
+    name = "json"
+    supports_buffer = False  # whether `loads` accepts memoryview (e.g. of a mmap-ed file)
+    decode_errors: tp.Tuple[tp.Type[Exception], ...] = (ValueError,)
+
+    def loads(self, data: tp.Union[str, bytes]) -> tp.Any:
+        """
+        Parses json.
+        :param data: json text (str or utf-8 bytes)
+        """
+        return json.loads(data)
+
+    def dumps(self, obj: tp.Any, indent: tp.Optional[int] = None) -> str:
+        """
+        Serializes object to json without escaping non-ascii characters.
+        :param obj: object to serialize
+        :param indent: indentation (None means compact output)
+        """
+        if indent is None:
+            return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+        return json.dumps(obj, ensure_ascii=False, indent=indent)
+
+
+class OrjsonBackend(JsonBackend):
+    """orjson backend. orjson supports only 2 spaces indentation, other indents fall back to stdlib."""
+    name = "orjson"
+    supports_buffer = True
+
+    def __init__(self) -> None:
+        import orjson
+        self._orjson = orjson
+        self._options = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        self.decode_errors = (orjson.JSONDecodeError, ValueError)
+
+    def loads(self, data: tp.Union[str, bytes, memoryview]) -> tp.Any:
+        return self._orjson.loads(data)
+
+    def dumps(self, obj: tp.Any, indent: tp.Optional[int] = None) -> str:
+        if indent is None:
+            return self._orjson.dumps(obj, option=self._options).decode("utf-8")
+        if indent == 2:
+            return self._orjson.dumps(obj, option=self._options | self._orjson.OPT_INDENT_2).decode("utf-8")
+        return super().dumps(obj, indent=indent)
+
+
+class UjsonBackend(JsonBackend):
+    """ujson backend."""
+    name = "ujson"
+
+    def __init__(self) -> None:
+        import ujson
+        self._ujson = ujson
+
+    def loads(self, data: tp.Union[str, bytes]) -> tp.Any:
+        return self._ujson.loads(data)
+
+    def dumps(self, obj: tp.Any, indent: tp.Optional[int] = None) -> str:
+        return self._ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False, indent=indent or 0)
+
+
+_BACKEND_CLASSES: tp.Dict[str, tp.Type[JsonBackend]] = {
+    "orjson": OrjsonBackend,
+    "ujson": UjsonBackend,
+    "json": JsonBackend,
+}
+_instances: tp.Dict[str, JsonBackend] = {}
+_default_backend_name: tp.Optional[str] = None
+
+
+def available_json_backends() -> tp.List[str]:
+    """Returns names of installed backends in the order of preference."""
+    return [name for name in BACKENDS_PRIORITY if name == "json" or find_spec(name) is not None]
+
+
+def set_default_json_backend(name: tp.Optional[str]) -> None:
+    """
+    Sets backend used when no backend is passed explicitly.
+    :param name: one of "orjson", "ujson", "json" (None means the fastest installed one)
+    """
+    global _default_backend_name
+    if name is not None and name not in _BACKEND_CLASSES:
+        raise ValueError(f"Unknown json backend {name!r}, expected one of {list(_BACKEND_CLASSES)}")
+    _default_backend_name = name
+
+
+def get_json_backend(name: tp.Optional[str] = None) -> JsonBackend:
+    """
+    Returns json backend.
+    :param name: one of "orjson", "ujson", "json" (None means the default one, see `set_default_json_backend`)
+    :return: backend
+    """
+    name = name or _default_backend_name or available_json_backends()[0]
+    if name not in _instances:
+        if name not in _BACKEND_CLASSES:
+            raise ValueError(f"Unknown json backend {name!r}, expected one of {list(_BACKEND_CLASSES)}")
+        _instances[name] = _BACKEND_CLASSES[name]()
+    return _instances[name]
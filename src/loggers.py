@@ -1,5 +1,17 @@
+import copy
+import gzip
 import logging
+import logging.handlers
 import os
+import queue
+import re
+import shutil
+import threading
+import time
+import typing as tp
+from datetime import datetime, timezone
+
+from src.json_backends import get_json_backend
 
 DEFAULT_FORMAT = "%(levelname)s from %(name)s (%(filename)s:%(lineno)d):\n%(message)s "
 DEFAULT_PATH_TO_FILE = os.path.join(os.path.dirname(__file__), '..', 'log.log')
@@ -21,49 +33,213 @@ class CustomFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + format + reset
     }
 
+    def __init__(self) -> None:
+        super().__init__(DEFAULT_FORMAT)
+        self._formatters = {level: logging.Formatter(fmt) for level, fmt in self.FORMATS.items()}
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
+        formatter = self._formatters.get(record.levelno)
+        if formatter is None:
+            formatter = self._formatters[record.levelno] = logging.Formatter(DEFAULT_FORMAT)
         return formatter.format(record)
 
 
+class JsonFormatter(logging.Formatter):
+    """Formats records as json lines: time, level, logger, message, source location and exception (if any)"""
+    def __init__(self) -> None:
+        super().__init__()
+        self._json_backend = get_json_backend()
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "file": record.filename,
+            "line": record.lineno,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return self._json_backend.dumps(entry)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Passes at most `max_records` similar records per `period` seconds, the rest are dropped.
+    Records are similar if they come from the same logger with the same level and message up to numbers
+    (e.g. "Failing fast during attempt 1" and "... attempt 2"). The first record passed after a drop tells how many were dropped.
+    """
+    _numbers_pattern = re.compile(r"\d+")
+    _max_windows = 1024  # expired windows are dropped when there are more of them
+
+    def __init__(self, max_records: int = 10, period: float = 60.0, max_key_length: int = 200) -> None:
+        """
+        :@param max_records: number of similar records passed per period
+        :@param period: length of the period in seconds
+        :@param max_key_length: only this prefix of the message is compared
+        """
+        super().__init__()
+        self.max_records = max_records
+        self.period = period
+        self.max_key_length = max_key_length
+        self._windows: tp.Dict[tp.Tuple[str, int, str], tp.List[tp.Any]] = {}  # key -> [window start, passed, dropped]
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.name, record.levelno, self._numbers_pattern.sub("#", str(record.msg)[:self.max_key_length]))
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.period:
+                if window is None and len(self._windows) >= self._max_windows:
+                    self._windows = {k: w for k, w in self._windows.items() if now - w[0] < self.period}
+                dropped = window[2] if window is not None else 0
+                self._windows[key] = [now, 1, 0]
+                if dropped:
+                    record.msg = f"{record.msg} ({dropped} similar messages were dropped)"
+                return True
+            if window[1] < self.max_records:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+def _gzip_rotator(source: str, dest: str) -> None:
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class _LazyFileHandler(logging.handlers.RotatingFileHandler):
+    """File handler which creates the file on the first record, not at construction (importing modules does no I/O).
+    The file is cleared once per process, handlers of several loggers can share it.
+    With `max_bytes` the file is rotated to `<file>.1.gz`, `<file>.2.gz`, ... (plain `<file>.1`, ... without `compress`)"""
+    _cleared_paths: tp.Set[str] = set()
+    _cleared_lock = threading.Lock()
+
+    def __init__(self, file_path: str, max_bytes: int = 0, backup_count: int = 0, compress: bool = True) -> None:
+        super().__init__(file_path, mode='a', maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        if compress:
+            self.namer = lambda name: name + ".gz"
+            self.rotator = _gzip_rotator
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        """Rotates once the file reaches `max_bytes` (the base class formats every record twice to check it in advance)"""
+        if self.maxBytes <= 0:
+            return False
+        if self.stream is None:
+            self.stream = self._open()
+        return self.stream.tell() >= self.maxBytes
+
+    def _open(self) -> tp.IO[str]:
+        with self._cleared_lock:
+            if self.baseFilename not in self._cleared_paths:
+                self._cleared_paths.add(self.baseFilename)
+                open(self.baseFilename, 'w').close()
+        return super()._open()
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler with its own listener thread writing records to `handler`, the thread starts on the first record.
+    The caller only formats the message and puts the record into the queue. Closing the handler (e.g. at exit) stops
+    the listener after all queued records are written."""
+    def __init__(self, handler: logging.Handler) -> None:
+        super().__init__(queue.SimpleQueue())
+        self.handler = handler
+        self.listener = logging.handlers.QueueListener(self.queue, handler, respect_handler_level=True)
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if not self._started:
+            with self._start_lock:
+                if not self._started:
+                    self.listener.start()
+                    self._started = True
+        super().emit(record)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Merges message with its arguments, the traceback is kept apart as text (formatters of the listener render it)"""
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = (self.handler.formatter or logging.Formatter()).formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def close(self) -> None:
+        with self._start_lock:
+            if self._started:
+                self.listener.stop()
+                self._started = False
+        self.handler.close()
+        super().close()
+
+
 def _clear_logger(logger: logging.Logger) -> None:
-    """Clear logger, i.e. remove all handlers from it and set propagate to False."""
+    """Clear logger, i.e. remove (and close) all handlers from it and set propagate to False."""
     logger.propagate = False
     for handler in logger.handlers[:]:
         logger.removeHandler(handler)
+        handler.close()
+
+
+def _set_handler(logger: logging.Logger, handler: logging.Handler, queued: bool,
+                 rate_limit: tp.Optional[RateLimitFilter]) -> None:
+    _clear_logger(logger)
+    for logger_filter in logger.filters[:]:
+        if isinstance(logger_filter, RateLimitFilter):
+            logger.removeFilter(logger_filter)
+    if rate_limit is not None:
+        logger.addFilter(rate_limit)
+    logger.addHandler(_LazyQueueHandler(handler) if queued else handler)
 
-def get_file_logger(name: str, level: int = logging.DEBUG, file_path: str = DEFAULT_PATH_TO_FILE) -> logging.Logger:
+
+def get_file_logger(name: str, level: int = logging.DEBUG, file_path: str = DEFAULT_PATH_TO_FILE, queued: bool = False,
+                    json_lines: bool = False, max_bytes: int = 0, backup_count: int = 3, compress: bool = True,
+                    rate_limit: tp.Optional[RateLimitFilter] = None) -> logging.Logger:
     """Return file logger.
     
     :@param name: logger name
     :@param level: logger level
-    :@param file_path: path to file to save logs (default: "log.txt")
-        The file will be cleared at the beginning of the program
+    :@param file_path: path to file to save logs (default: "log.log")
+        The file is created (and cleared) when the first record is written
+    :@param queued: if True, records are written by a background thread, the caller only puts them into a queue
+    :@param json_lines: if True, records are written as json lines (see `JsonFormatter`)
+    :@param max_bytes: rotate the file when it reaches this size (0 means no rotation)
+    :@param backup_count: number of rotated files to keep
+    :@param compress: if True, rotated files are compressed with gzip
+    :@param rate_limit: filter dropping repeated messages (e.g. `RateLimitFilter(max_records=10, period=60)`)
     :@return: logger
     """
     logger = logging.getLogger(name)
     logger.setLevel(level)
 
-    handler = logging.FileHandler(file_path, encoding='utf-8')
-    open(file_path, 'w').close()
+    handler = _LazyFileHandler(file_path, max_bytes=max_bytes, backup_count=backup_count, compress=compress)
     handler.setLevel(level)
 
-    formatter = logging.Formatter(DEFAULT_FORMAT)
+    formatter = JsonFormatter() if json_lines else logging.Formatter(DEFAULT_FORMAT)
     handler.setFormatter(formatter)
 
-    _clear_logger(logger)
-    logger.addHandler(handler)
+    _set_handler(logger, handler, queued, rate_limit)
     
     return logger
     
 
     
-def get_colorful_logger(name: str, level: int = logging.DEBUG) -> logging.Logger:
+def get_colorful_logger(name: str, level: int = logging.DEBUG, queued: bool = False,
+                        rate_limit: tp.Optional[RateLimitFilter] = None) -> logging.Logger:
     """Return colorful logger.
     
     :@param name: logger name
     :@param level: logger level
+    :@param queued: if True, records are written by a background thread, the caller only puts them into a queue
+    :@param rate_limit: filter dropping repeated messages (e.g. `RateLimitFilter(max_records=10, period=60)`)
     :@return: logger
     """
     logger = logging.getLogger(name)
@@ -75,7 +251,6 @@ def get_colorful_logger(name: str, level: int = logging.DEBUG) -> logging.Logger
     formatter = CustomFormatter()
     handler.setFormatter(formatter)
 
-    _clear_logger(logger)
-    logger.addHandler(handler)
+    _set_handler(logger, handler, queued, rate_limit)
     
     return logger
@@ -0,0 +1,245 @@
+"""
+In-process metrics: labeled counters and histograms with a Prometheus text dump and a json summary.
+Histograms keep counts of fixed buckets only, so an observation is a bisect under a lock and memory doesn't grow;
+quantiles are interpolated inside the buckets.
+"""
+import bisect
+import math
+import threading
+import time
+import typing as tp
+
+LabelsType = tp.Tuple[str, ...]
+
+
+def exponential_buckets(start: float, factor: float, count: int) -> tp.List[float]:
+    """
+    Returns upper bounds of buckets growing geometrically
+    :param start: upper bound of the first bucket
+    :param factor: ratio of neighbouring bounds
+    :param count: number of buckets
+    """
+    return [float(f"{start * factor ** i:.4g}") for i in range(count)]
+
+
+DEFAULT_BUCKETS = exponential_buckets(1e-6, 1.5, 52)  # 1 us .. ~16 min, quantiles within ~25%
+
+
+def _format_labels(label_names: tp.Sequence[str], label_values: tp.Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with labels."""
+    type_name = "counter"
+
+    def __init__(self, name: str, help: str = "", label_names: tp.Sequence[str] = ()) -> None:
+        """
+        :param name: metric name (e.g. "generation_attempts_total")
+        :param help: description
+        :param label_names: names of labels
+        """
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values: tp.Dict[LabelsType, float] = {}
+
+    def inc(self, *label_values: str, value: float = 1) -> None:
+        """
+        Increment counter
+        :param label_values: values of labels in the order of `label_names`
+        :param value: increment
+        """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + value
+
+    def get(self, *label_values: str) -> float:
+        return self._values.get(label_values, 0)
+
+    def to_prometheus(self) -> tp.List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, labels)} {_format_number(value)}" for labels, value in values]
+
+    def summary(self) -> tp.Dict[str, float]:
+        with self._lock:
+            return {",".join(labels) or "total": value for labels, value in sorted(self._values.items())}
+
+
+class _HistogramValues:
+    """Bucket counts of one label set. Must be accessed under the histogram lock."""
+    __slots__ = ("bucket_counts", "count", "sum", "max")
+
+    def __init__(self, n_buckets: int) -> None:
+        self.bucket_counts = [0] * (n_buckets + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+class _Timer:
+    """Context manager observing duration of the block (cheaper than a generator based one)."""
+    __slots__ = ("histogram", "label_values", "start")
+
+    def __init__(self, histogram: "Histogram", label_values: LabelsType) -> None:
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info: tp.Any) -> None:
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+class Histogram:
+    """Histogram with fixed buckets and labels."""
+    type_name = "histogram"
+
+    def __init__(self, name: str, help: str = "", label_names: tp.Sequence[str] = (),
+                 buckets: tp.Optional[tp.Sequence[float]] = None) -> None:
+        """
+        :param name: metric name (e.g. "generation_stage_seconds")
+        :param help: description
+        :param label_names: names of labels
+        :param buckets: sorted upper bounds of buckets (default: DEFAULT_BUCKETS)
+        """
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = list(buckets or DEFAULT_BUCKETS)
+        self._lock = threading.Lock()
+        self._values: tp.Dict[LabelsType, _HistogramValues] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        """
+        Record observation
+        :param value: observed value (e.g. duration in seconds)
+        :param label_values: values of labels in the order of `label_names`
+        """
+        bucket_id = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(label_values)
+            if values is None:
+                values = self._values[label_values] = _HistogramValues(len(self.buckets))
+            values.bucket_counts[bucket_id] += 1
+            values.count += 1
+            values.sum += value
+            if value > values.max:
+                values.max = value
+
+    def time(self, *label_values: str) -> tp.ContextManager[None]:
+        """
+        Returns context manager observing duration of the block in seconds
+        :param label_values: values of labels in the order of `label_names`
+        """
+        return _Timer(self, label_values)
+
+    def _quantile(self, values: _HistogramValues, q: float) -> float:
+        """Quantile interpolated linearly inside the bucket (the last bucket is bounded by the maximal value)."""
+        if values.count == 0:
+            return math.nan
+        rank = q * values.count
+        cumulative = 0
+        for bucket_id, bucket_count in enumerate(values.bucket_counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                lower = self.buckets[bucket_id - 1] if bucket_id > 0 else 0.0
+                upper = self.buckets[bucket_id] if bucket_id < len(self.buckets) else values.max
+                upper = min(upper, values.max)
+                lower = min(lower, upper)
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return values.max
+
+    def quantile(self, q: float, *label_values: str) -> float:
+        """
+        Returns estimated quantile of observations
+        :param q: quantile in [0, 1] (e.g. 0.99)
+        :param label_values: values of labels
+        """
+        with self._lock:
+            values = self._values.get(label_values)
+            return self._quantile(values, q) if values is not None else math.nan
+
+    def to_prometheus(self) -> tp.List[str]:
+        lines = []
+        with self._lock:
+            for labels, values in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip([*self.buckets, math.inf], values.bucket_counts):
+                    cumulative += bucket_count
+                    le = 'le="' + _format_number(bound if bound == math.inf else float(bound)) + '"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {_format_number(values.sum)}")
+                lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {values.count}")
+        return lines
+
+    def summary(self, quantiles: tp.Sequence[float] = (0.5, 0.95, 0.99)) -> tp.Dict[str, tp.Dict[str, float]]:
+        with self._lock:
+            return {
+                ",".join(labels) or "total": {
+                    "count": values.count,
+                    "sum": values.sum,
+                    "mean": values.sum / values.count if values.count else math.nan,
+                    **{f"p{round(q * 100)}": self._quantile(values, q) for q in quantiles},
+                    "max": values.max,
+                }
+                for labels, values in sorted(self._values.items())
+            }
+
+
+class MetricsRegistry:
+    """Set of metrics exported together."""
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._metrics: tp.Dict[str, tp.Union[Counter, Histogram]] = {}
+
+    def _register(self, metric_class: tp.Type, name: str, **kwargs: tp.Any) -> tp.Any:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, **kwargs)
+            elif not isinstance(metric, metric_class):
+                raise ValueError(f"Metric {name!r} is already registered as {metric.type_name}")
+            return metric
+
+    def counter(self, name: str, help: str = "", label_names: tp.Sequence[str] = ()) -> Counter:
+        """Returns counter, creating it on the first call."""
+        return self._register(Counter, name, help=help, label_names=label_names)
+
+    def histogram(self, name: str, help: str = "", label_names: tp.Sequence[str] = (),
+                  buckets: tp.Optional[tp.Sequence[float]] = None) -> Histogram:
+        """Returns histogram, creating it on the first call."""
+        return self._register(Histogram, name, help=help, label_names=label_names, buckets=buckets)
+
+    def to_prometheus(self) -> str:
+        """Returns all metrics in Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            if metric.help:
+                lines.append(f"# HELP {metric.name} {_escape(metric.help)}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            lines.extend(metric.to_prometheus())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> tp.Dict[str, tp.Any]:
+        """Returns all metrics as a json serializable dict (histograms as count, mean, p50, p95, p99 and max)."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.summary() for metric in metrics}
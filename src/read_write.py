@@ -1,13 +1,51 @@
 """
 Module for reading and writing data. Works with json and csv files. Also, provides functions for io with reports.
 """
-import json
+import mmap
 import os
+import stat
+import tempfile
+import threading
 import typing as tp
 import logging
-import pandas as pd
 import csv
 
+from .helpers import ordered_thread_map
+from .json_backends import get_json_backend
+
+if tp.TYPE_CHECKING:
+    import pandas as pd  # imported lazily, only functions working with DataFrames need it
+
+_umask: tp.Optional[int] = None
+_umask_lock = threading.Lock()
+
+def _get_umask() -> int:
+    """
+    Returns umask of the process, read once. On Linux it is read from /proc, elsewhere it can only be read by setting it:
+    this is done under a lock, and `write_reports` reads it before starting its threads, but files created by other threads
+    at the same moment may get permissions without the umask, so call it early in multithreaded programs.
+    """
+    global _umask
+    if _umask is None:
+        with _umask_lock:
+            if _umask is None:
+                try:
+                    with open("/proc/self/status", 'r', encoding='utf-8') as f:
+                        _umask = next(int(line.split()[1], 8) for line in f if line.startswith("Umask:"))
+                except (OSError, StopIteration, ValueError, IndexError):
+                    _umask = os.umask(0o077)
+                    os.umask(_umask)
+    return _umask
+
+def _new_file_mode(path: str) -> int:
+    """
+    Returns permissions for the file replacing `path`: those of the existing file or the default ones (0o666 & ~umask)
+    """
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        return 0o666 & ~_get_umask()
+
 def _create_dir(dirname: str) -> None:
     """
     Creates directory.
@@ -20,48 +58,120 @@ def _create_dir(dirname: str) -> None:
         logging.info(f"Creating directory {dirname!r}")
         os.makedirs(dirname, exist_ok=True)
 
-def write_reports(reports: tp.List[tp.Dict[str, tp.Any]], reports_dir: str, ignore_existing_reports: bool = False) -> None:
+def write_reports(reports: tp.Iterable[tp.Dict[str, tp.Any]], reports_dir: str, ignore_existing_reports: bool = False,
+                  max_workers: int = 8, atomic: bool = True) -> None:
     """
     Writes reports to reports_dir. Creates directory if it doesn't exist.
+    Files are written concurrently; with `atomic` each file is written to a temporary file and renamed,
+    so a crash never leaves a partially written report.
     :param reports: list of reports
     :param reports_dir: path to reports
     :param ignore_existing_reports: whether to ignore existing reports. If not, check that for each report to be rewrited exists file with same id.
+    :param max_workers: number of writing threads
+    :param atomic: whether to write files atomically
     """
     _create_dir(reports_dir)
-    for report in reports:
-        name = f"{report['id']}.json"
-        path = os.path.join(reports_dir, name)
-        if not ignore_existing_reports:
-            if not os.path.exists(path):
+    if atomic:
+        _get_umask()  # read before the writing threads start
+    if not ignore_existing_reports:
+        reports = list(reports)
+        existing_names = set(os.listdir(reports_dir))
+        for report in reports:
+            if f"{report['id']}.json" not in existing_names:
                 logging.warning(f"There is no report with id {report['id']!r} in {reports_dir!r}")
                 raise ValueError(f"Report with id {report['id']!r} didn't exist in {reports_dir!r} before.")
-        write_json(report, path, create_dirs=False)
 
-def read_json(path: str) -> tp.Union[tp.Dict, tp.List]:
+    def write_report(report: tp.Dict[str, tp.Any]) -> None:
+        path = os.path.join(reports_dir, f"{report['id']}.json")
+        write_json(report, path, create_dirs=False, atomic=atomic)
+
+    for _ in ordered_thread_map(write_report, reports, max_concurrency=max_workers):
+        pass
+
+def iter_reports(reports_dir: str, max_workers: int = 8) -> tp.Iterator[tp.Dict[str, tp.Any]]:
+    """
+    Lazily reads reports (json files) from reports_dir in the order of file names. Files are read concurrently.
+    :param reports_dir: path to reports
+    :param max_workers: number of reading threads
+    :return: iterator over reports
+    """
+    names = sorted(name for name in os.listdir(reports_dir) if name.endswith(".json"))
+    paths = (os.path.join(reports_dir, name) for name in names)
+    return ordered_thread_map(read_json, paths, max_concurrency=max_workers)
+
+def read_reports(reports_dir: str, max_workers: int = 8, lazy: bool = False) -> tp.Union[tp.List[tp.Dict[str, tp.Any]], tp.Iterator[tp.Dict[str, tp.Any]]]:
+    """
+    Reads reports (json files) from reports_dir in the order of file names. Files are read concurrently.
+    :param reports_dir: path to reports
+    :param max_workers: number of reading threads
+    :param lazy: whether to return iterator instead of list
+    :return: reports
+    """
+    reports = iter_reports(reports_dir, max_workers=max_workers)
+    return reports if lazy else list(reports)
+
+def _write_text(text: str, path: str, atomic: bool = False) -> None:
+    """
+    Writes text file.
+    :param text: text to write
+    :param path: path to file
+    :param atomic: whether to write to a temporary file in the same directory and rename it to path
+    """
+    if not atomic:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return
+
+    dirname, basename = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=f".{basename}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.chmod(tmp_path, _new_file_mode(path))  # mkstemp creates files readable only by the owner
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def read_json(path: str, json_backend: tp.Optional[str] = None) -> tp.Union[tp.Dict, tp.List]:
     """
-    Reads json file.
+    Reads json file. If the backend can parse buffers (orjson), the file is mmap-ed instead of being read into a str.
     :param path: path to json file
+    :param json_backend: "orjson", "ujson" or "json" (default: the fastest installed one, see `src.json_backends`)
     :return: json
     """
-    with open(path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    backend = get_json_backend(json_backend)
+    if not backend.supports_buffer:
+        with open(path, 'r', encoding='utf-8') as f:
+            return backend.loads(f.read())
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return backend.loads(b"")  # mmap can't map empty files, let the backend raise a decode error
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+            data = backend.loads(view)
     return data
 
-def write_json(data: tp.Union[tp.Dict, tp.List], path: str, create_dirs: bool = True) -> None:
+def write_json(data: tp.Union[tp.Dict, tp.List], path: str, create_dirs: bool = True,
+               indent: tp.Optional[int] = 4, json_backend: tp.Optional[str] = None, atomic: bool = False) -> None:
     """
     Writes json file.
     :param data: data to write
     :param path: path to json file
     :param create_dirs: whether to create directory if it doesn't exist
+    :param indent: indentation (None means compact output, which is smaller and faster to write)
+    :param json_backend: "orjson", "ujson" or "json" (default: the fastest installed one, see `src.json_backends`)
+    :param atomic: whether to write to a temporary file and rename it, so that the file is never partially written
     """
     if create_dirs:
         _create_dir(os.path.dirname(path))
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+    dumped = get_json_backend(json_backend).dumps(data, indent=indent)
+    _write_text(dumped, path, atomic=atomic)
 
 def append_json(path: str, data: tp.List[tp.Dict]) -> None:
     """
     Appends data to json file. If file doesn't exist, creates it.
+    The whole file is read and rewritten, so appending in a loop is quadratic. Prefer `append_jsonl` or `JsonlWriter` for it.
     :param path: path to json file
     :param data: data to append
     """
@@ -72,17 +182,237 @@ def append_json(path: str, data: tp.List[tp.Dict]) -> None:
     
     write_json(old_data + data, path)
 
-def read_csv(path: str) -> pd.DataFrame:
+def _ends_with_newline(path: str) -> bool:
+    """
+    Checks whether file is empty/missing or ends with a newline.
+    :param path: path to file
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return True
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+def _dump_jsonl_lines(data: tp.Iterable[tp.Any]) -> str:
+    """
+    Serializes records to json lines.
+    :param data: records
+    :return: one json per line, each line ends with a newline
+    """
+    dumps = get_json_backend().dumps
+    return "".join(dumps(record) + "\n" for record in data)
+
+def append_jsonl(path: str, data: tp.List[tp.Any], fsync: bool = False) -> None:
+    """
+    Appends records to json lines file (one json per line) without reading it. If file doesn't exist, creates it.
+    The cost doesn't depend on the size of the file.
+    :param path: path to jsonl file
+    :param data: records to append
+    :param fsync: whether to flush the data to disk before returning
+    """
+    _create_dir(os.path.dirname(path))
+    lines = _dump_jsonl_lines(data)
+    if not _ends_with_newline(path):
+        lines = "\n" + lines  # previous write was interrupted, don't glue new record to the truncated one
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(lines)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+
+def write_jsonl(data: tp.Iterable[tp.Any], path: str, create_dirs: bool = True) -> None:
+    """
+    Writes json lines file (one json per line).
+    :param data: records to write
+    :param path: path to jsonl file
+    :param create_dirs: whether to create directory if it doesn't exist
+    """
+    if create_dirs:
+        _create_dir(os.path.dirname(path))
+    dumps = get_json_backend().dumps
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in data:
+            f.write(dumps(record) + "\n")
+
+class JsonlWriter:
+    """
+    Keeps json lines file open and appends records to it. Data is flushed to disk (fsync) every `fsync_every` records,
+    so the durability/speed trade-off is configurable.
+
+    Usage:
+        with JsonlWriter(path, fsync_every=100) as writer:
+            writer.write(record)
+    """
+    def __init__(self, path: str, fsync_every: tp.Optional[int] = None) -> None:
+        """
+        :param path: path to jsonl file (created if it doesn't exist, appended otherwise)
+        :param fsync_every: number of records between fsyncs (None means never, rely on OS)
+        """
+        self.path = path
+        self.fsync_every = fsync_every
+        self._n_unsynced = 0
+        _create_dir(os.path.dirname(path))
+        needs_newline = not _ends_with_newline(path)
+        self._file = open(path, 'a', encoding='utf-8')
+        if needs_newline:
+            self._file.write("\n")  # previous write was interrupted, don't glue new record to the truncated one
+
+    def write(self, record: tp.Any) -> None:
+        """
+        Appends one record.
+        :param record: json serializable record
+        """
+        self.write_many([record])
+
+    def write_many(self, records: tp.List[tp.Any]) -> None:
+        """
+        Appends records.
+        :param records: json serializable records
+        """
+        self._file.write(_dump_jsonl_lines(records))
+        self._file.flush()
+        self._n_unsynced += len(records)
+        if self.fsync_every is not None and self._n_unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self) -> None:
+        """Flushes written records to disk."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._n_unsynced = 0
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        if self.fsync_every is not None and self._n_unsynced:
+            self.sync()
+        self._file.close()
+
+    def __enter__(self) -> "JsonlWriter":
+        return self
+
+    def __exit__(self, *exc_info: tp.Any) -> None:
+        self.close()
+
+def iter_jsonl(path: str) -> tp.Iterator[tp.Any]:
+    """
+    Lazily reads json lines file. Skips empty lines and corrupted lines (e.g. truncated by a crash during writing).
+    :param path: path to jsonl file
+    :return: iterator over records
+    """
+    backend = get_json_backend()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_id, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                record = backend.loads(line)
+            except backend.decode_errors:
+                logging.warning(f"Skipping corrupted line {line_id} of {path!r}")
+                continue
+            yield record
+
+def jsonl_to_json(jsonl_path: str, json_path: str, indent: tp.Optional[int] = 4) -> int:
+    """
+    Converts json lines file to json file with a list of records. Records are streamed, so memory use stays flat.
+    The output is the same as `write_json` of the whole list would produce.
+    :param jsonl_path: path to jsonl file
+    :param json_path: path to json file
+    :param indent: indentation (None means compact output)
+    :return: number of records
+    """
+    _create_dir(os.path.dirname(json_path))
+    n_records = 0
+    dumps = get_json_backend().dumps
+    newline = "\n" if indent is not None else ""
+    padding = " " * (indent or 0)
+    with open(json_path, 'w', encoding='utf-8') as f:
+        f.write("[")
+        for record in iter_jsonl(jsonl_path):
+            f.write("," + newline if n_records else newline)
+            f.write(padding + dumps(record, indent=indent).replace("\n", "\n" + padding))
+            n_records += 1
+        f.write(newline + "]" if n_records else "]")
+    return n_records
+
+def read_jsonl(path: str) -> tp.List[tp.Any]:
+    """
+    Reads json lines file.
+    :param path: path to jsonl file
+    :return: list of records
+    """
+    return list(iter_jsonl(path))
+
+def json_to_jsonl(json_path: str, jsonl_path: str) -> int:
+    """
+    Converts json file with a list of records (e.g. `data/results/*.json`) to json lines file.
+    :param json_path: path to json file
+    :param jsonl_path: path to jsonl file
+    :return: number of records
+    """
+    data = read_json(json_path)
+    assert isinstance(data, list), f"Expected list, got {type(data)} while reading {json_path!r}"
+    write_jsonl(data, jsonl_path)
+    return len(data)
+
+def read_csv(path: str, columns: tp.Optional[tp.List[str]] = None, engine: tp.Optional[str] = None) -> "pd.DataFrame":
     """
     Reads csv file.
     :param path: path to csv file
+    :param columns: columns to read (None means all), other columns are not parsed at all
+    :param engine: pandas parser engine ("c", "python" or "pyarrow", the latter is multithreaded), None means pandas default
     :return: csv
     """
+    import pandas as pd
     with open(path, 'r', encoding='utf-8') as f:
-        data = pd.read_csv(f)
+        data = pd.read_csv(f, usecols=columns, engine=engine)
     return data
 
-def write_csv(data: pd.DataFrame, path: str, create_dirs: bool = True) -> None:
+def iter_csv(path: str, chunksize: int = 10_000, columns: tp.Optional[tp.List[str]] = None,
+             engine: tp.Optional[str] = None, as_str: bool = False) -> tp.Iterator["pd.DataFrame"]:
+    """
+    Lazily reads csv file in chunks.
+    :param path: path to csv file
+    :param chunksize: number of rows in a chunk
+    :param columns: columns to read (None means all)
+    :param engine: "pyarrow" to parse with pyarrow streaming reader, otherwise pandas engine ("c" or "python")
+    :param as_str: if True, all values are read as str and empty cells as "" (types don't depend on the chunk)
+    :return: iterator over chunks
+    """
+    if engine != "pyarrow":
+        import pandas as pd
+        str_options = {"dtype": str, "keep_default_na": False} if as_str else {}
+        with pd.read_csv(path, encoding='utf-8', usecols=columns, engine=engine, chunksize=chunksize, **str_options) as reader:
+            yield from reader
+        return
+
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+    convert_kwargs: tp.Dict[str, tp.Any] = {"include_columns": columns} if columns is not None else {}
+    if as_str:
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            header = next(csv.reader(f), [])
+        convert_kwargs.update(column_types={name: pa.string() for name in header}, strings_can_be_null=False)
+    convert_options = pa_csv.ConvertOptions(**convert_kwargs) if convert_kwargs else None
+    with pa_csv.open_csv(path, convert_options=convert_options) as reader:
+        for batch in reader:
+            for start in range(0, batch.num_rows, chunksize):
+                yield batch.slice(start, chunksize).to_pandas()
+
+def iter_csv_rows(path: str, columns: tp.Optional[tp.List[str]] = None, chunksize: int = 10_000,
+                  engine: tp.Optional[str] = None) -> tp.Iterator[tp.Dict[str, tp.Any]]:
+    """
+    Lazily reads csv file row by row. Only one chunk is kept in memory.
+    :param path: path to csv file
+    :param columns: columns to read (None means all)
+    :param chunksize: number of rows parsed at once
+    :param engine: parser engine (see `iter_csv`)
+    :return: iterator over rows (column name -> value), values are str as in `csv.DictReader` (empty cells are "")
+    """
+    for chunk in iter_csv(path, chunksize=chunksize, columns=columns, engine=engine, as_str=True):
+        yield from chunk.to_dict(orient='records')
+
+def write_csv(data: "pd.DataFrame", path: str, create_dirs: bool = True) -> None:
     """
     Writes csv file.
     :param data: data to write
@@ -113,3 +443,116 @@ def append_csv(path: str, data: tp.List[tp.Dict]) -> None:
     with open(path, 'a', encoding='utf-8') as f:
         writer = csv.DictWriter(f, fieldnames=data[0].keys())
         writer.writerows(data)
+
+class CsvAppender:
+    """
+    Keeps csv file open and appends rows in batches. Column names are written if the file is new.
+
+    Usage:
+        with CsvAppender(path, flush_every=1000) as appender:
+            appender.append(row)
+    """
+    def __init__(self, path: str, fieldnames: tp.Optional[tp.List[str]] = None, flush_every: int = 1000) -> None:
+        """
+        :param path: path to csv file
+        :param fieldnames: column names (default: keys of the first appended row, or the header of the existing file)
+        :param flush_every: number of buffered rows that triggers writing to the file
+        """
+        self.path = path
+        self.fieldnames = fieldnames
+        self.flush_every = flush_every
+        self._buffer: tp.List[tp.Dict] = []
+        self._writer: tp.Optional[csv.DictWriter] = None
+
+        is_new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not is_new_file and self.fieldnames is None:
+            with open(path, 'r', encoding='utf-8', newline='') as f:
+                self.fieldnames = next(csv.reader(f))
+        _create_dir(os.path.dirname(path))
+        self._file = open(path, 'a', encoding='utf-8', newline='')
+        self._needs_header = is_new_file
+
+    def append(self, row: tp.Dict) -> None:
+        """
+        Appends one row (written to the file when the buffer is full).
+        :param row: row (column name -> value)
+        """
+        self._buffer.append(row)
+        if len(self._buffer) >= self.flush_every:
+            self.flush()
+
+    def extend(self, rows: tp.Iterable[tp.Dict]) -> None:
+        """
+        Appends rows.
+        :param rows: rows (column name -> value)
+        """
+        for row in rows:
+            self.append(row)
+
+    def flush(self) -> None:
+        """Writes buffered rows to the file."""
+        if not self._buffer:
+            return
+        if self._writer is None:
+            self.fieldnames = self.fieldnames or list(self._buffer[0].keys())
+            self._writer = csv.DictWriter(self._file, fieldnames=self.fieldnames)
+            if self._needs_header:
+                self._writer.writeheader()
+        self._writer.writerows(self._buffer)
+        self._buffer.clear()
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+
+    def __enter__(self) -> "CsvAppender":
+        return self
+
+    def __exit__(self, *exc_info: tp.Any) -> None:
+        self.close()
+
+def read_parquet(path: str, columns: tp.Optional[tp.List[str]] = None) -> "pd.DataFrame":
+    """
+    Reads parquet file (requires pyarrow or fastparquet).
+    :param path: path to parquet file
+    :param columns: columns to read (None means all)
+    :return: data
+    """
+    import pandas as pd
+    return pd.read_parquet(path, columns=columns)
+
+def write_parquet(data: "pd.DataFrame", path: str, create_dirs: bool = True, compression: tp.Optional[str] = "snappy") -> None:
+    """
+    Writes parquet file (requires pyarrow or fastparquet).
+    :param data: data to write
+    :param path: path to parquet file
+    :param create_dirs: whether to create directory if it doesn't exist
+    :param compression: compression codec (e.g. "snappy", "zstd", None)
+    """
+    if create_dirs:
+        _create_dir(os.path.dirname(path))
+    data.to_parquet(path, index=False, compression=compression)
+
+def read_feather(path: str, columns: tp.Optional[tp.List[str]] = None) -> "pd.DataFrame":
+    """
+    Reads feather (Arrow IPC) file (requires pyarrow).
+    :param path: path to feather file
+    :param columns: columns to read (None means all)
+    :return: data
+    """
+    import pandas as pd
+    return pd.read_feather(path, columns=columns)
+
+def write_feather(data: "pd.DataFrame", path: str, create_dirs: bool = True) -> None:
+    """
+    Writes feather (Arrow IPC) file (requires pyarrow).
+    :param data: data to write
+    :param path: path to feather file
+    :param create_dirs: whether to create directory if it doesn't exist
+    """
+    if create_dirs:
+        _create_dir(os.path.dirname(path))
+    data.reset_index(drop=True).to_feather(path)